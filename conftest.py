@@ -6,4 +6,6 @@ def pytest_addoption(parser):
             help="Run tests known to take a long time")
     parser.addoption("--network", action="store_true", default=False,
             help="Run tests that require network access")
+    parser.addoption("--benchmark", action="store_true", default=False,
+            help="Run benchmarks and print their timings")
 
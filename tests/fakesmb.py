@@ -0,0 +1,511 @@
+"""
+An in memory SMB2 server and a pysmb connection wired to it. The connection
+sends real SMB2 request bytes to the server and receives real response
+bytes back after a simulated round trip, so the smb_ext engines can be
+exercised (and timed) without a filer.
+"""
+from __future__ import absolute_import, unicode_literals
+import fnmatch
+import heapq
+import itertools
+import struct
+import threading
+import time
+
+from smb.SMBConnection import SMBConnection
+from smb.base import SMBTimeout
+
+HEADER_FORMAT = '<4sHHIHHIIQIIQ16s'
+ASYNC_HEADER_FORMAT = '<4sHHIHHIIQQQ16s'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+FLAGS_SERVER_TO_REDIR = 0x00000001
+FLAGS_ASYNC_COMMAND = 0x00000002
+
+COM_TREE_CONNECT = 0x03
+COM_CREATE = 0x05
+COM_CLOSE = 0x06
+COM_READ = 0x08
+COM_WRITE = 0x09
+COM_ECHO = 0x0D
+COM_QUERY_DIRECTORY = 0x0E
+COM_CHANGE_NOTIFY = 0x0F
+COM_QUERY_INFO = 0x10
+
+STATUS_SUCCESS = 0
+STATUS_PENDING = 0x00000103
+STATUS_NOTIFY_CLEANUP = 0x0000010B
+STATUS_NOTIFY_ENUM_DIR = 0x0000010C
+STATUS_NO_MORE_FILES = 0x80000006
+STATUS_END_OF_FILE = 0xC0000011
+STATUS_OBJECT_NAME_NOT_FOUND = 0xC0000034
+STATUS_OBJECT_NAME_COLLISION = 0xC0000035
+STATUS_DISK_FULL = 0xC000007F
+STATUS_FILE_IS_A_DIRECTORY = 0xC00000BA
+STATUS_BAD_NETWORK_NAME = 0xC00000CC
+STATUS_NOT_A_DIRECTORY = 0xC0000103
+STATUS_INVALID_HANDLE = 0xC0000008
+STATUS_NOT_SUPPORTED = 0xC00000BB
+
+FILE_SUPERSEDE = 0
+FILE_OPEN = 1
+FILE_CREATE = 2
+FILE_OPEN_IF = 3
+FILE_OVERWRITE = 4
+FILE_OVERWRITE_IF = 5
+FILE_DIRECTORY_FILE = 0x01
+FILE_NON_DIRECTORY_FILE = 0x40
+
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+
+FILE_ACTION_ADDED = 0x01
+FILE_ACTION_REMOVED = 0x02
+FILE_ACTION_MODIFIED = 0x03
+FILE_ACTION_RENAMED_OLD_NAME = 0x04
+FILE_ACTION_RENAMED_NEW_NAME = 0x05
+
+# 2018-01-01 00:00:00 UTC as a FILETIME
+FILETIME = 131592384000000000
+
+
+class ProtocolViolation(AssertionError):
+    "The client did something a real server would disconnect it for"
+
+
+class Node(object):
+
+    def __init__(self, name, is_dir=False, data=b''):
+        self.name = name
+        self.is_dir = is_dir
+        self.data = bytearray(data)
+        self.mtime = FILETIME
+
+
+class Open(object):
+
+    def __init__(self, share, key, node):
+        self.share = share
+        self.key = key
+        self.node = node
+        self.listing = None
+        # Changes recorded since the first CHANGE_NOTIFY on the handle and
+        # the request waiting for them
+        self.changes = None
+        self.watch = None
+        self.watch_tree = False
+        self.out_len = 0
+
+
+class FakeSMBServer(object):
+    """
+    Keeps files in memory and answers SMB2 requests. Credits are accounted
+    the way a server does: each request costs one and each response grants
+    what the client asked for (at least one) up to max_credits.
+    """
+
+    def __init__(self, shares=('share',), max_credits=512, initial_credits=1):
+        self.shares = dict((name.lower(), {}) for name in shares)
+        self.max_credits = max_credits
+        self.credits = initial_credits
+        self.trees = {}
+        self.opens = {}
+        self.fail_write_at = None
+        self.requests = []
+        # (directory, pattern) of every listing started
+        self.patterns = []
+        self._tids = itertools.count(1)
+        self._fids = itertools.count(1)
+
+    def add_file(self, share, path, data=b''):
+        nodes = self.shares[share.lower()]
+        parts = path.strip('\\').split('\\')
+        for i in range(1, len(parts)):
+            key = '\\'.join(parts[:i]).lower()
+            if key not in nodes:
+                nodes[key] = Node(parts[i - 1], is_dir=True)
+        node = Node(parts[-1], data=data)
+        key = '\\'.join(parts).lower()
+        nodes[key] = node
+        self.changed(share.lower(), key, FILE_ACTION_ADDED)
+        return node
+
+    def remove(self, share, path):
+        key = path.strip('\\').lower()
+        del self.shares[share.lower()][key]
+        self.changed(share.lower(), key, FILE_ACTION_REMOVED)
+
+    def rename(self, share, path, new_path):
+        nodes = self.shares[share.lower()]
+        key = path.strip('\\').lower()
+        new_key = new_path.strip('\\').lower()
+        node = nodes.pop(key)
+        node.name = new_path.strip('\\').rsplit('\\', 1)[-1]
+        nodes[new_key] = node
+        self.changed(share.lower(), key, FILE_ACTION_RENAMED_OLD_NAME, new_key)
+
+    def add_dir(self, share, path):
+        node = self.add_file(share, path)
+        node.is_dir = True
+        return node
+
+    def get_file(self, share, path):
+        return self.shares[share.lower()][path.strip('\\').lower()]
+
+    def handle(self, data, reply=None):
+        """
+        Handle one request, returning the encoded response. Responses to
+        requests that complete later, like CHANGE_NOTIFY, are passed to
+        reply.
+        """
+        (_, _, _, _, command, credit_request, _, _, mid, _, tid, session_id,
+            _) = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+        if self.credits < 1:
+            raise ProtocolViolation("Request sent without any credits")
+        self.credits -= 1
+        self.requests.append(command)
+        handler = {
+            COM_TREE_CONNECT: self.tree_connect,
+            COM_CREATE: self.create,
+            COM_CLOSE: self.close,
+            COM_READ: self.read,
+            COM_WRITE: self.write,
+            COM_ECHO: self.echo,
+            COM_QUERY_DIRECTORY: self.query_directory,
+            COM_QUERY_INFO: self.query_info,
+        }.get(command)
+        if command == COM_CHANGE_NOTIFY:
+            status, body, tid = self.change_notify(
+                data, tid, (mid, session_id, reply)
+            )
+        elif handler is None:
+            status, body = STATUS_NOT_SUPPORTED, None
+        else:
+            status, body, tid = handler(data, tid)
+        grant = min(max(1, credit_request), self.max_credits - self.credits)
+        if self.credits + grant < 1:
+            grant = 1
+        self.credits += grant
+        if status == STATUS_PENDING:
+            # Interim response, the mid doubles as the async id
+            return self._async_response(command, status, grant, mid, session_id)
+        return self._response(command, status, body, grant, mid, tid, session_id)
+
+    @staticmethod
+    def _response(command, status, body, grant, mid, tid, session_id):
+        if body is None:
+            body = struct.pack('<HBBI', 9, 0, 0, 0) + b'\0'
+        header = struct.pack(
+            HEADER_FORMAT, b'\xfeSMB', 64, 0, status, command, grant,
+            FLAGS_SERVER_TO_REDIR, 0, mid, 0, tid, session_id, b'\0' * 16,
+        )
+        return header + body
+
+    @staticmethod
+    def _async_response(command, status, grant, mid, session_id, body=None):
+        if body is None:
+            body = struct.pack('<HBBI', 9, 0, 0, 0) + b'\0'
+        header = struct.pack(
+            ASYNC_HEADER_FORMAT, b'\xfeSMB', 64, 0, status, command, grant,
+            FLAGS_SERVER_TO_REDIR | FLAGS_ASYNC_COMMAND, 0, mid, mid,
+            session_id, b'\0' * 16,
+        )
+        return header + body
+
+    def tree_connect(self, data, tid):
+        _, _, offset, length = struct.unpack('<HHHH', data[64:72])
+        share = data[offset:offset + length].decode('UTF-16LE').rsplit('\\', 1)[-1]
+        if share.lower() not in self.shares:
+            return STATUS_BAD_NETWORK_NAME, None, tid
+        tid = next(self._tids)
+        self.trees[tid] = share.lower()
+        return STATUS_SUCCESS, struct.pack('<HBBIII', 16, 1, 0, 0, 0, 0x1F01FF), tid
+
+    def create(self, data, tid):
+        (_, _, _, _, _, _, _, _, _, disposition, options, name_offset,
+            name_length, _, _) = struct.unpack('<HBBIQQIIIIIHHII', data[64:120])
+        path = data[name_offset:name_offset + name_length].decode('UTF-16LE')
+        key = path.strip('\\').lower()
+        nodes = self.shares[self.trees[tid]]
+        node = nodes.get(key)
+        if key == '':
+            node = Node('', is_dir=True)
+        if node is None:
+            if disposition in (FILE_OPEN, FILE_OVERWRITE):
+                return STATUS_OBJECT_NAME_NOT_FOUND, None, tid
+            parent = key.rsplit('\\', 1)[0] if '\\' in key else ''
+            if parent and parent not in nodes:
+                return STATUS_OBJECT_NAME_NOT_FOUND, None, tid
+            node = Node(
+                path.strip('\\').rsplit('\\', 1)[-1],
+                is_dir=bool(options & FILE_DIRECTORY_FILE),
+            )
+            nodes[key] = node
+            self.changed(self.trees[tid], key, FILE_ACTION_ADDED)
+        elif disposition == FILE_CREATE:
+            return STATUS_OBJECT_NAME_COLLISION, None, tid
+        elif options & FILE_DIRECTORY_FILE and not node.is_dir:
+            return STATUS_NOT_A_DIRECTORY, None, tid
+        elif options & FILE_NON_DIRECTORY_FILE and node.is_dir:
+            return STATUS_FILE_IS_A_DIRECTORY, None, tid
+        elif disposition in (FILE_SUPERSEDE, FILE_OVERWRITE, FILE_OVERWRITE_IF):
+            del node.data[:]
+        fid = struct.pack('<QQ', next(self._fids), 0)
+        self.opens[fid] = Open(self.trees[tid], key, node)
+        return STATUS_SUCCESS, self._create_response(node, fid), tid
+
+    def _create_response(self, node, fid):
+        attributes = ATTR_DIRECTORY if node.is_dir else ATTR_ARCHIVE
+        size = len(node.data)
+        return struct.pack(
+            '<HBBIQQQQQQII16sII', 89, 0, 0, 1, node.mtime, node.mtime,
+            node.mtime, node.mtime, size, size, attributes, 0, fid, 0, 0,
+        ) + b'\0'
+
+    def close(self, data, tid):
+        _, _, _, fid = struct.unpack('<HHI16s', data[64:88])
+        handle = self.opens.pop(fid, None)
+        if handle is None:
+            return STATUS_INVALID_HANDLE, None, tid
+        if handle.watch is not None:
+            self._complete(handle, STATUS_NOTIFY_CLEANUP)
+        return STATUS_SUCCESS, struct.pack('<HHIQQQQQQI', 60, 0, 0, 0, 0, 0, 0, 0, 0, 0), tid
+
+    def read(self, data, tid):
+        (_, _, _, length, offset, fid, _, _, _, _, _) = struct.unpack(
+            '<HBBIQ16sIIIHH', data[64:112]
+        )
+        handle = self.opens.get(fid)
+        if handle is None:
+            return STATUS_INVALID_HANDLE, None, tid
+        chunk = bytes(handle.node.data[offset:offset + length])
+        if not chunk:
+            return STATUS_END_OF_FILE, None, tid
+        return STATUS_SUCCESS, struct.pack('<HBBIII', 17, 80, 0, len(chunk), 0, 0) + chunk, tid
+
+    def write(self, data, tid):
+        (_, data_offset, length, offset, fid, _, _, _, _, _) = struct.unpack(
+            '<HHIQ16sIIHHI', data[64:112]
+        )
+        handle = self.opens.get(fid)
+        if handle is None:
+            return STATUS_INVALID_HANDLE, None, tid
+        if self.fail_write_at is not None and offset >= self.fail_write_at:
+            return STATUS_DISK_FULL, None, tid
+        payload = data[data_offset:data_offset + length]
+        buf = handle.node.data
+        if len(buf) < offset:
+            buf.extend(b'\0' * (offset - len(buf)))
+        buf[offset:offset + length] = payload
+        self.changed(handle.share, handle.key, FILE_ACTION_MODIFIED)
+        return STATUS_SUCCESS, struct.pack('<HHIIHH', 17, 0, length, 0, 0, 0), tid
+
+    def query_info(self, data, tid):
+        (_, info_type, info_class, _, _, _, _, _, _, fid) = struct.unpack(
+            '<HBBIHHIII16s', data[64:104]
+        )
+        handle = self.opens.get(fid)
+        if handle is None:
+            return STATUS_INVALID_HANDLE, None, tid
+        node = handle.node
+        if info_type != 1 or info_class != 0x05:
+            return STATUS_NOT_SUPPORTED, None, tid
+        # FileStandardInformation
+        info = struct.pack(
+            '<QQIBBH', len(node.data), len(node.data), 1, 0, int(node.is_dir), 0
+        )
+        return STATUS_SUCCESS, struct.pack('<HHI', 9, 72, len(info)) + info, tid
+
+    def echo(self, data, tid):
+        return STATUS_SUCCESS, struct.pack('<HH', 4, 0), tid
+
+    def query_directory(self, data, tid):
+        (_, info_class, flags, _, fid, name_offset, name_length,
+            out_len) = struct.unpack('<HBBI16sHHI', data[64:96])
+        handle = self.opens.get(fid)
+        if handle is None:
+            return STATUS_INVALID_HANDLE, None, tid
+        if not handle.node.is_dir:
+            return STATUS_NOT_A_DIRECTORY, None, tid
+        pattern = data[name_offset:name_offset + name_length].decode('UTF-16LE')
+        if handle.listing is None or flags & 0x11:
+            self.patterns.append((handle.key, pattern))
+            handle.listing = self._listing(
+                handle.share, handle.key, pattern or '*'
+            )
+        entries = []
+        size = 0
+        while handle.listing:
+            entry = self._both_directory_info(handle.listing[0])
+            if size + len(entry) > out_len:
+                break
+            handle.listing.pop(0)
+            pad = (8 - len(entry) % 8) % 8
+            entries.append(entry + b'\0' * pad)
+            size += len(entries[-1])
+            if flags & 0x02:
+                break
+        if not entries:
+            return STATUS_NO_MORE_FILES, None, tid
+        # Patch NextEntryOffset of every entry but the last.
+        body = b''
+        for n, entry in enumerate(entries):
+            if n == len(entries) - 1:
+                entry = struct.pack('<I', 0) + entry[4:]
+            else:
+                entry = struct.pack('<I', len(entry)) + entry[4:]
+            body += entry
+        return STATUS_SUCCESS, struct.pack('<HHI', 9, 72, len(body)) + body, tid
+
+    def change_notify(self, data, tid, watch):
+        (_, flags, out_len, fid, _, _) = struct.unpack('<HHI16sII', data[64:96])
+        handle = self.opens.get(fid)
+        if handle is None:
+            return STATUS_INVALID_HANDLE, None, tid
+        if not handle.node.is_dir:
+            return STATUS_NOT_A_DIRECTORY, None, tid
+        handle.watch_tree = bool(flags & 0x01)
+        handle.out_len = out_len
+        if handle.changes:
+            status, body = self._notify_response(handle)
+            return status, body, tid
+        handle.changes = []
+        handle.watch = watch
+        return STATUS_PENDING, None, tid
+
+    def changed(self, share, key, action, new_key=None):
+        """
+        Record a change for the directory handles watching key.
+        """
+        parent = key.rsplit('\\', 1)[0] if '\\' in key else ''
+        for handle in list(self.opens.values()):
+            if handle.changes is None or handle.share != share:
+                continue
+            if handle.key == parent:
+                name = key[len(parent):].lstrip('\\')
+            elif handle.watch_tree and (not handle.key or parent.startswith(handle.key + '\\')):
+                name = key[len(handle.key):].lstrip('\\')
+            else:
+                continue
+            handle.changes.append((action, name))
+            if new_key is not None:
+                handle.changes.append((
+                    FILE_ACTION_RENAMED_NEW_NAME,
+                    new_key[len(key) - len(name):],
+                ))
+            if handle.watch is not None:
+                self._complete(handle, *self._notify_response(handle))
+
+    def _notify_response(self, handle):
+        changes, handle.changes = handle.changes, []
+        entries = []
+        for action, name in changes:
+            name = name.encode('UTF-16LE')
+            entry = struct.pack('<III', 0, action, len(name)) + name
+            entries.append(entry + b'\0' * ((4 - len(entry) % 4) % 4))
+        if sum(len(entry) for entry in entries) > handle.out_len:
+            return STATUS_NOTIFY_ENUM_DIR, None
+        body = b''
+        for n, entry in enumerate(entries):
+            if n < len(entries) - 1:
+                entry = struct.pack('<I', len(entry)) + entry[4:]
+            body += entry
+        return STATUS_SUCCESS, struct.pack('<HHI', 9, 72, len(body)) + body
+
+    def _complete(self, handle, status, body=None):
+        (mid, session_id, reply), handle.watch = handle.watch, None
+        reply(self._async_response(
+            COM_CHANGE_NOTIFY, status, 0, mid, session_id, body
+        ))
+
+    def _listing(self, share, key, pattern):
+        nodes = self.shares[share]
+        prefix = key + '\\' if key else ''
+        names = [Node('.', is_dir=True), Node('..', is_dir=True)]
+        for child_key in sorted(nodes):
+            if not child_key.startswith(prefix):
+                continue
+            if '\\' in child_key[len(prefix):]:
+                continue
+            names.append(nodes[child_key])
+        return [
+            node for node in names
+            if fnmatch.fnmatch(node.name.lower(), pattern.lower())
+        ]
+
+    @staticmethod
+    def _both_directory_info(node):
+        name = node.name.encode('UTF-16LE')
+        size = len(node.data)
+        attributes = ATTR_DIRECTORY if node.is_dir else ATTR_ARCHIVE
+        return struct.pack(
+            '<IIQQQQQQIIIBB24s', 0, 0, node.mtime, node.mtime, node.mtime,
+            node.mtime, size, size, attributes, len(name), 0, 0, 0, b'\0' * 24,
+        ) + name
+
+
+class FakeSMBConnection(SMBConnection):
+    """
+    An authenticated SMB2 connection talking to a FakeSMBServer. Responses
+    are delivered rtt seconds after the request was sent.
+    """
+
+    def __init__(self, server, rtt=0, max_read_size=65536, max_write_size=65536):
+        SMBConnection.__init__(self, 'user', 'pass', 'client', 'FAKE')
+        self.server = server
+        self.rtt = rtt
+        self.is_using_smb2 = True
+        self._setupSMB2Methods()
+        self.smb_message = self._klassSMBMessage()
+        self.has_negotiated = True
+        self.has_authenticated = True
+        self.session_id = 1
+        self.sock = object()
+        self.max_read_size = max_read_size
+        self.max_write_size = max_write_size
+        self.max_transact_size = 65536
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._responses = []
+        self._seq = itertools.count()
+        self._arrived = threading.Condition(threading.Lock())
+
+    def sendNMBMessage(self, data):
+        response = self.server.handle(data, reply=self._reply)
+        with self._arrived:
+            heapq.heappush(
+                self._responses, (time.time() + self.rtt, next(self._seq), response)
+            )
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def _reply(self, response):
+        # A response to a request that completed later, possibly from
+        # another thread
+        with self._arrived:
+            heapq.heappush(
+                self._responses, (time.time() + self.rtt, next(self._seq), response)
+            )
+            self.in_flight += 1
+            self._arrived.notify_all()
+
+    def _watching(self):
+        return any(
+            handle.watch is not None and handle.watch[2] == self._reply
+            for handle in list(self.server.opens.values())
+        )
+
+    def _pollForNetBIOSPacket(self, timeout):
+        with self._arrived:
+            if not self._responses and self._watching():
+                self._arrived.wait(timeout)
+            if not self._responses:
+                raise SMBTimeout()
+            due, _, response = heapq.heappop(self._responses)
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self.in_flight -= 1
+        self.onNMBSessionMessage(0, response)
+
+    def close(self):
+        self.sock = None
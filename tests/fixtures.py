@@ -6,11 +6,32 @@ import tempfile
 
 from smb.SMBConnection import SMBConnection
 
+from .fakesmb import FakeSMBServer, FakeSMBConnection
 import pytest
 
 def data_path(filename):
     return os.path.join(os.path.dirname(__file__), 'data', filename)
 
+@pytest.yield_fixture
+def fake_smb(monkeypatch):
+    """
+    Point SMBPath objects at an in memory SMB2 server with a
+    'filerouter_stage' share holding an empty 'static_tests' directory.
+    """
+    from urlio import path, pool
+    server = FakeSMBServer(shares=('filerouter_stage',))
+    server.add_dir('filerouter_stage', 'static_tests')
+    server.connections = []
+    def connect(*args, **kwargs):
+        conn = FakeSMBConnection(server)
+        server.connections.append(conn)
+        return conn
+    monkeypatch.setattr(path, 'get_smb_connection', connect)
+    monkeypatch.setattr(pool, 'POOLS', pool.PoolManager())
+    monkeypatch.setattr(path, 'POOLS', pool.POOLS)
+    yield server
+
+
 @pytest.fixture(scope='session')
 def aws_access_key_id():
     return os.environ.get('AWS_ACCESS_KEY_ID', '')
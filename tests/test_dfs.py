@@ -0,0 +1,609 @@
+# -*- coding: utf-8 -*
+from __future__ import absolute_import, print_function, unicode_literals
+import datetime
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from urlio import dfs
+from urlio.dfs import (
+    DfsCache, DfsIndex, CompiledDfsIndex, FindDfsShare, find_dfs_share,
+    find_target_in_cache, depth_first_resources, compiled_cache_path,
+    DfsShareCache, _find_dfs_share,
+)
+import pytest
+
+
+def target(unc, state='ONLINE'):
+    return {'targets': [{'state': state, 'target': unc}]}
+
+
+def sample_cache():
+    return {
+        'timestamp': int(time.time() * 1000),
+        '\\\\filex.com': {
+            '\\\\filex.com\\Comm': {
+                '\\': target('\\\\fxs02fs0100\\Comm'),
+                '\\AS2': target('\\\\fxb05fs0300\\AS2'),
+                '\\DDS Bad Packs': target('\\\\FXB05FS0300\\DDSFTP\\BadPacks'),
+                '\\Offline': target('\\\\fxb06fs0300\\Offline', 'OFFLINE'),
+            },
+            '\\\\filex.com\\it': {
+                '\\stg': target('\\\\fxb04fs0301\\filerouter_stage'),
+            },
+        },
+    }
+
+
+def linear_find_target(uri, resources, case_sensative=False):
+    # The scan find_target_in_cache used to do over depth_first_resources(),
+    # for reference
+    test_uri = uri if case_sensative else uri.lower()
+    for path, conf in resources:
+        test_path = path if case_sensative else path.lower()
+        if test_uri.startswith(test_path + '\\') or test_path == test_uri:
+            for tgt in conf['targets']:
+                if tgt['state'] == 'ONLINE':
+                    return path, tgt
+
+
+@pytest.yield_fixture
+def dfscache(monkeypatch):
+    cache = DfsCache(sample_cache())
+    monkeypatch.setattr(dfs, 'DFSCACHE', cache)
+    monkeypatch.setattr(dfs, 'AUTO_UPDATE_DFSCACHE', False)
+    yield cache
+    cache.stop_refresher()
+
+
+@pytest.yield_fixture
+def cachedir():
+    dtemp = tempfile.mkdtemp()
+    yield dtemp
+    shutil.rmtree(dtemp)
+
+
+def write_cache(path, data):
+    with io.open(path, 'wb') as fp:
+        fp.write(json.dumps(data).encode('utf-8'))
+
+
+def test_index_lookup():
+    index = DfsIndex.from_domain_cache(sample_cache()['\\\\filex.com'])
+    assert index.size == 5
+    path, tgt = index.lookup('\\\\filex.com\\comm\\as2\\other')
+    assert path == '\\\\filex.com\\Comm\\AS2'
+    assert tgt['target'] == '\\\\fxb05fs0300\\AS2'
+    assert index.lookup('\\\\FILEX.com\\comm')[0] == '\\\\filex.com\\Comm'
+    # Links without an ONLINE target are skipped
+    assert index.lookup('\\\\filex.com\\comm\\offline\\a')[0] == '\\\\filex.com\\Comm'
+    # Components are matched whole
+    assert index.lookup('\\\\filex.com\\comm\\as2x')[0] == '\\\\filex.com\\Comm'
+    assert index.lookup('\\\\filex.com\\other') is None
+    assert index.lookup('\\\\filex.com\\Comm\\AS2', case_sensative=True)[0] == '\\\\filex.com\\Comm\\AS2'
+    assert index.lookup('\\\\filex.com\\Comm\\as2', case_sensative=True)[0] == '\\\\filex.com\\Comm'
+    assert index.lookup('\\\\filex.com\\comm', case_sensative=True) is None
+
+
+def random_cache(seed, links=200, lookups=500):
+    "A domain cache of random links and uris to look up in it"
+    rnd = random.Random(seed)
+    names = ['A', 'b', 'Cc', 'd d', 'ש']
+    domain_cache = {}
+    for n in range(links):
+        ns = '\\\\filex.com\\' + rnd.choice(names)
+        link = '\\'.join(rnd.choice(names) for _ in range(rnd.randint(0, 3)))
+        domain_cache.setdefault(ns, {})['\\' + link] = target(
+            '\\\\srv{}\\share'.format(n), rnd.choice(['ONLINE', 'OFFLINE'])
+        )
+    uris = [
+        '\\\\filex.com\\' + '\\'.join(
+            rnd.choice(names + [a.lower() for a in names])
+            for _ in range(rnd.randint(1, 6))
+        )
+        for _ in range(lookups)
+    ]
+    return domain_cache, uris
+
+
+def test_index_matches_linear_scan():
+    domain_cache, uris = random_cache(7)
+    resources = depth_first_resources(domain_cache)
+    for case_sensative in (False, True):
+        for uri in uris:
+            assert find_target_in_cache(uri, domain_cache, case_sensative) == \
+                linear_find_target(uri, resources, case_sensative), uri
+
+
+def test_find_dfs_share(dfscache):
+    assert find_dfs_share('\\\\Filex.com\\Comm') == ('fxs02fs0100', 'Comm', 'filex.com', '')
+    assert find_dfs_share('\\\\filex.com\\Comm\\AS2\\Other\\Foo\\bar.txt', case_sensative=True) == (
+        'fxb05fs0300', 'AS2', 'filex.com', 'Other\\Foo\\bar.txt'
+    )
+    assert find_dfs_share('\\\\filex.com\\Comm\\DDS Bad Packs\\bar.jpeg') == (
+        'FXB05FS0300', 'DDSFTP', 'filex.com', 'BadPacks\\bar.jpeg'
+    )
+    with pytest.raises(FindDfsShare):
+        find_dfs_share('\\\\filex.com\\comm', case_sensative=True)
+    with pytest.raises(FindDfsShare):
+        find_dfs_share('\\\\example.com\\comm')
+
+
+def test_find_dfs_share_never_fetches(dfscache, monkeypatch):
+    started = []
+    monkeypatch.setattr(dfs, 'AUTO_UPDATE_DFSCACHE', True)
+    monkeypatch.setattr(dfscache, '_fetch', lambda *args: pytest.fail('fetched'))
+    monkeypatch.setattr(dfscache, 'start_refresher', lambda: started.append(1))
+    assert find_dfs_share('\\\\filex.com\\Comm')[0] == 'fxs02fs0100'
+    assert started == [1]
+
+
+def test_refresher_swaps_indexes(dfscache, cachedir, monkeypatch):
+    path = os.path.join(cachedir, 'dfscache.json')
+    data = sample_cache()
+    data['\\\\filex.com']['\\\\filex.com\\Comm']['\\'] = target('\\\\fxs03fs0100\\Comm')
+    write_cache(path, data)
+    fetched = threading.Event()
+
+    def fetch(path, uri):
+        dfscache.last_update = datetime.datetime.utcnow()
+        fetched.set()
+        return data, os.stat(path)
+    monkeypatch.setattr(dfscache, '_fetch', fetch)
+    indexes = dfscache.indexes
+    dfscache.start_refresher(interval=60, path=path)
+    # Starting it again does nothing
+    dfscache.start_refresher(interval=60, path=path)
+    assert fetched.wait(5)
+    for _ in range(100):
+        if dfscache.indexes is not indexes:
+            break
+        time.sleep(0.01)
+    assert find_dfs_share('\\\\filex.com\\Comm')[0] == 'fxs03fs0100'
+    # Not due again for a minute
+    fetched.clear()
+    dfscache.stop_refresher()
+    dfscache.start_refresher(interval=60, path=path)
+    assert not fetched.wait(0.1)
+    dfscache.stop_refresher()
+    assert dfscache._refresher is None
+
+
+def test_refresher_survives_errors(dfscache, monkeypatch):
+    calls = []
+
+    def refresh(path):
+        calls.append(path)
+        dfscache.last_update = datetime.datetime.utcnow()
+        raise ValueError('broken')
+    monkeypatch.setattr(dfscache, 'refresh', refresh)
+    dfscache.start_refresher(interval=0.01)
+    time.sleep(0.2)
+    dfscache.stop_refresher()
+    assert len(calls) > 2
+    assert find_dfs_share('\\\\filex.com\\Comm')[0] == 'fxs02fs0100'
+
+
+def test_compiled_cache(cachedir):
+    domain_cache, uris = random_cache(11)
+    path = os.path.join(cachedir, 'dfscache.json')
+    write_cache(path, {'timestamp': 1514764800000, '\\\\Filex.com': domain_cache})
+    cache = DfsCache()
+    cache.load(path)
+    assert os.path.exists(compiled_cache_path(path))
+    assert isinstance(cache.indexes['\\\\filex.com'], DfsIndex)
+    assert '\\\\Filex.com' in cache
+    compiled = DfsCache()
+    compiled.load(path)
+    index = compiled.indexes['\\\\filex.com']
+    assert isinstance(index, CompiledDfsIndex)
+    assert compiled.timestamp == 1514764800000
+    # The JSON document isn't parsed, the domains are added by a lookup
+    assert compiled == {'timestamp': 1514764800000}
+    with io.open(path, 'r') as fp:
+        data = json.load(fp)
+    assert compiled['\\\\Filex.com'] == data['\\\\Filex.com']
+    assert compiled == data
+    resources = depth_first_resources(domain_cache)
+    for case_sensative in (False, True):
+        for uri in uris:
+            assert index.lookup(uri, case_sensative) == \
+                linear_find_target(uri, resources, case_sensative), uri
+
+
+def test_compiled_cache_fallback(cachedir, monkeypatch):
+    path = os.path.join(cachedir, 'dfscache.json')
+    compiled = compiled_cache_path(path)
+    write_cache(path, sample_cache())
+
+    def loaded():
+        cache = DfsCache()
+        cache.load(path)
+        return type(cache.indexes['\\\\filex.com'])
+
+    assert loaded() is DfsIndex
+    assert loaded() is CompiledDfsIndex
+    # Garbage, another version or a changed JSON file are replaced
+    with io.open(compiled, 'wb') as fp:
+        fp.write(b'garbage')
+    assert loaded() is DfsIndex
+    assert loaded() is CompiledDfsIndex
+    monkeypatch.setattr(dfs, 'COMPILED_VERSION', dfs.COMPILED_VERSION + 1)
+    assert loaded() is DfsIndex
+    assert loaded() is CompiledDfsIndex
+    data = sample_cache()
+    data['\\\\filex.com']['\\\\filex.com\\Comm']['\\'] = target('\\\\fxs03fs0100\\Comm')
+    write_cache(path, data)
+    os.utime(path, (time.time() + 10, time.time() + 10))
+    cache = DfsCache()
+    cache.load(path)
+    assert isinstance(cache.indexes['\\\\filex.com'], DfsIndex)
+    assert cache.indexes['\\\\filex.com'].lookup('\\\\filex.com\\comm')[1]['target'] == \
+        '\\\\fxs03fs0100\\Comm'
+    # A compiled copy that can't be written leaves the JSON in use
+    monkeypatch.setattr(dfs, 'compiled_cache_path', lambda path: os.path.join(path, 'x'))
+    assert loaded() is DfsIndex
+    assert loaded() is DfsIndex
+
+
+def test_compiled_cache_corrupt(cachedir):
+    path = os.path.join(cachedir, 'dfscache.json')
+    compiled = compiled_cache_path(path)
+    write_cache(path, sample_cache())
+    DfsCache().load(path)
+    with io.open(compiled, 'rb') as fp:
+        good = fp.read()
+    paths = dfs.COMPILED_HEADER.size + dfs.COMPILED_DOMAIN.size
+    corrupt = bytearray(good)
+    # A path row pointing past the end of the file
+    dfs.COMPILED_PATH.pack_into(corrupt, paths, len(good), 10, 0, 0)
+    for body in (good[:-20], good[:paths + 4], bytes(corrupt)):
+        with io.open(compiled, 'wb') as fp:
+            fp.write(body)
+        os.utime(compiled, None)
+        cache = DfsCache()
+        cache.load(path)
+        assert isinstance(cache.indexes['\\\\filex.com'], DfsIndex)
+        assert cache.indexes['\\\\filex.com'].lookup('\\\\filex.com\\comm')
+        with io.open(compiled, 'rb') as fp:
+            assert fp.read() == good
+
+
+def test_load_replaces_dict(cachedir):
+    path = os.path.join(cachedir, 'dfscache.json')
+    data = sample_cache()
+    data['\\\\other.com'] = {}
+    write_cache(path, data)
+    cache = DfsCache()
+    cache.load(path)
+    assert '\\\\other.com' in cache
+    data = sample_cache()
+    write_cache(path, data)
+    os.utime(path, (time.time() + 10, time.time() + 10))
+    cache.load(path)
+    assert cache == data
+    # The compiled copy leaves nothing of the JSON document behind
+    cache.load(path)
+    assert isinstance(cache.indexes['\\\\filex.com'], CompiledDfsIndex)
+    assert cache == {'timestamp': data['timestamp']}
+    assert cache.get('\\\\other.com') is None
+    assert '\\\\filex.com' in cache
+    assert cache == data
+
+
+def test_find_dfs_share_compiled(dfscache, cachedir, monkeypatch):
+    path = os.path.join(cachedir, 'dfscache.json')
+    write_cache(path, sample_cache())
+    DfsCache().load(path)
+    cache = DfsCache()
+    cache.load(path)
+    monkeypatch.setattr(dfs, 'DFSCACHE', cache)
+    assert find_dfs_share('\\\\filex.com\\Comm\\DDS Bad Packs\\bar.jpeg') == (
+        'FXB05FS0300', 'DDSFTP', 'filex.com', 'BadPacks\\bar.jpeg'
+    )
+    with pytest.raises(FindDfsShare):
+        find_dfs_share('\\\\filex.com\\comm', case_sensative=True)
+
+
+def test_has_links_below(cachedir):
+    domain_cache, _ = random_cache(5)
+    path = os.path.join(cachedir, 'dfscache.json')
+    write_cache(path, {'timestamp': 1514764800000, '\\\\filex.com': domain_cache})
+    DfsCache().load(path)
+    cache = DfsCache()
+    cache.load(path)
+    links = [link.lower() for link, _ in depth_first_resources(domain_cache)]
+    for index in (DfsIndex.from_domain_cache(domain_cache), cache.indexes['\\\\filex.com']):
+        for link in links:
+            expected = any(a.startswith(link + '\\') for a in links)
+            assert index.has_links_below(link.upper()) == expected, link
+        assert not index.has_links_below('\\\\filex.com\\missing')
+
+
+def resolve(uri):
+    return _find_dfs_share(uri)[0]
+
+
+@pytest.yield_fixture
+def share_cache(dfscache, monkeypatch):
+    lookups = []
+
+    def find_dfs_share(uri, **opts):
+        lookups.append(uri)
+        return _find_dfs_share(uri, **opts)
+    monkeypatch.setattr(dfs, '_find_dfs_share', find_dfs_share)
+    cache = DfsShareCache(maxsize=10, ttl=30, negative_ttl=30)
+    cache.lookups = lookups
+    yield cache
+
+
+def test_share_cache(share_cache):
+    uri = '\\\\filex.com\\Comm\\AS2\\Other'
+    assert share_cache.find_dfs_share(uri) == resolve(uri)
+    assert share_cache.find_dfs_share(uri) == resolve(uri)
+    assert share_cache.find_dfs_share(uri, case_sensative=True) == resolve(uri)
+    assert len(share_cache.lookups) == 2
+    for _ in range(2):
+        with pytest.raises(FindDfsShare) as e:
+            share_cache.find_dfs_share('\\\\example.com\\comm')
+        assert e.value.args[0] == "Domain not in cache: example.com"
+    assert len(share_cache.lookups) == 3
+    assert share_cache.stats() == {
+        'hits': 1, 'negative_hits': 1, 'prefix_hits': 0, 'misses': 3,
+        'evictions': 0, 'size': 4,
+    }
+
+
+def test_share_cache_prefix_reuse(share_cache):
+    uris = [
+        '\\\\filex.com\\it\\stg\\a',
+        '\\\\filex.com\\IT\\stg\\b\\c.txt',
+        '\\\\FILEX.com\\it\\STG',
+    ]
+    for uri in uris:
+        assert share_cache.find_dfs_share(uri) == resolve(uri)
+    assert share_cache.lookups == uris[:1]
+    assert share_cache.stats()['prefix_hits'] == 2
+    # There are links below Comm, so every uri is looked up
+    uris = [
+        '\\\\filex.com\\Comm\\a',
+        '\\\\filex.com\\Comm\\AS2\\b',
+        '\\\\filex.com\\Comm\\Offline\\c',
+    ]
+    for uri in uris:
+        assert share_cache.find_dfs_share(uri) == resolve(uri)
+    assert share_cache.lookups[1:] == uris
+    # Case sensitive lookups don't reuse links
+    uri = '\\\\filex.com\\it\\stg\\d'
+    assert share_cache.find_dfs_share(uri, case_sensative=True) == resolve(uri)
+    assert share_cache.lookups[-1] == uri
+
+
+def test_share_cache_expiry_and_eviction(share_cache, dfscache):
+    share_cache.negative_ttl = 0.05
+    for _ in range(2):
+        with pytest.raises(FindDfsShare):
+            share_cache.find_dfs_share('\\\\example.com\\comm')
+    time.sleep(0.1)
+    with pytest.raises(FindDfsShare):
+        share_cache.find_dfs_share('\\\\example.com\\comm')
+    assert len(share_cache.lookups) == 2
+    share_cache.maxsize = 3
+    for n in range(4):
+        share_cache.find_dfs_share('\\\\filex.com\\Comm\\{}'.format(n))
+    stats = share_cache.stats()
+    assert stats['size'] == 3 and stats['evictions'] == 2
+    # A new dfs cache forgets every result
+    dfscache.indexes = DfsCache(sample_cache()).indexes
+    share_cache.find_dfs_share('\\\\filex.com\\Comm\\3')
+    assert share_cache.lookups[-1] == '\\\\filex.com\\Comm\\3'
+    assert share_cache.stats()['size'] == 1
+
+
+def test_share_cache_cold_load(share_cache, dfscache, cachedir, monkeypatch):
+    path = os.path.join(cachedir, 'dfscache.json')
+    write_cache(path, sample_cache())
+    cold = DfsCache()
+    monkeypatch.setattr(cold, 'load', lambda: DfsCache.load(cold, path))
+    monkeypatch.setattr(dfs, 'DFSCACHE', cold)
+    uri = '\\\\filex.com\\Comm\\AS2\\Other'
+    expected = resolve(uri)
+    cold.indexes = {}
+    # The first result, found by loading the dfs cache, is kept
+    assert share_cache.find_dfs_share(uri) == expected
+    assert cold.indexes
+    assert share_cache.find_dfs_share(uri) == expected
+    assert share_cache.lookups == [uri]
+    assert share_cache.stats()['hits'] == 1
+
+
+class CacheHandler(BaseHTTPRequestHandler):
+    "Serves server.body like the dfs reference service, honouring validators"
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if server.status != 200:
+            self.send_response(server.status)
+            self.end_headers()
+            return
+        etag = '"{}"'.format(server.version)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(server.body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', 'Mon, 01 Jan 2018 00:00:00 GMT')
+        self.end_headers()
+        self.wfile.write(server.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.yield_fixture
+def cache_server():
+    server = HTTPServer(('127.0.0.1', 0), CacheHandler)
+    server.requests = []
+    server.status = 200
+    server.version = 1
+    server.body = json.dumps(sample_cache(), indent=1).encode('utf-8')
+    server.uri = 'http://127.0.0.1:{}/cache'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_conditional(cachedir, cache_server):
+    path = os.path.join(cachedir, 'dfscache.json')
+    cache = DfsCache()
+    assert cache.fetch(path, uri=cache_server.uri) == path
+    # The body is written as served
+    with io.open(path, 'rb') as f:
+        assert f.read() == cache_server.body
+    assert sorted(os.listdir(cachedir)) == ['dfscache.json', 'dfscache.json.meta']
+    assert 'If-None-Match' not in cache_server.requests[0]
+
+    # Unchanged, the server answers 304 and the copy on disk is kept
+    cache.last_update = datetime.datetime(1970, 1, 1)
+    assert cache.fetch(path, uri=cache_server.uri) is False
+    assert cache.last_update > datetime.datetime(1970, 1, 1)
+    headers = cache_server.requests[1]
+    assert headers['If-None-Match'] == '"1"'
+    assert headers['If-Modified-Since'] == 'Mon, 01 Jan 2018 00:00:00 GMT'
+
+    cache_server.version = 2
+    cache_server.body = json.dumps(sample_cache()).encode('utf-8')
+    assert cache.fetch(path, uri=cache_server.uri) == path
+    with io.open(path, 'rb') as f:
+        assert f.read() == cache_server.body
+    assert cache.fetch(path, uri=cache_server.uri) is False
+    assert cache_server.requests[3]['If-None-Match'] == '"2"'
+    cache.load(path)
+    assert cache.indexes['\\\\filex.com'].lookup('\\\\filex.com\\Comm')[0] == '\\\\filex.com\\Comm'
+
+
+def test_refresh_parses_once(cachedir, cache_server, monkeypatch):
+    path = os.path.join(cachedir, 'dfscache.json')
+    parsed = []
+    loads = json.loads
+
+    def counting_loads(s, *args, **kwargs):
+        if len(s) == len(cache_server.body):
+            parsed.append(1)
+        return loads(s, *args, **kwargs)
+    monkeypatch.setattr(json, 'loads', counting_loads)
+    cache = DfsCache()
+    cache.refresh(path, uri=cache_server.uri)
+    assert len(parsed) == 1
+    assert isinstance(cache.indexes['\\\\filex.com'], DfsIndex)
+    assert cache.timestamp == json.loads(cache_server.body.decode('utf-8'))['timestamp']
+    # The compiled copy was written from it
+    fresh = DfsCache()
+    fresh.load(path)
+    assert isinstance(fresh.indexes['\\\\filex.com'], CompiledDfsIndex)
+
+
+def test_fetch_without_copy(cachedir, cache_server):
+    path = os.path.join(cachedir, 'dfscache.json')
+    cache = DfsCache()
+    assert cache.fetch(path, uri=cache_server.uri) == path
+    # Validators are only sent when there is a copy they describe
+    os.remove(path)
+    assert cache.fetch(path, uri=cache_server.uri) == path
+    assert 'If-None-Match' not in cache_server.requests[1]
+
+
+@pytest.mark.parametrize('body', [b'{"timestamp": 15147', b'[]'])
+def test_fetch_invalid_body(cachedir, cache_server, body):
+    path = os.path.join(cachedir, 'dfscache.json')
+    cache = DfsCache()
+    assert cache.fetch(path, uri=cache_server.uri) == path
+    with io.open(path, 'rb') as f:
+        served = f.read()
+    with io.open(path + '.meta', 'rb') as f:
+        meta = f.read()
+    cache_server.version = 2
+    cache_server.body = body
+    assert cache.fetch(path, uri=cache_server.uri) is False
+    assert sorted(os.listdir(cachedir)) == ['dfscache.json', 'dfscache.json.meta']
+    with io.open(path, 'rb') as f:
+        assert f.read() == served
+    with io.open(path + '.meta', 'rb') as f:
+        assert f.read() == meta
+    # Still asking for the broken copy to be replaced
+    assert cache_server.requests[-1]['If-None-Match'] == '"1"'
+
+
+def test_fetch_error(cachedir, cache_server):
+    path = os.path.join(cachedir, 'dfscache.json')
+    data = sample_cache()
+    write_cache(path, data)
+    cache_server.status = 500
+    cache = DfsCache()
+    assert cache.fetch(path, uri=cache_server.uri) is False
+    assert os.listdir(cachedir) == ['dfscache.json']
+    with io.open(path, 'rb') as f:
+        assert json.loads(f.read().decode('utf-8')) == data
+
+
+@pytest.mark.skipif(not pytest.config.getvalue('benchmark'), reason='--benchmark was not specifified')
+def test_index_lookup_benchmark():
+    domain_cache = {}
+    for n in range(20000):
+        ns = '\\\\filex.com\\ns{}'.format(n % 20)
+        domain_cache.setdefault(ns, {})['\\link{}\\sub'.format(n)] = target(
+            '\\\\srv{}\\share'.format(n)
+        )
+    uris = [
+        '\\\\filex.com\\ns{}\\link{}\\sub\\a\\b.txt'.format(n % 20, n)
+        for n in range(0, 20000, 200)
+    ]
+    resources = depth_first_resources(domain_cache)
+    start = time.time()
+    for uri in uris:
+        linear_find_target(uri, resources)
+    linear = time.time() - start
+    find_target_in_cache(uris[0], domain_cache)
+    start = time.time()
+    for uri in uris:
+        find_target_in_cache(uri, domain_cache)
+    indexed = time.time() - start
+    print('linear {:.0f} lookups/s, indexed {:.0f} lookups/s'.format(
+        len(uris) / linear, len(uris) / indexed))
+
+
+@pytest.mark.skipif(not pytest.config.getvalue('benchmark'), reason='--benchmark was not specifified')
+def test_compiled_cache_load_benchmark(cachedir):
+    domain_cache, uris = random_cache(3, links=50000, lookups=1000)
+    path = os.path.join(cachedir, 'dfscache.json')
+    write_cache(path, {'timestamp': 1514764800000, '\\\\filex.com': domain_cache})
+    start = time.time()
+    DfsCache().load(path)
+    parsed = time.time() - start
+    cache = DfsCache()
+    start = time.time()
+    cache.load(path)
+    mapped = time.time() - start
+    index = cache.indexes['\\\\filex.com']
+    start = time.time()
+    for uri in uris:
+        index.lookup(uri)
+    lookups = time.time() - start
+    print('json {:.1f} ms, compiled {:.1f} ms, {:.0f} lookups/s'.format(
+        parsed * 1000, mapped * 1000, len(uris) / lookups))
@@ -0,0 +1,115 @@
+from __future__ import absolute_import, print_function, unicode_literals
+
+from urlio.globbing import Glob, expand_braces
+import pytest
+
+
+def matches(glob, path):
+    state = glob.start()
+    for name in path.split('\\'):
+        state = glob.child(state, name)
+    return glob.match(state)
+
+
+def state(glob, path):
+    state = glob.start()
+    for name in path.split('\\'):
+        if name:
+            state = glob.child(state, name)
+    return state
+
+
+def test_expand_braces():
+    assert expand_braces('*.edi') == ['*.edi']
+    assert expand_braces('*.{edi,x12}') == ['*.edi', '*.x12']
+    assert expand_braces('a{b,c{d,e}}f') == ['abf', 'acdf', 'acef']
+    assert expand_braces('{a,b}{c,d}') == ['ac', 'ad', 'bc', 'bd']
+    assert expand_braces('{a}{b,c}') == ['{a}b', '{a}c']
+    assert expand_braces('a{b,c') == ['a{b,c']
+
+
+@pytest.mark.parametrize('pattern,path,expected', [
+    ('*.edi', 'a.edi', True),
+    ('*.edi', 'A.EDI', True),
+    ('*.edi', 'a.txt', False),
+    ('*.edi', 'sub\\a.edi', False),
+    ('**/*.edi', 'a.edi', True),
+    ('**/*.edi', 'sub\\deeper\\a.edi', True),
+    ('**', 'sub\\deeper\\a.edi', True),
+    ('in/**/*.edi', 'in\\a.edi', True),
+    ('in/**/*.edi', 'in\\x\\y\\a.edi', True),
+    ('in/**/*.edi', 'out\\a.edi', False),
+    ('in\\*\\*.edi', 'in\\x\\a.edi', True),
+    ('in\\*\\*.edi', 'in\\a.edi', False),
+    ('*.{edi,x12}', 'a.x12', True),
+    ('{in,out}/*.[ex]*', 'out\\a.x12', True),
+    ('{in,out}/*.[ex]*', 'out\\a.txt', False),
+])
+def test_match(pattern, path, expected):
+    assert matches(Glob(pattern), path) is expected
+
+
+def test_exclude():
+    glob = Glob('**', exclude=['*.tmp', 'archive'])
+    assert matches(glob, 'a.edi')
+    assert not matches(glob, 'a.tmp')
+    assert matches(glob, 'sub\\a.tmp')
+    assert not glob.descend(state(glob, 'archive'))
+    assert glob.descend(state(glob, 'sub'))
+    glob = Glob('**', exclude='**/*.tmp')
+    assert not matches(glob, 'sub\\a.tmp')
+
+
+def test_recursive_patterns_match_at_any_depth():
+    glob = Glob.recursive('*.edi')
+    assert matches(glob, 'a.edi')
+    assert matches(glob, 'x\\y\\a.edi')
+    glob = Glob.recursive('in/*.edi')
+    assert not matches(glob, 'x\\in\\a.edi')
+
+
+def test_recursive_excludes_match_at_any_depth():
+    glob = Glob.recursive('*.edi', exclude=['*.tmp.edi', 'archive'])
+    assert matches(glob, 'sub\\a.edi')
+    assert not matches(glob, 'x.tmp.edi')
+    assert not matches(glob, 'sub\\y.tmp.edi')
+    assert not glob.descend(state(glob, 'sub\\archive'))
+    glob = Glob.recursive('*.edi', exclude='in/*.tmp.edi')
+    assert not matches(glob, 'in\\y.tmp.edi')
+    assert matches(glob, 'x\\in\\y.tmp.edi')
+
+
+def test_descend():
+    glob = Glob('in/*/*.edi')
+    assert glob.descend(state(glob, ''))
+    assert glob.descend(state(glob, 'in'))
+    assert not glob.descend(state(glob, 'out'))
+    assert glob.descend(state(glob, 'in\\x'))
+    assert not glob.descend(state(glob, 'in\\x\\y'))
+    assert not glob.descend(state(glob, 'in\\x\\y\\z'))
+
+
+def test_server_pattern():
+    glob = Glob('in/*/*.edi')
+    assert glob.server_pattern(state(glob, '')) == '*'
+    assert glob.server_pattern(state(glob, 'in\\x')) == '*.edi'
+    # Subdirectories have to be listed
+    glob = Glob('**/*.edi')
+    assert glob.server_pattern(state(glob, '')) == '*'
+    assert glob.server_pattern(state(glob, ''), descend=False) == '*.edi'
+    # More than one pattern or one the server doesn't understand
+    glob = Glob('*.{edi,x12}')
+    assert glob.server_pattern(glob.start()) == '*'
+    glob = Glob('*.[ex]*')
+    assert glob.server_pattern(glob.start()) == '*'
+    glob = Glob('A*.EDI', exclude='*.tmp')
+    assert glob.server_pattern(glob.start()) == 'a*.edi'
+
+
+def test_is_plain():
+    assert Glob.is_plain('*.edi')
+    assert Glob.is_plain('ab?.txt')
+    assert not Glob.is_plain('**/*.edi')
+    assert not Glob.is_plain('*.{edi,x12}')
+    assert not Glob.is_plain('*.[ex]*')
+    assert not Glob.is_plain(['*.edi'])
@@ -9,13 +9,15 @@ import shutil
 import os
 import errno
 import tempfile
+import threading
+import time
 from urlio import path
 from urlio.dfs import find_dfs_share, FindDfsShare
 from urlio.path import (
     PathFactory, SMBPath, LocalPath, smb_dirname, getBIOSName, OperationFailure
 )
 
-from .fixtures import data_path
+from .fixtures import data_path, fake_smb
 import pytest
 
 BASE = '\\\\filex.com\\it\\stg\\static_tests'
@@ -76,6 +78,7 @@ def mock_find_dfs_share(path, api=None):
         path,
     )
 
+
 def test_find_dfs_share_a():
     rslt = find_dfs_share('\\\\filex.com\\Comm')
     assert rslt == ('fxs02fs0100', 'Comm', 'filex.com', '')
@@ -614,6 +617,30 @@ def test_smb_join():
     assert p.join('b', 'c', 'd').path == '\\\\filex.com\\it\\stg\\a\\b\\c\\d'
     p = SMBPath('\\\\filex.com\\it\\stg\\a', find_dfs_share=mock_find_dfs_share)
     assert p.join('b', '\\c\\', '\\d').path == '\\\\filex.com\\it\\stg\\a\\b\\c\\d'
+    assert p.join('b', '\\c\\', '\\d').relpath == 'a\\b\\c\\d'
+
+
+def test_smb_join_does_not_resolve_children(fake_smb):
+    calls = []
+
+    def find_dfs_share(path, api=None):
+        calls.append(path)
+        return mock_find_dfs_share(path)
+
+    for n in range(1000):
+        fake_smb.add_file('filerouter_stage', 'static_tests\\f{:04d}.txt'.format(n))
+    p = SMBPath(BASE, user='someone', find_dfs_share=find_dfs_share)
+    files = list(p.files())
+    assert len(files) == 1000
+    assert calls == [BASE]
+    child = files[0]
+    assert (child.server_name, child.share, child.domain, child.relpath) == (
+        'fxb04fs0301', 'filerouter_stage', 'filex.com', 'static_tests\\f0000.txt'
+    )
+    assert child.user == 'someone'
+    assert child.find_dfs_share is find_dfs_share
+    assert child.join('x').relpath == 'static_tests\\f0000.txt\\x'
+    assert calls == [BASE]
 
 def test_local_join():
     assert LocalPath('/tmp/a').join('b', 'c', 'd').path == '/tmp/a/b/c/d'
@@ -730,3 +757,497 @@ def test_wrap_smb_paths_in_io_wrappers(smbtmpfile):
     )
     fp = io.TextIOWrapper(pth)
     assert fp.read() == smbtmpfile
+
+
+def test_transport_cache_record_and_expire():
+    cache = path.TransportCache(ttl=0.01)
+    assert cache('fxb04fs0301.filex.com') is None
+    cache.record('FXB04FS0301.filex.com', True, 0.02)
+    assert cache('fxb04fs0301.filex.com') is True
+    entry = cache.get('fxb04fs0301.filex.com')
+    assert entry['port'] == 445
+    assert entry['connect_time'] == 0.02
+    assert cache.order('fxb04fs0301.filex.com') == (True, False)
+    import time
+    time.sleep(0.02)
+    assert cache('fxb04fs0301.filex.com') is None
+    assert cache.order('fxb04fs0301.filex.com') == path.TRANSPORT_ORDER
+
+
+def test_transport_cache_invalidate():
+    cache = path.TransportCache()
+    cache.record('fxb04fs0301.filex.com', False)
+    cache.invalidate('fxb04fs0301.filex.com')
+    assert cache('fxb04fs0301.filex.com') is None
+
+
+def test_transport_cache_race_picks_listening_port(monkeypatch):
+    import socket
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(2)
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    ports = {True: listener.getsockname()[1], False: closed.getsockname()[1]}
+    closed.close()
+    monkeypatch.setattr(path, 'transport_port', lambda direct: ports[direct])
+    cache = path.TransportCache(race=True)
+    try:
+        assert cache.order('localhost', timeout=2) == (True, False)
+    finally:
+        listener.close()
+    assert cache('localhost') is True
+
+
+def test_smbpath_uses_cached_transport(monkeypatch):
+    from urlio import pool
+    attempts = []
+
+    class Conn(object):
+        sock = object()
+        pending_requests = {}
+        is_busy = False
+
+    def connect(*args, **kwargs):
+        attempts.append(kwargs['is_direct_tcp'])
+        return Conn()
+
+    def find_share(path, api=None):
+        return ('fxb04fs0301', 'filerouter_stage', 'filex.com', 'foo')
+
+    cache = path.TransportCache()
+    cache.record('fxb04fs0301.filex.com', True)
+    monkeypatch.setattr(path, 'transportcache', cache)
+    monkeypatch.setattr(path, 'get_smb_connection', connect)
+    monkeypatch.setattr(path, 'POOLS', pool.PoolManager())
+    p = SMBPath('\\\\filex.com\\it\\stg\\foo', find_dfs_share=find_share)
+    with p.connection():
+        pass
+    assert attempts == [True]
+
+
+def test_smbpath_read_session_reuses_handle(fake_smb):
+    data = os.urandom(200 * 1024)
+    fake_smb.add_file('filerouter_stage', 'static_tests\\session.bin', data)
+    p = SMBPath(BASE + '\\session.bin', find_dfs_share=mock_find_dfs_share)
+    chunks = []
+    chunk = p.read(64 * 1024)
+    while chunk:
+        chunks.append(chunk)
+        chunk = p.read(64 * 1024)
+    assert b''.join(chunks) == data
+    assert fake_smb.requests.count(0x05) == 1
+    assert len(fake_smb.opens) == 1
+    p.seek(10)
+    assert p.read(5) == data[10:15]
+    assert p.tell() == 15
+    p.close()
+    assert not fake_smb.opens
+    assert fake_smb.requests.count(0x05) == 1
+
+
+def test_smbpath_read_session_sees_appended_data(fake_smb):
+    node = fake_smb.add_file('filerouter_stage', 'static_tests\\grow.txt', b'abcdef')
+    p = SMBPath(BASE + '\\grow.txt', find_dfs_share=mock_find_dfs_share)
+    assert p.read(4) == b'abcd'
+    assert p.read(10) == b'ef'
+    assert p.read(10) == b''
+    # Appended while the handle is open
+    node.data.extend(b'ghij' * 50000)
+    assert p.read(3) == b'ghi'
+    assert p.read(-1) == (b'ghij' * 50000)[3:]
+    assert p.read(10) == b''
+    assert len(fake_smb.opens) == 1
+    p.close()
+
+
+@pytest.mark.parametrize('mode', ['rb', 'r+b'])
+def test_smbpath_large_read_of_small_file(fake_smb, mode):
+    tracemalloc = pytest.importorskip('tracemalloc')
+    fake_smb.add_file('filerouter_stage', 'static_tests\\small.txt', b'0123456789')
+    p = SMBPath(BASE + '\\small.txt', mode=mode, find_dfs_share=mock_find_dfs_share)
+    tracemalloc.start()
+    try:
+        assert p.read(1 << 30) == b'0123456789'
+        assert p.read(1 << 30) == b''
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        p.close()
+    assert peak < 4 * 1024 * 1024
+
+
+def test_smbpath_read_session_context_manager(fake_smb):
+    fake_smb.add_file('filerouter_stage', 'static_tests\\ctx.txt', b'abcdef')
+    with SMBPath(BASE + '\\ctx.txt', find_dfs_share=mock_find_dfs_share) as p:
+        assert p.read(3) == b'abc'
+        assert p.read(3) == b'def'
+        assert p.read(3) == b''
+    assert p.closed
+    assert not fake_smb.opens
+
+
+def test_smbpath_full_read_does_not_hold_file_open(fake_smb):
+    fake_smb.add_file('filerouter_stage', 'static_tests\\full.txt', b'abcdef')
+    p = SMBPath(BASE + '\\full.txt', find_dfs_share=mock_find_dfs_share)
+    assert p.read() == b'abcdef'
+    assert not fake_smb.opens
+    assert p._conn is None
+
+
+def test_smbpath_readline_buffered(fake_smb):
+    lines = [b'line %d\n' % n for n in range(2000)] + [b'no newline']
+    fake_smb.add_file('filerouter_stage', 'static_tests\\lines.txt', b''.join(lines))
+    p = SMBPath(
+        BASE + '\\lines.txt', find_dfs_share=mock_find_dfs_share,
+        buffer_size=4096,
+    )
+    assert p.readline() == lines[0]
+    assert p.tell() == len(lines[0])
+    assert p.read(3) == lines[1][:3]
+    assert p.readline() == lines[1][3:]
+    assert list(p) == lines[2:]
+    assert p.readline() == b''
+    reads = fake_smb.requests.count(0x08)
+    # Plus one read for each of the three reads reaching the end of the
+    # file, asking whether it grew
+    assert reads <= len(b''.join(lines)) // 4096 + 2 + 3
+    p.seek(0)
+    assert p.readline(4) == b'line'
+    p.close()
+
+
+def test_smbpath_buffered_reader_and_text_wrapper(fake_smb):
+    data = u'caf\xe9\nna\xefve\n'.encode('utf-8') * 500
+    fake_smb.add_file('filerouter_stage', 'static_tests\\text.txt', data)
+    p = SMBPath(BASE + '\\text.txt', find_dfs_share=mock_find_dfs_share)
+    reader = io.BufferedReader(p, buffer_size=1024)
+    text = io.TextIOWrapper(reader, encoding='utf-8')
+    assert text.readline() == u'caf\xe9\n'
+    assert text.read() == data.decode('utf-8')[len(u'caf\xe9\n'):]
+    text.close()
+    assert p.closed
+    assert not fake_smb.opens
+
+
+def test_smbpath_seek_whence(fake_smb):
+    fake_smb.add_file('filerouter_stage', 'static_tests\\seek.bin', b'0123456789')
+    p = SMBPath(BASE + '\\seek.bin', find_dfs_share=mock_find_dfs_share)
+    assert p.seek(2) == 2
+    assert p.seek(3, io.SEEK_CUR) == 5
+    buf = bytearray(3)
+    assert p.readinto(buf) == 3
+    assert bytes(buf) == b'567'
+    p.close()
+
+
+
+def test_smbpath_readinto_reuses_buffer(fake_smb):
+    data = os.urandom(100 * 1024 + 5)
+    fake_smb.add_file('filerouter_stage', 'static_tests\\into.bin', data)
+    p = SMBPath(BASE + '\\into.bin', find_dfs_share=mock_find_dfs_share)
+    buf = bytearray(16 * 1024)
+    view = memoryview(buf)
+    out = io.BytesIO()
+    n = p.readinto(buf)
+    while n:
+        out.write(view[:n])
+        n = p.readinto(view)
+    assert out.getvalue() == data
+    assert p.tell() == len(data)
+    p.close()
+
+
+def test_smbpath_readinto_mmap(fake_smb):
+    import mmap
+    import tempfile
+    data = os.urandom(8192)
+    fake_smb.add_file('filerouter_stage', 'static_tests\\map.bin', data)
+    with tempfile.TemporaryFile() as fp:
+        fp.write(b'\0' * len(data))
+        fp.flush()
+        region = mmap.mmap(fp.fileno(), len(data))
+        p = SMBPath(BASE + '\\map.bin', find_dfs_share=mock_find_dfs_share)
+        p.seek(100)
+        assert p.readinto(region) == len(data) - 100
+        assert region[:len(data) - 100] == data[100:]
+        region.close()
+        p.close()
+
+
+class RecordingLock(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def acquire(self, server, share, path):
+        self.calls.append('acquire')
+
+    def release(self, server, share, path):
+        self.calls.append('release')
+
+
+def test_smbpath_write_session_opens_once(fake_smb):
+    lock = RecordingLock()
+    data = os.urandom(100 * 1024)
+    p = SMBPath(
+        BASE + '\\chunks.bin', mode='wb', find_dfs_share=mock_find_dfs_share,
+        write_lock=lock,
+    )
+    p.chunked_copy(io.BytesIO(data), size=1024)
+    assert p.tell() == len(data)
+    assert fake_smb.requests.count(0x05) == 1
+    assert len(fake_smb.opens) == 1
+    assert lock.calls == ['acquire']
+    p.close()
+    assert lock.calls == ['acquire', 'release']
+    assert not fake_smb.opens
+    node = fake_smb.get_file('filerouter_stage', 'static_tests\\chunks.bin')
+    assert bytes(node.data) == data
+
+
+def test_smbpath_write_flush_closes_session(fake_smb):
+    lock = RecordingLock()
+    p = SMBPath(
+        BASE + '\\flush.txt', mode='wb', find_dfs_share=mock_find_dfs_share,
+        write_lock=lock,
+    )
+    p.write(b'abc')
+    p.flush()
+    assert not fake_smb.opens
+    p.write(b'def')
+    p.seek(0)
+    assert p.read(6) == b'abcdef'
+    p.close()
+    assert lock.calls == ['acquire', 'release', 'acquire', 'release']
+    node = fake_smb.get_file('filerouter_stage', 'static_tests\\flush.txt')
+    assert bytes(node.data) == b'abcdef'
+
+
+def test_smbpath_write_bytes_like(fake_smb):
+    import array
+    data = os.urandom(10 * 1024)
+    p = SMBPath(
+        BASE + '\\view.bin', mode='wb', find_dfs_share=mock_find_dfs_share,
+    )
+    assert p.write(memoryview(data)[:4096]) == 4096
+    assert p.write(bytearray(data[4096:8192])) == 4096
+    words = array.array('I', data[8192:])
+    assert p.write(words) == len(data) - 8192
+    assert p.tell() == len(data)
+    p.close()
+    node = fake_smb.get_file('filerouter_stage', 'static_tests\\view.bin')
+    assert bytes(node.data) == data
+
+
+def test_smbpath_cursor_pages_without_relisting(fake_smb):
+    names = ['f{:04d}.txt'.format(n) for n in range(2500)]
+    for name in names:
+        fake_smb.add_file('filerouter_stage', 'static_tests\\' + name)
+    p = SMBPath(BASE, find_dfs_share=mock_find_dfs_share)
+    cursor = p.cursor(page_size=100)
+    first = cursor.next_page()
+    assert [a.basename for a in first] == names[:100]
+    assert cursor.position == 100
+    seen = [a.basename for a in first]
+    for page in cursor:
+        assert len(page) <= 100
+        seen.extend(a.basename for a in page)
+    assert seen == names
+    assert cursor.done
+    assert fake_smb.requests.count(0x05) == 1
+    # One QUERY_DIRECTORY per response rather than per page
+    assert fake_smb.requests.count(0x0e) < 10
+    assert not fake_smb.opens
+    stats = list(path.POOLS.stats().values())[0]
+    assert stats['in_use'] == 0
+
+
+def test_smbpath_cursor_resumes_at_position(fake_smb):
+    names = ['f{:02d}.txt'.format(n) for n in range(30)]
+    for name in names:
+        fake_smb.add_file('filerouter_stage', 'static_tests\\' + name)
+    p = SMBPath(BASE, find_dfs_share=mock_find_dfs_share)
+    with p.cursor(page_size=7) as cursor:
+        cursor.next_page()
+        position = cursor.position
+    assert not fake_smb.opens
+    with p.cursor(page_size=7, position=position) as cursor:
+        rest = [a.basename for page in cursor for a in page]
+    assert rest == names[7:]
+
+
+@pytest.yield_fixture
+def listing_cache(monkeypatch):
+    cache = path.ListingCache(ttl=30, maxsize=4)
+    monkeypatch.setattr(path, 'listingcache', cache)
+    yield cache
+
+
+def test_listing_cache_lru_and_ttl(listing_cache, monkeypatch):
+    for n in range(5):
+        listing_cache.set('srv', 'share', 'dir{}'.format(n), '*', [n])
+    assert listing_cache.get('SRV', 'share', 'dir0', '*') is None
+    assert listing_cache.get('srv', 'share', 'DIR1', '*') == [1]
+    listing_cache.set('srv', 'share', 'dir5', '*', [5])
+    # dir1 was used more recently than dir2
+    assert listing_cache.get('srv', 'share', 'dir1', '*') == [1]
+    assert listing_cache.get('srv', 'share', 'dir2', '*') is None
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 60)
+    assert listing_cache.get('srv', 'share', 'dir1', '*') is None
+    assert listing_cache.stats() == {
+        'hits': 2, 'misses': 3, 'evictions': 2, 'invalidations': 0,
+        'size': 3,
+    }
+
+
+def test_listing_cache_invalidate(listing_cache):
+    listing_cache.maxsize = 10
+    for relpath in ('a', 'a\\b', 'a\\b\\c', 'a\\bc', 'x'):
+        listing_cache.set('srv', 'share', relpath, '*', [relpath])
+    listing_cache.set('srv', 'share', 'a', '*.txt', [])
+    # A file in a, only the listings of a change
+    listing_cache.invalidate('srv', 'share', 'a\\f.txt')
+    assert listing_cache.get('srv', 'share', 'a', '*') is None
+    assert listing_cache.get('srv', 'share', 'a', '*.txt') is None
+    assert listing_cache.get('srv', 'share', 'a\\b', '*') == ['a\\b']
+    listing_cache.invalidate('srv', 'share', 'a\\b', tree=True)
+    assert listing_cache.get('srv', 'share', 'a\\b\\c', '*') is None
+    assert listing_cache.get('srv', 'share', 'a\\bc', '*') == ['a\\bc']
+    assert listing_cache.get('srv', 'share', 'x', '*') == ['x']
+    assert listing_cache.stats()['invalidations'] == 4
+
+
+def test_smbpath_ls_uses_listing_cache(fake_smb, listing_cache):
+    fake_smb.add_file('filerouter_stage', 'static_tests\\a.txt', b'a')
+    p = SMBPath(BASE, find_dfs_share=mock_find_dfs_share)
+    assert [a.basename for a in p.ls()] == ['a.txt']
+    queries = fake_smb.requests.count(0x0e)
+    assert [a.basename for a in p.files()] == ['a.txt']
+    assert [a.basename for a in p.ls(limit=1)] == ['a.txt']
+    assert fake_smb.requests.count(0x0e) == queries
+    assert listing_cache.stats()['hits'] == 2
+    # A different glob is listed on its own
+    assert list(p.ls('*.edi')) == []
+    assert fake_smb.requests.count(0x0e) > queries
+
+    f = p.join('b.txt')
+    f.mode = 'wb'
+    f.write(b'b')
+    f.close()
+    assert [a.basename for a in p.ls()] == ['a.txt', 'b.txt']
+    assert p.join('b.txt').size == 1
+
+    p.join('sub', 'c.txt').makedirs()
+    assert [a.basename for a in p.dirs()] == ['sub']
+
+
+def test_smbpath_write_session_invalidates_once(fake_smb, listing_cache, monkeypatch):
+    calls = []
+    invalidate = listing_cache.invalidate
+    monkeypatch.setattr(listing_cache, 'invalidate', lambda *args, **kwargs: (
+        calls.append(args), invalidate(*args, **kwargs)
+    ))
+    p = SMBPath(BASE, find_dfs_share=mock_find_dfs_share)
+    f = p.join('b.txt')
+    f.mode = 'wb'
+    for n in range(10):
+        f.write(b'b')
+    assert not calls
+    f.flush()
+    assert len(calls) == 1
+    f.write(b'b')
+    f.close()
+    assert len(calls) == 2
+    assert [a.basename for a in p.ls()] == ['b.txt']
+    assert p.join('b.txt').size == 11
+
+
+def test_smbpath_ls_recurse_uses_listing_cache(fake_smb, listing_cache):
+    fake_smb.add_file('filerouter_stage', 'static_tests\\sub\\a.txt', b'a')
+    p = SMBPath(BASE, find_dfs_share=mock_find_dfs_share)
+    names = [a.basename for a in p.ls(recurse=True)]
+    assert names == ['sub', 'a.txt']
+    queries = fake_smb.requests.count(0x0e)
+    assert [a.basename for a in p.ls(recurse=True)] == names
+    assert fake_smb.requests.count(0x0e) == queries
+    assert not fake_smb.opens
+
+
+def test_smbpath_listing_cache_disabled(fake_smb):
+    fake_smb.add_file('filerouter_stage', 'static_tests\\a.txt', b'a')
+    p = SMBPath(BASE, find_dfs_share=mock_find_dfs_share)
+    list(p.ls())
+    queries = fake_smb.requests.count(0x0e)
+    list(p.ls())
+    assert fake_smb.requests.count(0x0e) > queries
+    assert path.listingcache.stats()['size'] == 0
+
+
+def delayed(*changes):
+    "Run the changes one after the other in a thread, once watching started"
+    def run():
+        for change in changes:
+            time.sleep(0.05)
+            change()
+    t = threading.Thread(target=run)
+    t.start()
+    return t
+
+
+def test_smbpath_watch(fake_smb, listing_cache):
+    from urlio.smb_ext import ChangeEvent
+    p = SMBPath(BASE, find_dfs_share=mock_find_dfs_share)
+    list(p.ls())
+    assert listing_cache.stats()['size'] == 1
+    delayed(
+        lambda: fake_smb.add_file('filerouter_stage', 'static_tests\\a.txt'),
+        lambda: fake_smb.rename(
+            'filerouter_stage', 'static_tests\\a.txt', 'static_tests\\b.txt'
+        ),
+    )
+    events = []
+    for event in p.watch(timeout=5):
+        events.append(event)
+        if len(events) == 2:
+            break
+    assert events == [
+        ChangeEvent('added', 'a.txt', None),
+        ChangeEvent('renamed', 'b.txt', 'a.txt'),
+    ]
+    assert listing_cache.stats()['size'] == 0
+    assert not fake_smb.opens
+    stats = list(path.POOLS.stats().values())[0]
+    assert stats['in_use'] == 0
+
+
+def test_smbpath_watch_timeout(fake_smb):
+    p = SMBPath(BASE, find_dfs_share=mock_find_dfs_share)
+    start = time.time()
+    assert list(p.watch(timeout=0.1)) == []
+    assert time.time() - start < 1
+    assert not fake_smb.opens
+
+
+def test_smbpath_watch_polling(fake_smb):
+    from urlio.smb_ext import ChangeEvent
+    fake_smb.add_file('filerouter_stage', 'static_tests\\old.txt')
+    fake_smb.add_dir('filerouter_stage', 'static_tests\\sub')
+    p = SMBPath(BASE, find_dfs_share=mock_find_dfs_share)
+
+    def modify():
+        node = fake_smb.get_file('filerouter_stage', 'static_tests\\old.txt')
+        node.data.extend(b'more')
+
+    delayed(
+        lambda: fake_smb.add_file('filerouter_stage', 'static_tests\\sub\\new.txt'),
+        modify,
+        lambda: fake_smb.remove('filerouter_stage', 'static_tests\\old.txt'),
+    )
+    events = list(p.watch(recursive=True, poll=True, interval=0.01, timeout=0.3))
+    assert events == [
+        ChangeEvent('added', 'sub\\new.txt', None),
+        ChangeEvent('modified', 'old.txt', None),
+        ChangeEvent('removed', 'old.txt', None),
+    ]
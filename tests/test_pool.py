@@ -0,0 +1,294 @@
+from __future__ import absolute_import, print_function, unicode_literals
+import threading
+import time
+
+from urlio.pool import ConnectionPool, PoolManager, PoolTimeout
+
+import pytest
+
+
+class DummyConnection(object):
+
+    def __init__(self):
+        self.sock = object()
+        self.pending_requests = {}
+        self.is_busy = False
+        self.echoes = 0
+
+    def echo(self, data, timeout=10):
+        if self.sock is None:
+            raise IOError("Connection closed")
+        self.echoes += 1
+        return data
+
+    def close(self):
+        self.sock = None
+
+
+def counting_factory():
+    made = []
+    def factory():
+        conn = DummyConnection()
+        made.append(conn)
+        return conn
+    factory.made = made
+    return factory
+
+
+def test_pool_reuses_released_connection():
+    factory = counting_factory()
+    pool = ConnectionPool(factory)
+    a = pool.acquire()
+    pool.release(a)
+    b = pool.acquire()
+    assert a is b
+    assert len(factory.made) == 1
+    stats = pool.stats()
+    assert stats['created'] == 1
+    assert stats['reused'] == 1
+    assert stats['in_use'] == 1
+
+
+def test_pool_creates_up_to_max_size():
+    pool = ConnectionPool(counting_factory(), max_size=2, wait_timeout=0.05)
+    a = pool.acquire()
+    b = pool.acquire()
+    assert a is not b
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+    assert pool.stats()['timeouts'] == 1
+
+
+def test_pool_waiter_gets_released_connection():
+    pool = ConnectionPool(counting_factory(), max_size=1, wait_timeout=5)
+    a = pool.acquire()
+    got = []
+    t = threading.Thread(target=lambda: got.append(pool.acquire()))
+    t.start()
+    time.sleep(0.05)
+    pool.release(a)
+    t.join(5)
+    assert got == [a]
+    assert pool.stats()['waits'] >= 1
+
+
+def test_pool_discard_frees_slot():
+    factory = counting_factory()
+    pool = ConnectionPool(factory, max_size=1, wait_timeout=0.05)
+    a = pool.acquire()
+    pool.discard(a)
+    assert a.sock is None
+    b = pool.acquire()
+    assert b is not a
+    assert pool.stats()['discarded'] == 1
+
+
+def test_pool_release_closed_connection_is_discarded():
+    pool = ConnectionPool(counting_factory())
+    a = pool.acquire()
+    a.close()
+    pool.release(a)
+    assert pool.stats()['idle'] == 0
+    assert pool.stats()['size'] == 0
+
+
+def test_pool_idle_eviction_respects_min_size():
+    factory = counting_factory()
+    pool = ConnectionPool(factory, min_size=1, idle_timeout=0.01)
+    a = pool.acquire()
+    b = pool.acquire()
+    pool.release(a)
+    pool.release(b)
+    time.sleep(0.02)
+    pool.acquire()
+    stats = pool.stats()
+    assert stats['evicted'] == 1
+    assert stats['size'] == 1
+    assert a.sock is None
+
+
+def test_pool_fill():
+    factory = counting_factory()
+    pool = ConnectionPool(factory, min_size=3)
+    pool.fill()
+    assert pool.stats()['idle'] == 3
+    assert len(factory.made) == 3
+
+
+def test_pool_retires_connection_after_max_lifetime():
+    factory = counting_factory()
+    pool = ConnectionPool(factory, max_lifetime=0.01)
+    a = pool.acquire()
+    pool.release(a)
+    time.sleep(0.02)
+    b = pool.acquire()
+    assert b is not a
+    assert a.sock is None
+    stats = pool.stats()
+    assert stats['retired'] == 1
+    assert stats['size'] == 1
+
+
+def test_pool_pings_idle_connection_on_checkout():
+    from urlio.path import smb_ping
+    pool = ConnectionPool(counting_factory(), ping=smb_ping, ping_after=0)
+    a = pool.acquire()
+    pool.release(a)
+    assert pool.acquire() is a
+    assert a.echoes == 1
+    assert pool.stats()['pings'] == 1
+
+
+def test_pool_skips_ping_for_recently_used_connection():
+    pool = ConnectionPool(counting_factory(), ping=lambda conn: False, ping_after=60)
+    a = pool.acquire()
+    pool.release(a)
+    assert pool.acquire() is a
+    assert pool.stats()['pings'] == 0
+
+
+def test_pool_discards_connection_failing_ping():
+    def ping(conn):
+        raise IOError("Connection reset by peer")
+    pool = ConnectionPool(counting_factory(), ping=ping, ping_after=0)
+    a = pool.acquire()
+    pool.release(a)
+    b = pool.acquire()
+    assert b is not a
+    assert a.sock is None
+    stats = pool.stats()
+    assert stats['ping_failures'] == 1
+    assert stats['size'] == 1
+
+
+def test_pool_manager_shares_pool_per_key():
+    manager = PoolManager(max_size=3)
+    factory = counting_factory()
+    a = manager.get(('srv', 'filex.com', 'user', False), factory)
+    b = manager.get(('srv', 'filex.com', 'user', False), factory)
+    c = manager.get(('srv', 'filex.com', 'user', True), factory)
+    assert a is b
+    assert a is not c
+    assert a.max_size == 3
+    manager.configure(max_size=5)
+    assert a.max_size == 5
+    assert len(manager.stats()) == 2
+
+
+def test_pool_manager_options_override_defaults():
+    manager = PoolManager(max_size=10, wait_timeout=30)
+    factory = counting_factory()
+    pool = manager.get('key', factory, max_size=1, wait_timeout=0.01)
+    assert pool.max_size == 1
+    assert pool.wait_timeout == 0.01
+    pool.acquire()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+    assert manager.get('other', factory).max_size == 10
+
+
+@pytest.yield_fixture
+def dummy_smb(monkeypatch):
+    from urlio import path, pool
+    factory = counting_factory()
+    monkeypatch.setattr(
+        path, 'get_smb_connection', lambda *args, **kwargs: factory()
+    )
+    monkeypatch.setattr(pool, 'POOLS', PoolManager())
+    monkeypatch.setattr(path, 'POOLS', pool.POOLS)
+    yield factory
+
+
+def mock_find_dfs_share(path, api=None):
+    return ('fxb04fs0301', 'filerouter_stage', 'filex.com', 'foo')
+
+
+def test_smbpath_shares_pooled_connection(dummy_smb):
+    from urlio.path import SMBPath
+    a = SMBPath('\\\\filex.com\\it\\stg\\foo', find_dfs_share=mock_find_dfs_share)
+    b = SMBPath('\\\\filex.com\\it\\stg\\bar', find_dfs_share=mock_find_dfs_share)
+    with a.connection() as conn_a:
+        pass
+    with b.connection() as conn_b:
+        pass
+    assert conn_a is conn_b
+    assert len(dummy_smb.made) == 1
+
+
+def test_smbpath_discards_busy_connection(dummy_smb):
+    from urlio.path import SMBPath
+    a = SMBPath('\\\\filex.com\\it\\stg\\foo', find_dfs_share=mock_find_dfs_share)
+    with a.connection() as conn:
+        conn.pending_requests[1] = None
+    assert conn.sock is None
+    with a.connection() as other:
+        pass
+    assert other is not conn
+
+
+def test_smbpath_discards_connection_with_async_request(dummy_smb):
+    from urlio.path import SMBPath
+    a = SMBPath('\\\\filex.com\\it\\stg\\foo', find_dfs_share=mock_find_dfs_share)
+    with a.connection() as conn:
+        conn.async_requests = {7: None}
+    assert conn.sock is None
+
+
+def test_smbpath_pinned_connection_released_on_close(dummy_smb):
+    from urlio.path import SMBPath
+    a = SMBPath('\\\\filex.com\\it\\stg\\foo', find_dfs_share=mock_find_dfs_share)
+    conn = a.get_connection()
+    with a.connection() as same:
+        assert same is conn
+    a.close()
+    assert a.closed
+    b = SMBPath('\\\\filex.com\\it\\stg\\bar', find_dfs_share=mock_find_dfs_share)
+    with b.connection() as reused:
+        assert reused is conn
+    # Used again after close() it is open again
+    a.get_connection()
+    assert not a.closed
+    a.close()
+    assert a.closed
+
+
+def test_smbpath_del_swallows_errors(dummy_smb):
+    from urlio.path import SMBPath
+
+    class BrokenPool(object):
+        def release(self, conn):
+            raise RuntimeError("pool gone")
+        discard = release
+
+    a = SMBPath('\\\\filex.com\\it\\stg\\foo', find_dfs_share=mock_find_dfs_share)
+    a.get_connection()
+    a._pool = BrokenPool()
+    a.__del__()
+
+
+def test_smbpath_pool_follows_password(dummy_smb, monkeypatch):
+    from urlio import path
+    from urlio.path import SMBPath
+    monkeypatch.setattr(path, 'SMB_PASS', path.SMB_PASS)
+    path.set_smb_password('old')
+    a = SMBPath('\\\\filex.com\\it\\stg\\foo', find_dfs_share=mock_find_dfs_share)
+    with a.connection() as old:
+        pass
+    path.set_smb_password('new')
+    b = SMBPath('\\\\filex.com\\it\\stg\\foo', find_dfs_share=mock_find_dfs_share)
+    with b.connection() as new:
+        pass
+    assert new is not old
+    assert len(path.POOLS.stats()) == 2
+    assert not any('new' in key or 'old' in key for key in path.POOLS.stats())
+
+
+def test_smbpath_pinned_connection_kept_while_open(dummy_smb):
+    from urlio.path import SMBPath
+    a = SMBPath('\\\\filex.com\\it\\stg\\foo', find_dfs_share=mock_find_dfs_share)
+    conn = a.get_connection()
+    assert a.get_connection() is conn
+    conn.close()
+    replacement = a.get_connection()
+    assert replacement is not conn
+    assert len(dummy_smb.made) == 2
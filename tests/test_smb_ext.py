@@ -0,0 +1,338 @@
+from __future__ import absolute_import, print_function, unicode_literals
+import datetime
+import io
+import os
+import threading
+import time
+
+from smb.smb_structs import OperationFailure
+import struct
+
+from smb.base import SharedFile
+from smb.utils import convertFILETIMEtoEpoch
+from urlio.smb_ext import (
+    storeFileFromOffset, retrieveFileFromOffset, BufferReader, openDirectory,
+    _decodeQueryDirectory, ChangeEvent, EntryFilter,
+)
+
+from .fakesmb import FakeSMBServer, FakeSMBConnection, Node, FILETIME
+import pytest
+
+
+def payload(size):
+    return os.urandom(size)
+
+
+def test_store_windowed_writes_in_order():
+    server = FakeSMBServer()
+    conn = FakeSMBConnection(server, max_write_size=1024)
+    data = payload(64 * 1024 + 10)
+    end = storeFileFromOffset(conn, 'share', 'out.bin', io.BytesIO(data), window=8)
+    assert end == len(data)
+    assert bytes(server.get_file('share', 'out.bin').data) == data
+    assert conn.max_in_flight == 8
+    assert not server.opens
+
+
+def test_store_window_bounded_by_credits():
+    server = FakeSMBServer(max_credits=4)
+    conn = FakeSMBConnection(server, max_write_size=1024)
+    data = payload(32 * 1024)
+    storeFileFromOffset(conn, 'share', 'out.bin', io.BytesIO(data), window=16)
+    assert bytes(server.get_file('share', 'out.bin').data) == data
+    assert conn.max_in_flight <= 4
+
+
+def test_store_sequential_window():
+    server = FakeSMBServer()
+    conn = FakeSMBConnection(server, max_write_size=1024)
+    data = payload(8 * 1024)
+    storeFileFromOffset(conn, 'share', 'out.bin', io.BytesIO(data), window=1)
+    assert bytes(server.get_file('share', 'out.bin').data) == data
+    assert conn.max_in_flight == 1
+
+
+def test_store_from_offset():
+    server = FakeSMBServer()
+    server.add_file('share', 'out.bin', b'abc')
+    conn = FakeSMBConnection(server, max_write_size=2)
+    end = storeFileFromOffset(conn, 'share', 'out.bin', io.BytesIO(b'defgh'), offset=3)
+    assert end == 8
+    assert bytes(server.get_file('share', 'out.bin').data) == b'abcdefgh'
+
+
+def test_store_write_error_closes_file():
+    server = FakeSMBServer()
+    server.fail_write_at = 4096
+    conn = FakeSMBConnection(server, max_write_size=1024)
+    with pytest.raises(OperationFailure):
+        storeFileFromOffset(conn, 'share', 'out.bin', io.BytesIO(payload(16 * 1024)))
+    assert not server.opens
+    assert not conn.pending_requests
+
+
+def test_retrieve_windowed_reads_in_order():
+    server = FakeSMBServer()
+    data = payload(100 * 1024 + 7)
+    server.add_file('share', 'dir\\in.bin', data)
+    conn = FakeSMBConnection(server, max_read_size=1024)
+    fp = io.BytesIO()
+    attrs, size = retrieveFileFromOffset(conn, 'share', 'dir\\in.bin', fp, window=8)
+    assert size == len(data)
+    assert fp.getvalue() == data
+    assert conn.max_in_flight == 8
+    assert not server.opens
+
+
+def test_retrieve_offset_and_max_length():
+    server = FakeSMBServer()
+    data = payload(10 * 1024)
+    server.add_file('share', 'in.bin', data)
+    conn = FakeSMBConnection(server, max_read_size=1000)
+    fp = io.BytesIO()
+    _, size = retrieveFileFromOffset(conn, 'share', 'in.bin', fp, offset=1500, max_length=4000)
+    assert size == 4000
+    assert fp.getvalue() == data[1500:5500]
+    fp = io.BytesIO()
+    _, size = retrieveFileFromOffset(conn, 'share', 'in.bin', fp, offset=20000)
+    assert size == 0
+    assert fp.getvalue() == b''
+
+
+def test_retrieve_missing_file():
+    server = FakeSMBServer()
+    conn = FakeSMBConnection(server)
+    with pytest.raises(OperationFailure):
+        retrieveFileFromOffset(conn, 'share', 'missing.bin', io.BytesIO())
+
+
+
+def test_open_directory_query_pages():
+    server = FakeSMBServer()
+    for n in range(50):
+        server.add_file('share', 'dir\\f{:02d}'.format(n))
+    conn = FakeSMBConnection(server)
+    conn.max_transact_size = 1024
+    smbdir = openDirectory(conn, 'share', 'dir')
+    first = smbdir.query(ignore=('.', '..'))
+    assert 0 < len(first) < 50
+    names = [entry.filename for entry in first]
+    entries = smbdir.query()
+    while entries:
+        names.extend(entry.filename for entry in entries)
+        entries = smbdir.query()
+    assert names == ['f{:02d}'.format(n) for n in range(50)]
+    assert smbdir.done
+    again = smbdir.query(restart=True, ignore=('.', '..'))
+    assert [entry.filename for entry in again] == names[:len(again)]
+    smbdir.close()
+    assert not server.opens
+
+
+def test_directory_notify():
+    server = FakeSMBServer()
+    server.add_dir('share', 'dir')
+    conn = FakeSMBConnection(server)
+    smbdir = openDirectory(conn, 'share', 'dir')
+    assert smbdir.notify(timeout=0.01) == []
+    server.add_file('share', 'dir\\a.txt')
+    assert smbdir.notify(timeout=1) == [ChangeEvent('added', 'a.txt', None)]
+    # Changes made while no request is in flight are kept by the server
+    server.rename('share', 'dir\\a.txt', 'dir\\b.txt')
+    server.remove('share', 'dir\\b.txt')
+    assert smbdir.notify(timeout=1) == [
+        ChangeEvent('renamed', 'b.txt', 'a.txt'),
+        ChangeEvent('removed', 'b.txt', None),
+    ]
+    threading.Timer(0.05, server.add_file, ('share', 'dir\\c.txt')).start()
+    assert smbdir.notify(timeout=5) == [ChangeEvent('added', 'c.txt', None)]
+    assert server.requests.count(0x0f) == 3
+    assert smbdir.notify(timeout=0.01) == []
+    smbdir.close()
+    assert not server.opens
+    assert not conn.pending_requests
+    assert not conn.async_requests
+
+
+def test_directory_close_drops_notify():
+    server = FakeSMBServer()
+    server.add_dir('share', 'dir')
+    conn = FakeSMBConnection(server)
+    smbdir = openDirectory(conn, 'share', 'dir')
+    assert smbdir.notify(timeout=0.01) == []
+    assert conn.async_requests
+    # A server that never sends STATUS_NOTIFY_CLEANUP
+    for handle in server.opens.values():
+        handle.watch = None
+    smbdir.close()
+    assert not conn.pending_requests
+    assert not conn.async_requests
+
+
+def test_directory_notify_recursive_and_overflow():
+    server = FakeSMBServer()
+    server.add_dir('share', 'dir\\sub')
+    conn = FakeSMBConnection(server)
+    conn.max_transact_size = 256
+    smbdir = openDirectory(conn, 'share', 'dir')
+    smbdir.notify(recursive=True, timeout=0.01)
+    server.add_file('share', 'dir\\sub\\x.txt')
+    assert smbdir.notify(timeout=1) == [
+        ChangeEvent('added', 'sub\\x.txt', None)
+    ]
+    for n in range(20):
+        server.add_file('share', 'dir\\f{:02d}.txt'.format(n))
+    assert smbdir.notify(timeout=1) == [ChangeEvent('overflow', None, None)]
+    smbdir.close()
+    assert not server.opens
+
+
+def test_retrieve_window_overlaps_reads():
+    size = 4 * 1024 * 1024
+    data = payload(size)
+    for window in (1, 4, 16):
+        server = FakeSMBServer()
+        server.add_file('share', 'in.bin', data)
+        conn = FakeSMBConnection(server)
+        fp = io.BytesIO()
+        retrieveFileFromOffset(conn, 'share', 'in.bin', fp, window=window)
+        assert fp.getvalue() == data
+        # Overlapped, not repeated
+        assert conn.max_in_flight == window
+        assert server.requests.count(0x08) == size // conn.max_read_size
+
+
+def test_store_window_overlaps_writes():
+    size = 4 * 1024 * 1024
+    data = payload(size)
+    for window in (1, 4, 16):
+        server = FakeSMBServer()
+        conn = FakeSMBConnection(server)
+        storeFileFromOffset(conn, 'share', 'out.bin', io.BytesIO(data), window=window)
+        assert bytes(server.get_file('share', 'out.bin').data) == data
+        assert conn.max_in_flight == window
+        assert server.requests.count(0x09) == size // conn.max_write_size
+
+
+def test_store_from_buffer_reader():
+    server = FakeSMBServer()
+    conn = FakeSMBConnection(server, max_write_size=1000)
+    data = payload(5000)
+    end = storeFileFromOffset(conn, 'share', 'out.bin', BufferReader(memoryview(data)))
+    assert end == len(data)
+    assert bytes(server.get_file('share', 'out.bin').data) == data
+
+
+def directory_info(count):
+    """
+    QUERY_DIRECTORY response data holding count FileBothDirectoryInformation
+    entries.
+    """
+    return encode_entries(Node('file{:05d}.edi'.format(n)) for n in range(count))
+
+
+def encode_entries(nodes):
+    entries = []
+    for node in nodes:
+        entry = FakeSMBServer._both_directory_info(node)
+        entry += b'\0' * ((8 - len(entry) % 8) % 8)
+        entries.append(entry)
+    body = b''
+    for n, entry in enumerate(entries):
+        next_offset = len(entry) if n < len(entries) - 1 else 0
+        body += struct.pack('<I', next_offset) + entry[4:]
+    return body
+
+
+def eager_decode(data_bytes, ignore=()):
+    # The decoder _listPath_SMB2 used to have, for the benchmark.
+    info_format = '<IIQQQQQQIIIBB24s'
+    info_size = struct.calcsize(info_format)
+    entries = []
+    offset = 0
+    while offset < len(data_bytes):
+        next_offset, _, create_time, last_access_time, last_write_time, \
+            last_attr_change_time, file_size, alloc_size, file_attributes, \
+            filename_length, _, _, _, short_name = struct.unpack(
+                info_format, data_bytes[offset:offset + info_size])
+        offset2 = offset + info_size
+        filename = data_bytes[offset2:offset2 + filename_length].decode('UTF-16LE')
+        if filename not in ignore:
+            entries.append(SharedFile(
+                convertFILETIMEtoEpoch(create_time), convertFILETIMEtoEpoch(last_access_time),
+                convertFILETIMEtoEpoch(last_write_time), convertFILETIMEtoEpoch(last_attr_change_time),
+                file_size, alloc_size, file_attributes, short_name.decode('UTF-16LE'), filename))
+        if not next_offset:
+            break
+        offset += next_offset
+    return entries
+
+
+def test_decode_query_directory():
+    data = directory_info(20)
+    entries, leftover = _decodeQueryDirectory(data, ignore=('file00003.edi',))
+    expected = eager_decode(data, ignore=('file00003.edi',))
+    assert leftover == b''
+    assert len(entries) == 19
+    for entry, other in zip(entries, expected):
+        assert entry.filename == other.filename
+        assert entry.file_size == other.file_size
+        assert not entry.isDirectory
+        assert entry.last_write_time == other.last_write_time
+        assert entry.create_time == other.create_time
+        assert entry.short_name == other.short_name
+
+
+def test_decode_query_directory_leftover():
+    data = directory_info(3)
+    entries, leftover = _decodeQueryDirectory(data[:-30])
+    assert len(entries) == 2
+    assert isinstance(leftover, bytes)
+    more, rest = _decodeQueryDirectory(leftover + data[-30:])
+    assert [entry.filename for entry in more] == ['file00002.edi']
+    assert rest == b''
+
+
+def test_decode_query_directory_where():
+    nodes = [Node('dir', is_dir=True)]
+    for n in range(6):
+        node = Node('f{}.edi'.format(n), data=b'x' * n)
+        node.mtime = FILETIME + n * 86400 * 10 ** 7
+        nodes.append(node)
+    # 2018-01-03 12:00:00 UTC
+    where = EntryFilter(min_size=1, max_size=4, mtime_before=1514980800)
+    entries, _ = _decodeQueryDirectory(encode_entries(nodes), where=where)
+    # Directories are always kept
+    assert [entry.filename for entry in entries] == ['dir', 'f1.edi', 'f2.edi']
+    assert where.match(entries[1])
+    assert not where.match(entries[0])
+
+
+def test_entry_filter_match():
+    # pysmb's and SMB1 entries hold epoch timestamps
+    entry = SharedFile(1514764800.0, 0, 1514764800.0, 0, 10, 10, 0x20, '', 'a.edi')
+    assert EntryFilter(mtime_before=1514764801).match(entry)
+    assert not EntryFilter(mtime_before=1514764800).match(entry)
+    assert EntryFilter(mtime_after=datetime.datetime(2018, 1, 1)).match(entry)
+    assert not EntryFilter(ctime_after=datetime.datetime(2018, 1, 1, 0, 0, 1)).match(entry)
+    assert EntryFilter(attributes=0x20, min_size=10).match(entry)
+    assert not EntryFilter(exclude_attributes=0x20).match(entry)
+    assert not EntryFilter(max_size=9).match(entry)
+
+
+@pytest.mark.skipif(not pytest.config.getvalue('benchmark'), reason='--benchmark was not specifified')
+def test_decode_query_directory_benchmark():
+    # As many entries as fit a 64 KB response
+    data = directory_info(64 * 1024 // len(directory_info(1)))
+    rounds = 200
+    start = time.time()
+    for _ in range(rounds):
+        eager_decode(data)
+    eager = time.time() - start
+    start = time.time()
+    for _ in range(rounds):
+        _decodeQueryDirectory(data)
+    lazy = time.time() - start
+    entries = len(eager_decode(data)) * rounds
+    print('eager {:.0f} entries/s, lazy {:.0f} entries/s'.format(
+        entries / eager, entries / lazy))
@@ -0,0 +1,499 @@
+from __future__ import absolute_import, print_function, unicode_literals
+import calendar
+import datetime
+import threading
+import time
+
+from smb.smb_constants import ATTR_ARCHIVE
+from urlio.path import SMBPath, EntryFilter
+from urlio.walk import ParallelWalker
+
+from .fixtures import fake_smb
+from .test_path import BASE, mock_find_dfs_share, listing_cache
+import pytest
+
+
+class Node(object):
+    "Directory stand in which counts concurrent listings"
+
+    active = 0
+    most_active = 0
+    lock = threading.Lock()
+
+    def __init__(self, name, children=(), files=(), delay=0, fail=False):
+        self.name = name
+        self.children = list(children)
+        self.files = list(files)
+        self.delay = delay
+        self.fail = fail
+
+    def __repr__(self):
+        return self.name
+
+    def _walk(self):
+        with Node.lock:
+            Node.active += 1
+            Node.most_active = max(Node.most_active, Node.active)
+        try:
+            time.sleep(self.delay)
+            if self.fail:
+                raise IOError("Listing {} failed".format(self.name))
+            return list(self.children), list(self.files)
+        finally:
+            with Node.lock:
+                Node.active -= 1
+
+    def walk(self, top_down=False):
+        # Reference sequential walk, same shape as SMBPath.walk()
+        dirs, files = self._walk()
+        if top_down:
+            for x in dirs:
+                for _ in x.walk(top_down=top_down):
+                    yield _
+        yield self, dirs, files
+        if top_down:
+            return
+        for x in dirs:
+            for _ in x.walk(top_down=top_down):
+                yield _
+
+
+def tree(depth=3, width=3, name='root', delay=0):
+    children = []
+    if depth:
+        children = [
+            tree(depth - 1, width, '{}/{}'.format(name, n), delay)
+            for n in range(width)
+        ]
+    return Node(name, children, ['{}/file'.format(name)], delay=delay)
+
+
+@pytest.mark.parametrize('top_down', [False, True])
+def test_parallel_walk_ordered_matches_sequential(top_down):
+    root = tree()
+    expected = [
+        (d.name, [c.name for c in dirs], files)
+        for d, dirs, files in root.walk(top_down=top_down)
+    ]
+    got = [
+        (d.name, [c.name for c in dirs], files)
+        for d, dirs, files in ParallelWalker(root, workers=4, top_down=top_down)
+    ]
+    assert got == expected
+
+
+def test_parallel_walk_unordered_yields_every_directory():
+    root = tree()
+    expected = set(d.name for d, _, _ in root.walk())
+    got = [d.name for d, _, _ in ParallelWalker(root, workers=4, ordered=False)]
+    assert len(got) == len(expected)
+    assert set(got) == expected
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_parallel_walk_bounds_pending_listings(ordered):
+    Node.most_active = 0
+    root = tree(depth=2, width=8, delay=0.005)
+    walker = ParallelWalker(root, workers=8, ordered=ordered, max_pending=3)
+    assert len(list(walker)) == 1 + 8 + 64
+    assert 1 < Node.most_active <= 4
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_parallel_walk_bounds_frontier(ordered):
+    import gc
+    from urlio.walk import _Listing
+    root = tree(depth=2, width=30)
+    walker = ParallelWalker(root, workers=4, ordered=ordered, max_pending=4)
+    count = 0
+    for count, _ in enumerate(walker, 1):
+        if count % 50 == 0:
+            live = sum(isinstance(o, _Listing) for o in gc.get_objects())
+            assert live <= 10
+    assert count == 1 + 30 + 900
+
+
+def test_parallel_walk_is_faster_than_sequential():
+    root = tree(depth=2, width=6, delay=0.01)
+    start = time.time()
+    list(root.walk())
+    sequential = time.time() - start
+    start = time.time()
+    list(ParallelWalker(root, workers=8))
+    assert (time.time() - start) * 2 < sequential
+
+
+def test_parallel_walk_raises_listing_error():
+    root = Node('root', [Node('root/a'), Node('root/b', fail=True)])
+    walker = iter(ParallelWalker(root, workers=2))
+    assert next(walker)[0] is root
+    assert next(walker)[0].name == 'root/a'
+    with pytest.raises(IOError):
+        next(walker)
+
+
+@pytest.yield_fixture
+def smb_tree(fake_smb):
+    for d in ('tree', 'tree\\a', 'tree\\a\\b', 'tree\\c'):
+        fake_smb.add_dir('filerouter_stage', 'static_tests\\' + d)
+        for name in ('x.txt', 'y.txt'):
+            fake_smb.add_file(
+                'filerouter_stage', 'static_tests\\{}\\{}'.format(d, name), b'x'
+            )
+    yield SMBPath(BASE + '\\tree', find_dfs_share=mock_find_dfs_share)
+
+
+TREE = [
+    'tree\\a',
+    'tree\\a\\b',
+    'tree\\a\\b\\x.txt',
+    'tree\\a\\b\\y.txt',
+    'tree\\a\\x.txt',
+    'tree\\a\\y.txt',
+    'tree\\c',
+    'tree\\c\\x.txt',
+    'tree\\c\\y.txt',
+    'tree\\x.txt',
+    'tree\\y.txt',
+]
+
+
+def relnames(paths):
+    return [p.path[len(BASE) + 1:] for p in paths]
+
+
+def test_smbpath_parallel_walk(smb_tree):
+    top = smb_tree
+
+    def names(walk):
+        return [
+            (d.path, sorted(a.path for a in dirs), sorted(a.path for a in files))
+            for d, dirs, files in walk
+        ]
+
+    expected = names(top.walk())
+    assert len(expected) == 4
+    assert names(top.walk(workers=4)) == expected
+    assert sorted(names(top.walk(workers=4, ordered=False))) == sorted(expected)
+
+
+def test_smbpath_parallel_walk_sizes_pool(smb_tree, fake_smb, monkeypatch):
+    from urlio import path, pool
+    monkeypatch.setattr(pool, 'POOLS', pool.PoolManager(max_size=2, wait_timeout=0.05))
+    monkeypatch.setattr(path, 'POOLS', pool.POOLS)
+    connect = path.get_smb_connection
+
+    def slow_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.rtt = 0.1
+        return conn
+    monkeypatch.setattr(path, 'get_smb_connection', slow_connect)
+    for n in range(8):
+        fake_smb.add_dir('filerouter_stage', 'static_tests\\tree\\w{}'.format(n))
+    # One connection pinned on top of the ones the workers check out
+    smb_tree.get_connection()
+    try:
+        walked = list(smb_tree.walk(workers=6, ordered=False))
+    finally:
+        smb_tree.close()
+    assert len(walked) == 4 + 8
+    assert max(p.max_size for p in pool.POOLS._pools.values()) >= 7
+    # Only the pool of the transport in use is grown
+    assert len(pool.POOLS._pools) == 1
+    smb_tree._is_direct_tcp = None
+    assert len(list(smb_tree.walk(workers=6, ordered=False))) == 4 + 8
+    assert len(pool.POOLS._pools) == 1
+
+
+def test_smbpath_walk_max_depth(smb_tree):
+    assert relnames(d for d, _, _ in smb_tree.walk()) == [
+        'tree', 'tree\\a', 'tree\\a\\b', 'tree\\c',
+    ]
+    assert relnames(d for d, _, _ in smb_tree.walk(top_down=True)) == [
+        'tree\\a\\b', 'tree\\a', 'tree\\c', 'tree',
+    ]
+    assert relnames(d for d, _, _ in smb_tree.walk(max_depth=0)) == ['tree']
+    assert relnames(d for d, _, _ in smb_tree.walk(max_depth=1)) == [
+        'tree', 'tree\\a', 'tree\\c',
+    ]
+    assert relnames(
+        d for d, _, _ in smb_tree.walk(max_depth=1, workers=2)
+    ) == ['tree', 'tree\\a', 'tree\\c']
+
+
+def test_smbpath_walk_deep_tree_is_not_recursive(fake_smb):
+    import sys
+    depth = 300
+    key = 'static_tests'
+    for n in range(depth):
+        key += '\\d'
+        fake_smb.add_dir('filerouter_stage', key)
+    top = SMBPath(BASE + '\\d', find_dfs_share=mock_find_dfs_share)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(250)
+    try:
+        walked = len(list(top.walk()))
+        listed = len(list(top.ls(recurse=True)))
+    finally:
+        sys.setrecursionlimit(limit)
+    assert walked == depth
+    assert listed == depth - 1
+
+
+def test_smbpath_ls_recurse_order(smb_tree):
+    assert relnames(smb_tree.ls(recurse=True)) == TREE
+    assert relnames(smb_tree.ls(recurse=True, offset=2, limit=3)) == TREE[2:5]
+    assert relnames(smb_tree.files(recurse=True)) == [
+        a for a in TREE if a.endswith('.txt')
+    ]
+    assert relnames(smb_tree.ls(recurse=True, max_depth=0)) == [
+        'tree\\a', 'tree\\c', 'tree\\x.txt', 'tree\\y.txt',
+    ]
+
+
+def test_smbpath_ls_recurse_bounded_frontier(smb_tree, fake_smb):
+    opens = fake_smb.requests.count(0x05)
+    assert relnames(smb_tree.ls(recurse=True)) == TREE
+    unbounded = fake_smb.requests.count(0x05) - opens
+    opens = fake_smb.requests.count(0x05)
+    assert relnames(smb_tree.ls(recurse=True, max_frontier=1)) == TREE
+    # Directories are held open rather than listed again
+    assert fake_smb.requests.count(0x05) - opens == unbounded
+    assert not fake_smb.opens
+
+
+def test_smbpath_ls_recurse_bounded_frontier_wide(fake_smb, monkeypatch):
+    from urlio import path
+    connect = path.get_smb_connection
+
+    def small_responses(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.max_transact_size = 1024
+        return conn
+    monkeypatch.setattr(path, 'get_smb_connection', small_responses)
+    for n in range(300):
+        fake_smb.add_file(
+            'filerouter_stage', 'static_tests\\wide\\d{:03d}\\x.txt'.format(n)
+        )
+    top = SMBPath(BASE + '\\wide', find_dfs_share=mock_find_dfs_share)
+    expected = relnames(top.ls(recurse=True))
+    assert len(expected) == 600
+    opens = fake_smb.requests.count(0x05)
+    queries = fake_smb.requests.count(0x0e)
+    assert relnames(top.ls(recurse=True, max_frontier=10)) == expected
+    # Every directory is opened and read through once
+    assert fake_smb.requests.count(0x05) - opens == 301
+    assert fake_smb.requests.count(0x0e) - queries < 2 * 301 + 50
+    assert not fake_smb.opens
+    assert all(a['in_use'] == 0 for a in path.POOLS.stats().values())
+    # Stopping half way closes the directories held open
+    listing = top.ls(recurse=True, max_frontier=10)
+    assert len([next(listing) for _ in range(100)]) == 100
+    assert fake_smb.opens
+    listing.close()
+    assert not fake_smb.opens
+    assert all(a['in_use'] == 0 for a in path.POOLS.stats().values())
+
+
+def test_smbpath_ls_recurse_streams_listing(fake_smb, monkeypatch):
+    from urlio import path
+    connect = path.get_smb_connection
+
+    def small_responses(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.max_transact_size = 1024
+        return conn
+    monkeypatch.setattr(path, 'get_smb_connection', small_responses)
+    for n in range(300):
+        fake_smb.add_file(
+            'filerouter_stage', 'static_tests\\wide\\f{:03d}.txt'.format(n)
+        )
+    top = SMBPath(BASE + '\\wide', find_dfs_share=mock_find_dfs_share)
+    queries = fake_smb.requests.count(0x0e)
+    listing = top.ls(recurse=True)
+    next(listing)
+    # Only the first response was read
+    assert fake_smb.requests.count(0x0e) - queries == 1
+    assert len(list(listing)) == 299
+    assert fake_smb.requests.count(0x0e) - queries > 2
+    assert not fake_smb.opens
+
+
+def test_smbpath_ls_streams_entries(fake_smb):
+    from urlio.smb_ext import iter_listPath
+    from .fakesmb import FakeSMBConnection
+    for n in range(200):
+        fake_smb.add_file(
+            'filerouter_stage', 'static_tests\\f{:03d}.txt'.format(n)
+        )
+    conn = FakeSMBConnection(fake_smb)
+    conn.max_transact_size = 1024
+    listing = iter_listPath(conn, 'filerouter_stage', 'static_tests')
+    assert next(listing).filename == '.'
+    queries = fake_smb.requests.count(0x0e)
+    assert conn.is_busy
+    names = [entry.filename for entry in listing]
+    assert len(names) == 201
+    assert fake_smb.requests.count(0x0e) > queries
+
+
+def test_smbpath_ls_entries(smb_tree, fake_smb):
+    from urlio.path import DirEntry
+    assert all(isinstance(a, SMBPath) for a in smb_tree.ls(recurse=True))
+    listed = list(smb_tree.ls(entries=True))
+    assert all(isinstance(a, DirEntry) for a in listed)
+    assert not hasattr(listed[0], '__dict__')
+    assert relnames(listed) == [
+        'tree\\a', 'tree\\c', 'tree\\x.txt', 'tree\\y.txt',
+    ]
+    assert [a.isdir() for a in listed] == [True, True, False, False]
+    entry = listed[2]
+    assert entry.name == 'x.txt'
+    assert entry.size == 1
+    expected = smb_tree.join('x.txt')
+    assert entry.mtime == expected.mtime
+    assert entry.stat() == expected.stat()
+    # Upgrading doesn't ask the server for the attributes again
+    requests = len(fake_smb.requests)
+    p = entry.smbpath()
+    assert p.path == entry.path
+    assert p.size == 1 and p.mtime == entry.mtime and not p.isdir()
+    assert len(fake_smb.requests) == requests
+    assert relnames(smb_tree.ls(recurse=True, entries=True)) == TREE
+    assert relnames(smb_tree.files(recurse=True)) == relnames(
+        a for a in smb_tree.ls(recurse=True, entries=True) if a.isfile()
+    )
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_smbpath_walk_entries(smb_tree, workers):
+    from urlio.path import DirEntry
+
+    def names(walk):
+        return [
+            (d.path, [a.path for a in dirs], [a.path for a in files])
+            for d, dirs, files in walk
+        ]
+
+    walked = list(smb_tree.walk(entries=True, workers=workers))
+    assert names(walked) == names(smb_tree.walk())
+    assert walked[0][0] is smb_tree
+    for d, dirs, files in walked[1:]:
+        assert isinstance(d, DirEntry)
+        assert all(isinstance(a, DirEntry) for a in dirs + files)
+
+
+def test_smbpath_ls_recursive_glob_descends(smb_tree, fake_smb):
+    # Directories are traversed even though their names don't match
+    assert relnames(smb_tree.ls('x.*', recurse=True)) == [
+        a for a in TREE if a.endswith('x.txt')
+    ]
+    assert relnames(smb_tree.ls('**/b/*', recurse=True)) == [
+        'tree\\a\\b\\x.txt', 'tree\\a\\b\\y.txt',
+    ]
+    assert relnames(smb_tree.ls('a/*', recurse=True)) == [
+        'tree\\a\\b', 'tree\\a\\x.txt', 'tree\\a\\y.txt',
+    ]
+    # Nothing below c can match, it isn't listed
+    del fake_smb.patterns[:]
+    assert relnames(smb_tree.files('a/**/y.txt', recurse=True)) == [
+        'tree\\a\\b\\y.txt', 'tree\\a\\y.txt',
+    ]
+    assert [key for key, _ in fake_smb.patterns] == [
+        'static_tests\\tree', 'static_tests\\tree\\a', 'static_tests\\tree\\a\\b',
+    ]
+
+
+def test_smbpath_ls_glob_pushdown(smb_tree, fake_smb):
+    del fake_smb.patterns[:]
+    assert relnames(smb_tree.ls('a/b/x.*', recurse=True)) == ['tree\\a\\b\\x.txt']
+    assert fake_smb.patterns == [
+        ('static_tests\\tree', '*'),
+        ('static_tests\\tree\\a', '*'),
+        ('static_tests\\tree\\a\\b', 'x.*'),
+    ]
+    del fake_smb.patterns[:]
+    assert relnames(smb_tree.ls('*.txt', recurse=True, max_depth=0)) == [
+        'tree\\x.txt', 'tree\\y.txt',
+    ]
+    assert relnames(smb_tree.ls('x.*')) == ['tree\\x.txt']
+    assert [pattern for _, pattern in fake_smb.patterns] == ['*.txt', 'x.*']
+
+
+def test_smbpath_ls_multiple_patterns(smb_tree, fake_smb):
+    del fake_smb.patterns[:]
+    assert relnames(smb_tree.ls(['x.*', '{a,c}'])) == [
+        'tree\\a', 'tree\\c', 'tree\\x.txt',
+    ]
+    assert relnames(smb_tree.ls('*', exclude=['y.*', 'c'])) == [
+        'tree\\a', 'tree\\x.txt',
+    ]
+    assert relnames(smb_tree.files(recurse=True, exclude='a')) == [
+        'tree\\c\\x.txt', 'tree\\c\\y.txt', 'tree\\x.txt', 'tree\\y.txt',
+    ]
+    assert relnames(smb_tree.ls('*.{txt,edi}', recurse=True, exclude='**/y.txt')) == [
+        a for a in TREE if a.endswith('x.txt')
+    ]
+
+
+@pytest.yield_fixture
+def aged_tree(smb_tree, fake_smb):
+    "smb_tree with large y.txt files and a directory c ten days older"
+    ten_days = 10 * 86400 * 10 ** 7
+    for d in ('tree', 'tree\\a', 'tree\\a\\b', 'tree\\c'):
+        node = fake_smb.get_file(
+            'filerouter_stage', 'static_tests\\{}\\y.txt'.format(d)
+        )
+        node.data = bytearray(b'y' * 100)
+        node.mtime -= ten_days
+    fake_smb.get_file('filerouter_stage', 'static_tests\\tree\\c').mtime -= ten_days
+    yield smb_tree
+
+
+OLD = EntryFilter(mtime_before=datetime.datetime(2017, 12, 25))
+
+
+def test_smbpath_ls_where(aged_tree):
+    assert relnames(aged_tree.ls(where=OLD)) == ['tree\\c', 'tree\\y.txt']
+    assert relnames(aged_tree.files(where=OLD)) == ['tree\\y.txt']
+    large = EntryFilter(min_size=100)
+    assert relnames(aged_tree.files(recurse=True, where=large)) == [
+        a for a in TREE if a.endswith('y.txt')
+    ]
+    # Directories that don't match are still descended into
+    assert relnames(aged_tree.ls(recurse=True, where=OLD)) == [
+        'tree\\a\\b\\y.txt', 'tree\\a\\y.txt', 'tree\\c', 'tree\\c\\y.txt',
+        'tree\\y.txt',
+    ]
+    assert relnames(aged_tree.ls('*.txt', exclude='y*', where=large)) == []
+    assert relnames(aged_tree.ls(entries=True, where=EntryFilter(
+        exclude_attributes=ATTR_ARCHIVE))) == ['tree\\a', 'tree\\c']
+    assert relnames(aged_tree.ls(where=EntryFilter(
+        mtime_after=calendar.timegm((2017, 12, 30, 0, 0, 0)),
+        max_size=1,
+    ))) == ['tree\\a', 'tree\\x.txt']
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_smbpath_walk_where(aged_tree, workers):
+    walked = [
+        (d.path[len(BASE) + 1:], relnames(dirs), relnames(files))
+        for d, dirs, files in aged_tree.walk(where=OLD, workers=workers)
+    ]
+    # Only the files are filtered
+    assert walked == [
+        ('tree', ['tree\\a', 'tree\\c'], ['tree\\y.txt']),
+        ('tree\\a', ['tree\\a\\b'], ['tree\\a\\y.txt']),
+        ('tree\\a\\b', [], ['tree\\a\\b\\y.txt']),
+        ('tree\\c', [], ['tree\\c\\y.txt']),
+    ]
+
+
+def test_smbpath_ls_where_cached(aged_tree, fake_smb, listing_cache):
+    assert relnames(aged_tree.ls(where=OLD)) == ['tree\\c', 'tree\\y.txt']
+    # Filtered listings aren't cached, full ones are filtered when served
+    assert listing_cache.stats()['size'] == 0
+    assert len(relnames(aged_tree.ls())) == 4
+    requests = len(fake_smb.requests)
+    assert relnames(aged_tree.ls(where=OLD)) == ['tree\\c', 'tree\\y.txt']
+    assert len(fake_smb.requests) == requests
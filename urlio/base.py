@@ -383,6 +383,12 @@ class BasicIO(object):
     #tell
     #writable
     #writelines
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def seek(self, index):
         raise NotImplementedError()
 
@@ -1,16 +1,20 @@
+import collections
+import contextlib
 import datetime
 import io
 import logging
+import mmap
 import multiprocessing
 import os
 import json
 import socket
+import struct
 import time
 import tempfile
+import threading
 import requests
 
 from smb.SMBConnection import SMBConnection
-import repoze.lru
 
 from .base import UrlIOException
 from .smb_ext import getDfsReferral
@@ -24,6 +28,12 @@ DFSCACHE = {}
 DFSCACHE_PATH = '/tmp/traxcommon.dfscache.json'
 AUTO_UPDATE_DFSCACHE = True
 DFS_REF_API = "http://dfs-reference-service.s03.filex.com/cache"
+# Seconds between refreshes of the dfs cache by the background thread
+REFRESH_INTERVAL = 300
+# Seconds to wait on the dfs reference service, and the size of the chunks
+# the cache is streamed to disk in
+FETCH_TIMEOUT = 60
+FETCH_CHUNK_SIZE = 64 * 1024
 
 def lookupdcs(domain):
     import dns.resolver
@@ -242,59 +252,275 @@ class FindDfsShare(Exception):
     "Raised when dfs share is not mapped"
 
 
+_http_session = None
+
+
+def http_session():
+    """
+    The requests session dfs caches are fetched with, so refreshes reuse a
+    pooled connection. Each process gets its own session.
+    """
+    global _http_session
+    if _http_session is None or _http_session[1] != os.getpid():
+        _http_session = requests.Session(), os.getpid()
+    return _http_session[0]
+
+
+def fetch_meta_path(path):
+    return path + '.meta'
+
+
+def fetch_validators(path):
+    "Conditional request headers for the copy of the cache at path"
+    try:
+        with io.open(fetch_meta_path(path), 'r') as f:
+            meta = json.loads(f.read())
+    except (IOError, OSError, ValueError):
+        return {}
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
+
+def save_fetch_validators(path, headers):
+    "Keep the ETag and Last-Modified of the cache written to path"
+    meta = {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+    }
+    try:
+        with io.open(fetch_meta_path(path), 'wb') as f:
+            f.write(json.dumps(meta).encode('utf-8'))
+    except (IOError, OSError):
+        log.exception("Exception saving dfs cache validators")
+
+
 class DfsCache(dict):
     """
     A local copy of the cache file from a dfs reference service instance
         https://github.com/TraxTechnologies/dfs_reference_service
+
+    Lookups go through indexes, a DfsIndex per '\\\\domain'. load() builds
+    new indexes and swaps them in with a single assignment, so a lookup
+    sees either the old or the new cache, never a mix of both. A daemon
+    thread started by start_refresher() keeps the cache up to date away
+    from the lookups.
+
+    When the cache was loaded from its compiled copy the domains are only
+    added to the dict by the first lookup of a key it doesn't hold, with
+    [], get() or in.
     """
     def __init__(self, *args, **opts):
         super(DfsCache, self).__init__(*args, **opts)
         self.fetch_event = multiprocessing.Event()
         self.last_update = datetime.datetime(1970, 1, 1)
+        self.indexes = self._build_indexes(self)
+        # The indexes of a compiled copy whose domains aren't in the dict
+        self._compiled = None
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._refresher_lock = threading.Lock()
+
+    def __missing__(self, key):
+        if self._materialize():
+            return self[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return (
+            super(DfsCache, self).__contains__(key) or
+            self._materialize() and super(DfsCache, self).__contains__(key)
+        )
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def _materialize(self):
+        """
+        Add the domains of the compiled copy the cache was loaded from to
+        the dict. Returns False when there was nothing to add.
+        """
+        with self._lock:
+            indexes, self._compiled = self._compiled, None
+            if indexes is None:
+                return False
+            for index in indexes.values():
+                self[index.name] = index.domain_cache()
+            return True
+
+    @staticmethod
+    def _build_indexes(data):
+        return dict(
+            (domain.lower(), DfsIndex.from_domain_cache(data[domain]))
+            for domain in data if isinstance(data[domain], dict)
+        )
 
     def load(self, path=DFSCACHE_PATH):
+        """
+        Load the cache from the compiled copy next to path, or from path
+        itself when the compiled copy is missing, corrupt or was made from
+        another version of path, writing a new compiled copy. The JSON
+        document is only kept in this dict when it had to be parsed,
+        otherwise the dict holds the cache's timestamp until a domain is
+        looked up in it.
+        """
+        fetched = None
         if not os.path.exists(path):
-            self.fetch(path)
-        if os.path.exists(path):
-            with io.open(path, 'r') as f:
-                self.update(json.loads(f.read()))
-            cache_time = datetime.datetime.utcfromtimestamp(
-                int(str(DFSCACHE['timestamp'])[:-3])
+            fetched = self._fetch(path)
+        if fetched is not None:
+            self._load(path, *fetched)
+        elif os.path.exists(path):
+            self._load(path)
+
+    def _load(self, path, data=None, source=None):
+        # data is the document just fetched to path, source the os.stat()
+        # of the file it was written to
+        compiled = compiled_cache_path(path)
+        if data is None:
+            source = os.stat(path)
+            loaded = load_compiled_cache(compiled, source)
+            if loaded is None:
+                with io.open(path, 'r') as f:
+                    data = json.loads(f.read())
+        if data is not None:
+            write_compiled_cache(compiled, data, source)
+            indexes, timestamp = self._build_indexes(data), data['timestamp']
+            lazy = None
+        else:
+            indexes, timestamp = loaded
+            data = {'timestamp': timestamp}
+            lazy = indexes
+        # Nothing from the previous cache is left in the dict
+        with self._lock:
+            self.indexes = indexes
+            self.clear()
+            self.update(data)
+            self._compiled = lazy
+        self.timestamp = timestamp
+        cache_time = datetime.datetime.utcfromtimestamp(
+            int(str(timestamp)[:-3])
+        )
+        dlt = datetime.datetime.utcnow() - datetime.timedelta(minutes=20)
+        if cache_time < dlt:
+            log.warn("Dfs cache timestamp is more than 20 minutes old")
+
+    def refresh(self, path=DFSCACHE_PATH, uri=DFS_REF_API):
+        """
+        Fetch the cache and load it if a new copy was written, from the
+        document parsed when it was checked.
+        """
+        fetched = self._fetch(path, uri)
+        if fetched is not None:
+            self._load(path, *fetched)
+
+    def start_refresher(self, interval=REFRESH_INTERVAL, path=DFSCACHE_PATH):
+        """
+        Refresh the cache from a daemon thread once it is interval seconds
+        old. Nothing is done while the thread runs, a process forked from
+        one with a refresher starts its own.
+        """
+        with self._refresher_lock:
+            if self._refresher is not None:
+                thread, stop, pid = self._refresher
+                if pid == os.getpid() and thread.is_alive() and not stop.is_set():
+                    return
+            stop = threading.Event()
+            thread = threading.Thread(
+                target=self._refresh_loop, args=(interval, path, stop),
+                name='urlio-dfs-refresh',
             )
-            dlt = datetime.datetime.utcnow() - datetime.timedelta(minutes=20)
-            if cache_time < dlt:
-                log.warn("Dfs cache timestamp is more than 20 minutes old")
+            thread.daemon = True
+            thread.start()
+            self._refresher = thread, stop, os.getpid()
+
+    def stop_refresher(self):
+        with self._refresher_lock:
+            refresher, self._refresher = self._refresher, None
+        if refresher is not None:
+            thread, stop, _ = refresher
+            stop.set()
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def _refresh_loop(self, interval, path, stop):
+        while not stop.is_set():
+            age = datetime.datetime.utcnow() - self.last_update
+            delay = interval - age.total_seconds()
+            if delay <= 0:
+                try:
+                    self.refresh(path)
+                except Exception:
+                    log.exception("Exception refreshing dfs cache")
+                # Also when the fetch was left to another process
+                delay = interval
+            stop.wait(delay)
 
     def fetch(self, path=DFSCACHE_PATH, uri=DFS_REF_API):
-        if self.fetch_event.is_set():
+        """
+        Download the cache from uri to path, sending the validators saved
+        by the last download so an unchanged cache is answered with a 304.
+        A download that isn't a valid cache leaves path and its validators
+        as they were. Returns path when a new copy was written, False
+        otherwise.
+        """
+        if self._fetch(path, uri) is None:
             return False
+        return path
+
+    def _fetch(self, path=DFSCACHE_PATH, uri=DFS_REF_API):
+        """
+        fetch() returning the (document, os.stat()) of the new copy, parsed
+        once to check it, or None.
+        """
+        if self.fetch_event.is_set():
+            return None
         self.fetch_event.set()
         try:
-            response = requests.get(uri, stream=True)
-            if response.status_code != 200:
-                raise UrlIOException(
-                    "Non 200 response: {}".format(response.status_code)
-                )
-            data = response.json()
-            tmp = tempfile.mktemp(dir=os.path.dirname(DFSCACHE_PATH))
-            with io.open(tmp, 'wb') as f:
-                f.write(
-                    json.dumps(
-                        data,
-                        sort_keys=True,
-                        indent=4,
-                    ).encode('utf-8')
+            headers = {}
+            if os.path.exists(path):
+                headers = fetch_validators(path)
+            response = http_session().get(
+                uri, headers=headers, stream=True, timeout=FETCH_TIMEOUT,
+            )
+            with contextlib.closing(response):
+                if response.status_code == 304:
+                    log.debug("Dfs cache not modified: %s", uri)
+                    return None
+                if response.status_code != 200:
+                    raise UrlIOException(
+                        "Non 200 response: {}".format(response.status_code)
+                    )
+                fd, tmp = tempfile.mkstemp(
+                    dir=os.path.dirname(os.path.abspath(path))
                 )
-            try:
-                os.chmod(tmp, int('666', 8))
-                os.rename(tmp, path)
-            except:
-                log.exception("Exception renaming cache")
-                os.remove(tmp)
-            return path
+                try:
+                    with io.open(fd, 'wb') as f:
+                        for chunk in response.iter_content(FETCH_CHUNK_SIZE):
+                            f.write(chunk)
+                    # A truncated or broken body must not replace the cache,
+                    # its validators would keep it there
+                    with io.open(tmp, 'rb') as f:
+                        data = json.loads(f.read().decode('utf-8'))
+                    if not isinstance(data, dict) or 'timestamp' not in data:
+                        raise UrlIOException("Not a dfs cache: {}".format(uri))
+                    os.chmod(tmp, int('666', 8))
+                    source = os.stat(tmp)
+                    os.rename(tmp, path)
+                except:
+                    log.exception("Exception writing cache")
+                    os.remove(tmp)
+                    return None
+            save_fetch_validators(path, response.headers)
+            return data, source
         except Exception as e:
             log.exception("Exception fetching cache")
-            return False
+            return None
         finally:
             self.last_update = datetime.datetime.utcnow()
             self.fetch_event.clear()
@@ -351,40 +577,336 @@ def cmp_to_key(mycmp):
             return mycmp(self.obj, other.obj) != 0
     return K
 
-def depth_first_resources(domain_cache):
-    resources = []
+# Keys find_target_in_cache adds to a domain's cache
+INDEX_KEYS = ('depth_first_resources', 'prefix_index')
+
+
+def resource_path(ns, resource):
+    "The path of the link to resource in the namespace ns"
+    return "{0}\\{1}".format(
+        ns.rstrip('\\'), resource.lstrip('\\')
+    ).rstrip('\\')
+
+
+def iter_resources(domain_cache):
+    "Iterate over the (path, conf) of every link in a domain's cache"
     for ns in domain_cache.copy():
+        if ns in INDEX_KEYS:
+            continue
         for resource in domain_cache[ns]:
-            path = "{0}\\{1}".format(
-                ns.rstrip('\\'), resource.lstrip('\\')
-            ).rstrip('\\')
-            resources.append(
-                (
-                    path,
-                    domain_cache[ns][resource]
-                )
-            )
+            yield resource_path(ns, resource), domain_cache[ns][resource]
+
+def depth_first_resources(domain_cache):
+    resources = list(iter_resources(domain_cache))
     sorted_resources = sorted(resources, key=cmp_to_key(by_depth), reverse=True)
     return sorted_resources
 
+
+class _IndexNode(object):
+    __slots__ = ('children', 'resources')
+
+    def __init__(self):
+        self.children = {}
+        # (path, conf) of the links ending at this node
+        self.resources = []
+
+
+class DfsIndex(object):
+    """
+    The links of a domain's dfs cache in a trie of case folded path
+    components. A lookup walks the components of a uri, no more than its
+    depth, instead of testing every link in the cache.
+    """
+
+    def __init__(self, resources=()):
+        self.root = _IndexNode()
+        self.size = 0
+        for path, conf in resources:
+            self.add(path, conf)
+
+    @classmethod
+    def from_domain_cache(cls, domain_cache):
+        return cls(iter_resources(domain_cache))
+
+    def add(self, path, conf):
+        node = self.root
+        for part in path.lower().split('\\'):
+            child = node.children.get(part)
+            if child is None:
+                child = node.children[part] = _IndexNode()
+            node = child
+        node.resources.append((path, conf))
+        self.size += 1
+
+    def lookup(self, uri, case_sensative=False):
+        """
+        Return the (path, target) of the deepest link holding uri that has
+        an ONLINE target, or None.
+        """
+        matched = []
+        node = self.root
+        for part in uri.lower().split('\\'):
+            node = node.children.get(part)
+            if node is None:
+                break
+            if node.resources:
+                matched.append(node)
+        for node in reversed(matched):
+            for path, conf in node.resources:
+                if case_sensative and not (
+                        uri == path or uri.startswith(path + '\\')):
+                    continue
+                for tgt in conf['targets']:
+                    if tgt['state'] == 'ONLINE':
+                        return path, tgt
+        return None
+
+    def has_links_below(self, path):
+        "True when there are links below the link path"
+        node = self.root
+        for part in path.lower().split('\\'):
+            node = node.children.get(part)
+            if node is None:
+                return False
+        return bool(node.children)
+
+
 def find_target_in_cache(uri, cache, case_sensative=False):
-    if not case_sensative:
-        test_uri = uri.lower()
-    else:
-        test_uri = uri
-    if not 'depth_first_resources' in cache:
-        cache['depth_first_resources'] = depth_first_resources(cache)
-    for path, conf in cache['depth_first_resources']:
-        if not case_sensative:
-            test_path = path.lower().rstrip('\\')
-        else:
-            test_path = path.rstrip('\\')
-        if test_uri.startswith(test_path + '\\') or test_path == test_uri:
-            for tgt in conf['targets']:
-                if tgt['state'] == 'ONLINE':
-                    if test_path.rstrip('\\') == test_uri:
-                        return path.rstrip('\\'), tgt
-                    return path, tgt
+    """
+    Return the (path, target) of the deepest link of a domain's cache
+    holding uri that has an ONLINE target, or None. The cache's index is
+    built on the first lookup.
+    """
+    index = cache.get('prefix_index')
+    if index is None:
+        index = cache['prefix_index'] = DfsIndex.from_domain_cache(cache)
+    return index.lookup(uri, case_sensative)
+
+# The compiled cache file: a header, a table of domains, a table of the
+# case folded link paths of every domain sorted bytewise, and the names,
+# paths and JSON encoded links the tables point to. The links of a path
+# are found by a binary search over the mapped file. A link is kept as
+# its [namespace, resource, conf] so the domain's part of the JSON
+# document can be rebuilt from it.
+COMPILED_MAGIC = b'URLIODFS'
+COMPILED_VERSION = 2
+# magic, version, source size, source mtime (ns), cache timestamp, number
+# of domains, number of paths
+COMPILED_HEADER = struct.Struct('<8sIqqqII')
+# name offset, name length, first path, number of paths
+COMPILED_DOMAIN = struct.Struct('<IIII')
+# path offset, path length, links offset, links length
+COMPILED_PATH = struct.Struct('<IIII')
+
+
+def compiled_cache_path(path):
+    return path + '.idx'
+
+
+def _source_mtime(source):
+    return getattr(source, 'st_mtime_ns', None) or int(source.st_mtime * 1e9)
+
+
+def write_compiled_cache(path, data, source):
+    """
+    Write the compiled copy of data, the cache parsed from the file source
+    is the os.stat() of. Returns False when it could not be written.
+    """
+    domains = sorted(
+        (domain.lower(), domain)
+        for domain in data if isinstance(data[domain], dict)
+    )
+    tables = []
+    for _, domain in domains:
+        links = {}
+        domain_cache = data[domain]
+        for ns in domain_cache:
+            if ns in INDEX_KEYS:
+                continue
+            for resource, conf in domain_cache[ns].items():
+                key = resource_path(ns, resource).lower().encode('utf-8')
+                links.setdefault(key, []).append([ns, resource, conf])
+        tables.append((domain.encode('utf-8'), sorted(links.items())))
+    npaths = sum(len(links) for _, links in tables)
+    offset = (
+        COMPILED_HEADER.size + len(tables) * COMPILED_DOMAIN.size +
+        npaths * COMPILED_PATH.size
+    )
+    header = [COMPILED_HEADER.pack(
+        COMPILED_MAGIC, COMPILED_VERSION, source.st_size,
+        _source_mtime(source), int(data.get('timestamp', 0)), len(tables),
+        npaths,
+    )]
+    rows = []
+    blob = []
+    first = 0
+    for name, links in tables:
+        header.append(COMPILED_DOMAIN.pack(offset, len(name), first, len(links)))
+        blob.append(name)
+        offset += len(name)
+        first += len(links)
+        for key, record in links:
+            record = json.dumps(record, separators=(',', ':')).encode('utf-8')
+            rows.append(COMPILED_PATH.pack(
+                offset, len(key), offset + len(key), len(record)
+            ))
+            blob.append(key)
+            blob.append(record)
+            offset += len(key) + len(record)
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+        with io.open(fd, 'wb') as f:
+            f.write(b''.join(header + rows + blob))
+        os.chmod(tmp, int('666', 8))
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        log.exception("Exception writing compiled dfs cache")
+        if tmp and os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+    return True
+
+
+def load_compiled_cache(path, source):
+    """
+    Map the compiled cache at path and return its (indexes, timestamp), or
+    None when it is missing, of another version, or wasn't made from the
+    file source is the os.stat() of. The indexes are keyed by the case
+    folded domain names.
+    """
+    try:
+        with io.open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+    try:
+        magic, version, size, mtime, timestamp, ndomains, npaths = \
+            COMPILED_HEADER.unpack_from(buf, 0)
+    except struct.error:
+        return None
+    if magic != COMPILED_MAGIC or version != COMPILED_VERSION:
+        log.debug("Ignoring compiled dfs cache of another version")
+        return None
+    if (size, mtime) != (source.st_size, _source_mtime(source)):
+        log.debug("Ignoring stale compiled dfs cache")
+        return None
+    paths = COMPILED_HEADER.size + ndomains * COMPILED_DOMAIN.size
+    indexes = {}
+    try:
+        domains = [
+            COMPILED_DOMAIN.unpack_from(buf, COMPILED_HEADER.size + n * COMPILED_DOMAIN.size)
+            for n in range(ndomains)
+        ]
+        _check_compiled_sections(buf, paths, domains, npaths)
+        for offset, length, first, count in domains:
+            name = buf[offset:offset + length].decode('utf-8')
+            indexes[name.lower()] = CompiledDfsIndex(buf, paths, first, count, name)
+    except (struct.error, ValueError):
+        log.warn("Ignoring corrupt compiled dfs cache: %s", path)
+        return None
+    return indexes, timestamp
+
+
+def _check_compiled_sections(buf, paths, domains, npaths):
+    """
+    Raise ValueError unless every table and every name, path and links
+    they point to lie within buf, so a truncated or corrupt compiled cache
+    is never used for lookups.
+    """
+    size = len(buf)
+    if paths + npaths * COMPILED_PATH.size > size:
+        raise ValueError("Compiled dfs cache tables truncated")
+    for offset, length, first, count in domains:
+        if offset + length > size or first + count > npaths:
+            raise ValueError("Compiled dfs cache domain out of bounds")
+    for n in range(npaths):
+        offset, length, links, links_length = COMPILED_PATH.unpack_from(
+            buf, paths + n * COMPILED_PATH.size
+        )
+        if offset + length > size or links + links_length > size:
+            raise ValueError("Compiled dfs cache path out of bounds")
+
+
+class CompiledDfsIndex(object):
+    """
+    A DfsIndex over the links of one domain in a mapped compiled cache.
+    A lookup does a binary search for every prefix of the uri and only
+    decodes the links of the paths found. name is the domain's key in the
+    JSON document.
+    """
+
+    def __init__(self, buf, paths, first, count, name=None):
+        self.buf = buf
+        self.paths = paths
+        self.first = first
+        self.size = count
+        self.name = name
+
+    def _row(self, n):
+        return COMPILED_PATH.unpack_from(self.buf, self.paths + n * COMPILED_PATH.size)
+
+    def _key(self, n):
+        offset, length, _, _ = self._row(n)
+        return self.buf[offset:offset + length]
+
+    def _bisect(self, key):
+        "Return the number of the first path not less than key"
+        lo, hi = self.first, self.first + self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _links(self, n):
+        _, _, links, links_length = self._row(n)
+        return json.loads(self.buf[links:links + links_length].decode('utf-8'))
+
+    def _find(self, key):
+        n = self._bisect(key)
+        if n < self.first + self.size and self._key(n) == key:
+            return self._links(n)
+        return None
+
+    def domain_cache(self):
+        "Rebuild the domain's part of the JSON document"
+        domain_cache = {}
+        for n in range(self.first, self.first + self.size):
+            for ns, resource, conf in self._links(n):
+                domain_cache.setdefault(ns, {})[resource] = conf
+        return domain_cache
+
+    def has_links_below(self, path):
+        "True when there are links below the link path"
+        prefix = (path.lower() + '\\').encode('utf-8')
+        n = self._bisect(prefix)
+        return (
+            n < self.first + self.size and self._key(n).startswith(prefix)
+        )
+
+    def lookup(self, uri, case_sensative=False):
+        """
+        Return the (path, target) of the deepest link holding uri that has
+        an ONLINE target, or None.
+        """
+        parts = uri.lower().split('\\')
+        for n in range(len(parts), 0, -1):
+            links = self._find('\\'.join(parts[:n]).encode('utf-8'))
+            if links is None:
+                continue
+            for ns, resource, conf in links:
+                path = resource_path(ns, resource)
+                if case_sensative and not (
+                        uri == path or uri.startswith(path + '\\')):
+                    continue
+                for tgt in conf['targets']:
+                    if tgt['state'] == 'ONLINE':
+                        return path, tgt
+        return None
+
 
 DFSCACHE = DfsCache()
 load_dfs_cache = DFSCACHE.load
@@ -392,6 +914,16 @@ fetch_dfs_caceh = DFSCACHE.fetch
 
 
 def find_dfs_share(uri, **opts):
+    return _find_dfs_share(uri, **opts)[0]
+
+
+def _find_dfs_share(uri, **opts):
+    """
+    find_dfs_share() returning the (server, service, domain, path) found
+    and the (path, server, service, domain, sharedir, leaf) of the dfs
+    link it was found through, or None for uris naming their server. leaf
+    is True when there are no links below the link.
+    """
     case_sensative = opts.get('case_sensative', False)
     log.debug("find dfs share: %s", uri)
     uri = normalize_domain(uri)
@@ -408,52 +940,167 @@ def find_dfs_share(uri, **opts):
         log.debug("Using parts from uri %s %s %s %s",
             hostname, service, domain, dfspath
         )
-        return hostname, service, domain, dfspath.lstrip('\\')
+        return (hostname, service, domain, dfspath.lstrip('\\')), None
     domain, _ = split_host_path(uri)
-    if not DFSCACHE:
-        load_dfs_cache()
+    if not DFSCACHE.indexes:
+        # Nothing to look up in yet, this is the only time a lookup waits
+        DFSCACHE.load()
         log.warn("No dfs cache present")
-    elif AUTO_UPDATE_DFSCACHE:
-        dlt = datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
-        if DFSCACHE.last_update < dlt:
-            if DFSCACHE.fetch():
-                load_dfs_cache()
+    if AUTO_UPDATE_DFSCACHE:
+        DFSCACHE.start_refresher()
     slashed_domain = u'\\\\{0}'.format(domain).lower()
-    if slashed_domain in DFSCACHE:
-        domain_cache = DFSCACHE[slashed_domain]
-    else:
+    index = DFSCACHE.indexes.get(slashed_domain)
+    if index is None:
         errmsg = "Domain not in cache: {}".format(domain)
         raise FindDfsShare(errmsg)
-    result = find_target_in_cache(test_uri, domain_cache, case_sensative)
+    result = index.lookup(test_uri, case_sensative)
     if not result:
         raise FindDfsShare("No dfs cache result found")
-    path, tgt = result
+    link, tgt = result
     server, service = split_host_path(tgt['target'])
     sharedir = ''
     if '\\' in service:
         service, sharedir = service.split('\\', 1)
     if domain.count('.') > 1:
         domain = '.'.join(domain.split('.')[-2:])
-    part = uri.lower().split(path.lower(), 1)[1]
+    path = _link_path(uri, link, sharedir)
+    leaf = not index.has_links_below(link)
+    return (server, service, domain, path), (link, server, service, domain, sharedir, leaf)
+
+
+def _link_path(uri, link, sharedir):
+    "The path on the share of uri, found through the dfs link"
+    part = uri.lower().split(link.lower(), 1)[1]
     if len(part):
-        path = u"{0}\\{1}".format(
+        return u"{0}\\{1}".format(
             sharedir, uri[-len(part):].lstrip('\\')
         ).strip('\\')
-    else:
-        path = sharedir
-    data = {
-        'host': server,
-        'service': service,
-        'domain': domain,
-        'path': path,
-    }
-    server = server
-    service = service
-    path = path
-    domain = domain
-    return server, service, domain, path
+    return sharedir
+
+
+class DfsShareCache(object):
+    """
+    Results of find_dfs_share() for default_find_dfs_share(), keyed by uri
+    and options. Results expire after ttl seconds, FindDfsShare failures
+    after negative_ttl seconds, and the least recently used are evicted
+    once maxsize are cached. Loading a new dfs cache forgets every result.
+
+    A uri below a dfs link with no links below it resolves from the link
+    a cached result was found through, without a lookup. That's only done
+    for case insensitive lookups.
+    """
+
+    def __init__(self, maxsize=4096, ttl=500, negative_ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # ('uri', uri, options) => (expires, result or FindDfsShare) and
+        # ('link', folded link path) => (expires, link)
+        self.cache = collections.OrderedDict()
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+        self._indexes = None
+
+    def find_dfs_share(self, uri, **opts):
+        key = ('uri', uri, tuple(sorted(opts.items())))
+        now = time.time()
+        with self.lock:
+            indexes = self._check_indexes()
+            value = self._get(key, now)
+            if value is not None:
+                if isinstance(value, FindDfsShare):
+                    self.counters['negative_hits'] += 1
+                    raise FindDfsShare(*value.args)
+                self.counters['hits'] += 1
+                return value
+            if not opts.get('case_sensative', False):
+                result = self._from_link(uri, now)
+                if result is not None:
+                    self.counters['prefix_hits'] += 1
+                    return result
+            self.counters['misses'] += 1
+        try:
+            result, link = _find_dfs_share(uri, **opts)
+        except FindDfsShare as e:
+            self._set(self._loaded(indexes), key, e, self.negative_ttl)
+            raise
+        indexes = self._loaded(indexes)
+        self._set(indexes, key, result, self.ttl)
+        if link is not None and link[-1]:
+            self._set(indexes, ('link', link[0].lower()), link, self.ttl)
+        return result
+
+    def _from_link(self, uri, now):
+        uri = normalize_domain(uri)
+        parts = uri.lower().split('\\')
+        for n in range(len(parts), 3, -1):
+            link = self._get(('link', '\\'.join(parts[:n])), now)
+            if link is not None:
+                path, server, service, domain, sharedir, _ = link
+                return server, service, domain, _link_path(uri, path, sharedir)
+        return None
+
+    def _get(self, key, now):
+        entry = self.cache.pop(key, None)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < now:
+            return None
+        self.cache[key] = entry
+        return value
+
+    def _set(self, indexes, key, value, ttl):
+        if not self.maxsize or not ttl:
+            return
+        with self.lock:
+            if self._check_indexes() is not indexes:
+                # Found in a dfs cache that has since been replaced
+                return
+            self.cache.pop(key, None)
+            self.cache[key] = (time.time() + ttl, value)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    @staticmethod
+    def _loaded(indexes):
+        # Without a dfs cache the lookup loaded the first one, its result is
+        # from the dfs cache in use
+        if not indexes:
+            return DFSCACHE.indexes
+        return indexes
+
+    def _check_indexes(self):
+        # Results found in another dfs cache may be out of date
+        if DFSCACHE.indexes is not self._indexes:
+            self.cache.clear()
+            self._indexes = DFSCACHE.indexes
+        return self._indexes
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def stats(self):
+        """
+        Return a dictionary of the cache's hit, negative hit, prefix hit,
+        miss and eviction counters.
+        """
+        with self.lock:
+            stats = dict(
+                (name, self.counters[name])
+                for name in (
+                    'hits', 'negative_hits', 'prefix_hits', 'misses',
+                    'evictions',
+                )
+            )
+            stats['size'] = len(self.cache)
+        return stats
+
+
+dfs_share_cache = DfsShareCache()
 
 
-@repoze.lru.lru_cache(100, timeout=500)
 def default_find_dfs_share(uri, **opts):
-    return find_dfs_share(uri, **opts)
+    return dfs_share_cache.find_dfs_share(uri, **opts)
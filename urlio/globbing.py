@@ -0,0 +1,212 @@
+"""
+Glob patterns for directory listings.
+
+Patterns are matched against paths relative to the directory listed, one
+path component at a time. Besides the usual '*', '?' and '[seq]' a pattern
+may hold '**', which matches any number of directories, and brace
+alternatives like '*.{edi,x12}'. Either '\\' or '/' separates components
+and matching is case insensitive, like SMB servers do.
+
+QUERY_DIRECTORY takes a single pattern with '*' and '?' only and it applies
+to directories as well, so a pattern is only sent to the server for a
+directory none of whose subdirectories have to be listed. Everything else is
+matched on the client with compiled regular expressions.
+"""
+from __future__ import absolute_import
+import fnmatch
+import re
+
+# Characters with no special meaning in QUERY_DIRECTORY patterns
+SERVER_SAFE = re.compile(r'^[^\[\]<>"]*$')
+
+
+def expand_braces(pattern):
+    """
+    Return the list of patterns a pattern with brace alternatives stands
+    for: 'a{b,c{d,e}}' => ['ab', 'acd', 'ace']. Unbalanced braces and braces
+    without a comma are kept as they are.
+    """
+    depth = 0
+    start = None
+    commas = []
+    for n, c in enumerate(pattern):
+        if c == '{':
+            if depth == 0:
+                start = n
+                commas = []
+            depth += 1
+        elif c == ',' and depth == 1:
+            commas.append(n)
+        elif c == '}' and depth:
+            depth -= 1
+            if depth == 0 and commas:
+                prefix, suffix = pattern[:start], pattern[n + 1:]
+                bounds = [start] + commas + [n]
+                expanded = []
+                for a, b in zip(bounds, bounds[1:]):
+                    for alternative in expand_braces(pattern[a + 1:b]):
+                        for rest in expand_braces(suffix):
+                            expanded.append(prefix + alternative + rest)
+                return expanded
+            elif depth == 0:
+                return [
+                    pattern[:n + 1] + rest
+                    for rest in expand_braces(pattern[n + 1:])
+                ]
+    return [pattern]
+
+
+class _Pattern(object):
+    "A brace free pattern split into compiled components"
+
+    def __init__(self, pattern):
+        parts = [a for a in re.split(r'[\\/]+', pattern.strip('\\/')) if a]
+        # Consecutive '**' are the same as one
+        self.parts = [
+            a for n, a in enumerate(parts)
+            if not (a == '**' and n and parts[n - 1] == '**')
+        ]
+        self.regexes = [
+            None if a == '**' else re.compile(fnmatch.translate(a), re.IGNORECASE)
+            for a in self.parts
+        ]
+
+    def advance(self, states, name):
+        "Return the states reached from states by the component name"
+        reached = set()
+        for i in states:
+            if i >= len(self.parts):
+                continue
+            if self.regexes[i] is None:
+                reached.add(i)
+            elif self.regexes[i].match(name):
+                reached.add(i + 1)
+        return self.closure(reached)
+
+    def closure(self, states):
+        # '**' also matches no directory at all
+        states = set(states)
+        for i in sorted(states):
+            while i < len(self.parts) and self.regexes[i] is None:
+                i += 1
+                states.add(i)
+        return frozenset(states)
+
+
+def _any_depth(patterns):
+    if isinstance(patterns, (str, type(u''))):
+        patterns = [patterns]
+    return [a if re.search(r'[\\/]|\*\*', a) else '**/' + a for a in patterns]
+
+
+class Glob(object):
+    """
+    Match relative paths against include patterns and, optionally, exclude
+    patterns. A path matches when any include pattern and no exclude
+    pattern matches it. A directory matched by an exclude pattern is not
+    descended into.
+
+    Entries are matched one component at a time: start() returns the state
+    of the directory listed and child() the state of one of its entries
+    from the state of the directory. The other methods take those states,
+    so every component is only matched once.
+    """
+
+    def __init__(self, include='*', exclude=()):
+        if isinstance(include, (str, type(u''))):
+            include = [include]
+        if isinstance(exclude, (str, type(u''))):
+            exclude = [exclude]
+        self.include = [
+            _Pattern(a) for pattern in include for a in expand_braces(pattern)
+        ]
+        self.exclude = [
+            _Pattern(a) for pattern in exclude or () for a in expand_braces(pattern)
+        ]
+        self._patterns = self.include + self.exclude
+
+    @classmethod
+    def recursive(cls, include='*', exclude=()):
+        """
+        A Glob for recursive listings. Include and exclude patterns without
+        a directory part match at any depth, '*.edi' is the same as
+        '**/*.edi'.
+        """
+        return cls(_any_depth(include), _any_depth(exclude or ()))
+
+    @staticmethod
+    def is_plain(pattern):
+        "True when a pattern can be sent to the server as it is"
+        return (
+            isinstance(pattern, (str, type(u''))) and
+            not re.search(r'[\\/{}]', pattern) and
+            SERVER_SAFE.match(pattern) is not None
+        )
+
+    def start(self):
+        "Return the state of the directory listed"
+        return tuple(a.closure([0]) for a in self._patterns)
+
+    def child(self, state, name):
+        "Return the state of the entry name of the directory with state"
+        return tuple(
+            a.advance(states, name) for a, states in zip(self._patterns, state)
+        )
+
+    def match(self, state):
+        "True when the entry with state matches"
+        include = self._patterns[:len(self.include)]
+        if not any(len(a.parts) in s for a, s in zip(include, state)):
+            return False
+        return not self.excluded(state)
+
+    def excluded(self, state):
+        n = len(self.include)
+        return any(
+            len(a.parts) in s
+            for a, s in zip(self._patterns[n:], state[n:])
+        )
+
+    def descend(self, state):
+        """
+        True when anything below the directory with state can match.
+        """
+        if self.excluded(state):
+            return False
+        return any(
+            i < len(a.parts)
+            for a, states in zip(self.include, state) for i in states
+        )
+
+    def _deep(self, state):
+        # True when entries of the subdirectories of the directory with
+        # state can match, so they have to be listed
+        if self.excluded(state):
+            return False
+        for a, states in zip(self.include, state):
+            for i in states:
+                if i < len(a.parts) and (
+                        a.regexes[i] is None or len(a.parts) - i > 1):
+                    return True
+        return False
+
+    def server_pattern(self, state, descend=True):
+        """
+        Return the pattern to list the directory with state with. Unless
+        the directory's subdirectories don't have to be listed, because
+        nothing below them can match or descend is False, and its entries
+        can only match a single pattern the server understands, that is
+        '*'.
+        """
+        if descend and self._deep(state):
+            return '*'
+        last = set()
+        for a, states in zip(self.include, state):
+            for i in states:
+                if i == len(a.parts) - 1:
+                    last.add(a.parts[i].lower().replace('**', '*'))
+        if len(last) == 1:
+            pattern = last.pop()
+            if SERVER_SAFE.match(pattern):
+                return pattern
+        return '*'
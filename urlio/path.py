@@ -5,6 +5,9 @@ access things using '\\\\foo\\bar' or '/foo/bar' instead of 'smb://foo/bar' or
 """
 from __future__ import absolute_import, unicode_literals
 import sys
+import collections
+import contextlib
+import functools
 import json
 import errno
 import socket
@@ -19,6 +22,7 @@ import time
 import smb
 import nmb.NetBIOS
 import hashlib
+import hmac
 import tempfile
 import multiprocessing
 
@@ -29,9 +33,19 @@ from smb.smb2_constants import *
 import threading
 import logging
 import repoze.lru
-from .smb_ext import iter_listPath, listPath, storeFileFromOffset
+from .smb_ext import (
+    iter_listPath, listPath, storeFileFromOffset, retrieveFileFromOffset,
+    openFile, openDirectory, BufferReader, BufferWriter, ChangeEvent,
+    CHANGE_ADDED, CHANGE_REMOVED, CHANGE_MODIFIED, CHANGE_OVERFLOW,
+    FILE_NOTIFY_CHANGE_DEFAULT, FILE_NOTIFY_CHANGE_FILE_NAME,
+    FILE_NOTIFY_CHANGE_DIR_NAME, FILE_NOTIFY_CHANGE_SIZE,
+    FILE_NOTIFY_CHANGE_LAST_WRITE, EntryFilter,
+)
 from .dfs import default_find_dfs_share as find_dfs_share
 from .base import BasicIO
+from .pool import POOLS
+from .walk import ParallelWalker
+from .globbing import Glob
 log = logging.getLogger(__name__)
 
 if hasattr(os, 'uname'):
@@ -42,6 +56,10 @@ else:
 SMB_IGNORE_FILENAMES = (
     '.', '..', '$RECYCLE.BIN', '.DS_Store',
 )
+# Bytes read ahead by SMBPath.readline() and line iteration
+READ_BUFFER_SIZE = 64 * 1024
+# Largest read(size) buffer allocated before the size of the file is known
+READ_PREALLOCATE = 1024 * 1024
 SMB_USER = os.environ.get('SMBUSER', None)
 SMB_PASS = os.environ.get('SMBPASS', None)
 if sys.version_info <= (3,):
@@ -438,6 +456,256 @@ class DnsCache(object):
 
 dnscache = DnsCache()
 
+# Socket errors that mean a transport isn't offered and the other one
+# should be tried: ECONNREFUSED (Linux and BSD) and ECONNRESET.
+TRANSPORT_REFUSED_ERRNOS = (61, 104, 111)
+
+# NetBIOS session service (139) is tried before direct TCP (445) when
+# nothing is known about a server.
+TRANSPORT_ORDER = (False, True)
+
+
+def transport_port(is_direct_tcp):
+    if is_direct_tcp:
+        return 445
+    return 139
+
+
+class TransportCache(object):
+    """
+    Remember which SMB transport worked for each server, direct TCP on port
+    445 or NetBIOS over port 139, and how long connecting took. When race is
+    True servers not in the cache are probed on both ports at once and the
+    first to accept a connection is used.
+    """
+
+    def __init__(self, cache=None, expirations=None, ttl=3600, race=False):
+        if cache is None:
+            cache = {}
+        if expirations is None:
+            expirations = {}
+        self.ttl = ttl
+        self.race = race
+        self.cache = cache
+        self.expirations = expirations
+        self.lock = threading.Lock()
+
+    def __call__(self, hostname):
+        """
+        Return True if direct TCP, False if NetBIOS is known to work for
+        the host and None when it is unknown.
+        """
+        entry = self.get(hostname)
+        if entry is None:
+            return None
+        return entry['is_direct_tcp']
+
+    def get(self, hostname):
+        hostname = hostname.lower()
+        with self.lock:
+            if hostname not in self.cache or self._is_expired(hostname):
+                return None
+            return dict(self.cache[hostname])
+
+    def record(self, hostname, is_direct_tcp, connect_time=None):
+        hostname = hostname.lower()
+        with self.lock:
+            self.cache[hostname] = {
+                'is_direct_tcp': is_direct_tcp,
+                'port': transport_port(is_direct_tcp),
+                'connect_time': connect_time,
+            }
+            self.expirations[hostname] = time.time() + self.ttl
+
+    def invalidate(self, hostname):
+        hostname = hostname.lower()
+        with self.lock:
+            self.cache.pop(hostname, None)
+            self.expirations.pop(hostname, None)
+
+    def order(self, hostname, timeout=5):
+        """
+        Return the transports to try for a host, best first.
+        """
+        is_direct_tcp = self(hostname)
+        if is_direct_tcp is None and self.race:
+            is_direct_tcp = self.race_transports(hostname, timeout=timeout)
+        if is_direct_tcp is None:
+            return TRANSPORT_ORDER
+        return (is_direct_tcp, not is_direct_tcp)
+
+    def race_transports(self, hostname, timeout=5):
+        """
+        Open plain TCP connections to both SMB ports concurrently and record
+        the transport of the first one to connect. Returns None when neither
+        port accepts a connection.
+        """
+        ip = dnscache(hostname)
+        results = []
+        done = threading.Condition(threading.Lock())
+
+        def probe(is_direct_tcp):
+            start = time.time()
+            try:
+                sock = socket.create_connection(
+                    (ip, transport_port(is_direct_tcp)), timeout
+                )
+            except (socket.error, socket.timeout):
+                result = (is_direct_tcp, None)
+            else:
+                sock.close()
+                result = (is_direct_tcp, time.time() - start)
+            with done:
+                results.append(result)
+                done.notify()
+
+        for is_direct_tcp in TRANSPORT_ORDER:
+            t = threading.Thread(target=probe, args=(is_direct_tcp,))
+            t.daemon = True
+            t.start()
+        deadline = time.time() + timeout
+        with done:
+            while True:
+                for is_direct_tcp, connect_time in results:
+                    if connect_time is not None:
+                        self.record(hostname, is_direct_tcp, connect_time)
+                        return is_direct_tcp
+                remaining = deadline - time.time()
+                if len(results) == len(TRANSPORT_ORDER) or remaining <= 0:
+                    return None
+                done.wait(remaining)
+
+    def _is_expired(self, name):
+        if name not in self.expirations:
+            return True
+        exp = self.expirations[name]
+        if exp <= time.time():
+            self.cache.pop(name)
+            self.expirations.pop(name)
+            return True
+        return False
+
+transportcache = TransportCache()
+
+
+class ListingCache(object):
+    """
+    Directory listings of SMBPath.ls() and everything built on it, keyed by
+    server, share, directory and glob. Listings expire after ttl seconds
+    and the least recently used are evicted once maxsize are cached. The
+    cache is disabled while ttl is 0.
+
+    SMBPath.write(), remove(), rename(), makedirs() and rmtree() invalidate
+    the listings they change, changes made any other way are only seen once
+    a listing expires.
+    """
+
+    def __init__(self, ttl=0, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+        self.expirations = {}
+        # The keys of the cached listings of each directory
+        self.dirs = {}
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _dir_key(server, share, relpath):
+        return (server.lower(), share.lower(), relpath.strip('\\').lower())
+
+    def get(self, server, share, relpath, glob):
+        """
+        Return the cached list of entries or None.
+        """
+        if not self.ttl:
+            return None
+        key = self._dir_key(server, share, relpath) + (glob,)
+        with self.lock:
+            if key not in self.cache or self._is_expired(key):
+                self.counters['misses'] += 1
+                return None
+            self.counters['hits'] += 1
+            entries = self.cache.pop(key)
+            self.cache[key] = entries
+            return entries
+
+    def set(self, server, share, relpath, glob, entries):
+        if not self.ttl:
+            return
+        dir_key = self._dir_key(server, share, relpath)
+        key = dir_key + (glob,)
+        with self.lock:
+            self.cache.pop(key, None)
+            self.cache[key] = entries
+            self.expirations[key] = time.time() + self.ttl
+            self.dirs.setdefault(dir_key, set()).add(key)
+            while len(self.cache) > self.maxsize:
+                self._drop(next(iter(self.cache)))
+                self.counters['evictions'] += 1
+
+    def invalidate(self, server, share, relpath, tree=False):
+        """
+        Forget the listings of relpath and of the directory holding it.
+        With tree the listings of every directory below relpath are
+        forgotten as well.
+        """
+        dir_key = self._dir_key(server, share, relpath)
+        parent = dir_key[:2] + (dir_key[2].rpartition('\\')[0],)
+        with self.lock:
+            if not self.cache:
+                return
+            keys = set()
+            for k in (dir_key, parent):
+                keys.update(self.dirs.get(k, ()))
+            if tree:
+                prefix = dir_key[2] + '\\'
+                keys.update(
+                    key for key in self.cache
+                    if key[:2] == dir_key[:2] and key[2].startswith(prefix)
+                )
+            for key in keys:
+                self._drop(key)
+            self.counters['invalidations'] += len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.expirations.clear()
+            self.dirs.clear()
+
+    def stats(self):
+        """
+        Return a dictionary of the cache's hit, miss, eviction and
+        invalidation counters.
+        """
+        with self.lock:
+            stats = dict(
+                (name, self.counters[name])
+                for name in ('hits', 'misses', 'evictions', 'invalidations')
+            )
+            stats['size'] = len(self.cache)
+        return stats
+
+    def _drop(self, key):
+        self.cache.pop(key, None)
+        self.expirations.pop(key, None)
+        keys = self.dirs.get(key[:3])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                self.dirs.pop(key[:3])
+
+    def _is_expired(self, key):
+        if key not in self.expirations:
+            return True
+        if self.expirations[key] <= time.time():
+            self._drop(key)
+            return True
+        return False
+
+listingcache = ListingCache()
+
 def get_smb_connection(
         server, domain, user, pas, port=139, timeout=30, client=CLIENTNAME,
         is_direct_tcp=False,
@@ -461,10 +729,74 @@ def get_smb_connection(
     conn = SMBConnection(
         str(user), str(pas), str(client), str(server_name), domain=str(domain), is_direct_tcp=is_direct_tcp
     )
-    conn.connect(server_ip, port, timeout=timeout)
+    start = time.time()
+    try:
+        conn.connect(server_ip, port, timeout=timeout)
+    except socket.error as e:
+        if e.errno in TRANSPORT_REFUSED_ERRNOS:
+            transportcache.invalidate(hostname)
+        raise
+    transportcache.record(hostname, is_direct_tcp, time.time() - start)
     return conn
 
 
+# Keeps the passwords in pool keys from being recovered from the keys
+_CREDENTIAL_SALT = os.urandom(16)
+
+
+def credential_key(password):
+    """
+    A digest of password for pool keys, so a changed password gets a pool
+    of its own instead of reusing sessions opened with the old one.
+    """
+    return hmac.new(
+        _CREDENTIAL_SALT, '{}'.format(password).encode('utf-8'),
+        hashlib.sha256,
+    ).hexdigest()[:16]
+
+
+def get_smb_pool(
+        server, domain, user, pas, timeout=30, client=CLIENTNAME,
+        is_direct_tcp=False,
+    ):
+    """
+    Return the shared connection pool for a server, domain, credentials
+    and transport. New connections are made with get_smb_connection.
+    """
+    key = (
+        server.lower(), domain.lower(), user, credential_key(pas),
+        is_direct_tcp,
+    )
+    factory = functools.partial(
+        get_smb_connection, server, domain, user, pas, timeout=timeout,
+        client=client, is_direct_tcp=is_direct_tcp,
+    )
+    return POOLS.get(key, factory, ping=smb_ping)
+
+
+def smb_ping(conn, timeout=5):
+    """
+    Liveness check for pooled connections. Sends an SMB ECHO and raises when
+    no reply comes back in time.
+    """
+    if conn.sock is None:
+        return False
+    conn.echo(b'urlio', timeout=timeout)
+    return True
+
+
+def connection_reusable(conn):
+    """
+    True when a connection can safely be handed to another caller: the
+    socket is still open and no replies are outstanding, including requests
+    the server answered with STATUS_PENDING.
+    """
+    return (
+        conn.sock is not None and not conn.pending_requests and
+        not getattr(conn, 'async_requests', None) and not conn.is_busy
+    )
+
+
 def smb_dirname(inpath):
     host = None
     if inpath.startswith('\\\\'):
@@ -514,19 +846,100 @@ def getFiletime(dt):
         return datetime.datetime.utcfromtimestamp(dt)
 
 
+class DirEntry(object):
+    """
+    A directory entry returned by ls(entries=True) and walk(entries=True),
+    much like the entries of os.scandir(). Only the name, size, attributes
+    and timestamps sent by the server are kept, an SMBPath is created by
+    smbpath() when one is needed.
+
+    raw_times holds the create, last access, last write and last attribute
+    change times as listed: FILETIME integers from SMB2 and epoch floats
+    from SMB1 servers, getFiletime() accepts both.
+    """
+
+    __slots__ = ('parent', 'name', 'size', 'attributes', 'raw_times')
+
+    def __init__(self, parent, entry):
+        self.parent = parent
+        self.name = entry.filename
+        self.size = entry.file_size
+        self.attributes = entry.file_attributes
+        self.raw_times = getattr(entry, 'raw_times', None) or (
+            entry.create_time, entry.last_access_time,
+            entry.last_write_time, entry.last_attr_change_time,
+        )
+
+    def __repr__(self):
+        return '<DirEntry({})>'.format(repr(self.name))
+
+    def __str__(self):
+        return self.path
+
+    @property
+    def path(self):
+        return SMBPath.static_join(self.parent.path, self.name)
+
+    def isdir(self):
+        return bool(self.attributes & ATTR_DIRECTORY)
+
+    def isfile(self):
+        return not self.isdir()
+
+    @property
+    def ctime(self):
+        return getFiletime(self.raw_times[0])
+
+    @property
+    def atime(self):
+        return getFiletime(self.raw_times[1])
+
+    @property
+    def mtime(self):
+        return getFiletime(self.raw_times[2])
+
+    def stat(self):
+        return {
+           'size': self.size,
+           'atime': self.atime,
+           'mtime': self.mtime,
+           'ctime': self.ctime,
+        }
+
+    def smbpath(self, **kwargs):
+        "Return an SMBPath for this entry, its attributes already filled in"
+        kwargs.setdefault('_attrs', self)
+        return self.parent.join(self.name, **kwargs)
+
+    def _walk(self, entries=True, where=None):
+        return self.smbpath()._walk(entries=entries, where=where)
+
+    # The SharedFile attributes read by SMBPath, so that an entry can stand
+    # in for the attributes of the SMBPath it is upgraded to.
+    filename = property(lambda self: self.name)
+    file_size = property(lambda self: self.size)
+    file_attributes = property(lambda self: self.attributes)
+    isDirectory = property(isdir)
+    create_time = property(lambda self: self.raw_times[0])
+    last_access_time = property(lambda self: self.raw_times[1])
+    last_write_time = property(lambda self: self.raw_times[2])
+    last_attr_change_time = property(lambda self: self.raw_times[3])
+
+
 class SMBPath(BasePath):
-    MAX_CONNECTION_TIME = 60
 
     def __init__(
             self, path, mode='r', user=None, password=None, api=None,
             clientname=CLIENTNAME, find_dfs_share=find_dfs_share, write_lock=None,
-            timeout=120, _attrs=None,
+            timeout=120, _attrs=None, buffer_size=None, _location=None,
             ):
         #if type(path) == str:
         #    path = path.decode('utf-8')
         self._set_path(path)
         self.find_dfs_share = find_dfs_share
-        server_name, share, domain, relpath = self.find_dfs_share(self.path)
+        if _location is None:
+            _location = self.find_dfs_share(self.path)
+        server_name, share, domain, relpath = _location
         self.server_name = server_name
         self.share = share
         self.relpath = relpath
@@ -536,8 +949,16 @@ class SMBPath(BasePath):
         self.clientname = clientname
         self.timeout = timeout
         self._index = 0
+        self.buffer_size = buffer_size or READ_BUFFER_SIZE
+        # Bytes read ahead of the current position and their file offset
+        self._buffer = b''
+        self._buffer_pos = 0
         self.mode = mode
         self._conn = None
+        self._pool = None
+        self._file = None
+        self._locked = False
+        self._closed = False
         self.WRITELOCK = write_lock
         self._attrs = _attrs
         self.ignore_filenames = SMB_IGNORE_FILENAMES
@@ -557,67 +978,278 @@ class SMBPath(BasePath):
     def tell(self):
         return self._index
 
-    def seek(self, index, *args):
+    def seek(self, index, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            index = self._index + index
+        elif whence == io.SEEK_END:
+            index = self.size + index
+        elif whence != io.SEEK_SET:
+            raise ValueError("Invalid whence ({})".format(whence))
+        if index < 0:
+            raise ValueError("Negative seek position {}".format(index))
         self._index = index
+        return self._index
 
     def read(self, size=-1, conn=None):
+        """
+        Read up to size bytes from the current position, or the rest of the
+        file when size is negative. Reading in pieces keeps the remote file
+        open between calls until close() is called.
+        """
         if size is None:
             size = -1
-        if conn is None:
-            conn = self.get_connection()
+        data = self._read_buffered(size)
+        if size < 0:
+            return data + self._read(-1, conn)
+        if len(data) < size:
+            data += self._read(size - len(data), conn)
+        return data
+
+    def readall(self):
+        return self.read(-1)
+
+    def readinto(self, b, conn=None):
+        """
+        Read up to len(b) bytes into the writable buffer b and return the
+        number of bytes read, 0 at the end of the file. READ responses are
+        copied straight into b, which may be a bytearray, memoryview or mmap.
+        """
+        writer = BufferWriter(b)
+        try:
+            writer.write(self._read_buffered(len(writer)))
+            self._readinto(writer, conn)
+        finally:
+            writer.close()
+        return writer.pos
+
+    def _read_buffered(self, size=-1):
+        # Bytes at the current position already held by the read ahead
+        # buffer, which is dropped when the position has moved outside it.
+        start = self._index - self._buffer_pos
+        if not self._buffer or start < 0 or start >= len(self._buffer):
+            self._buffer = b''
+            return b''
+        if size < 0:
+            end = len(self._buffer)
+        else:
+            end = min(len(self._buffer), start + size)
+        self._index += end - start
+        return self._buffer[start:end]
+
+    def _read(self, size=-1, conn=None):
+        if size == 0:
+            return b''
+        if size > 0:
+            # Read into a buffer of the size the read will have when that is
+            # known, or small enough to allocate up front when it isn't.
+            remaining = self._remaining(conn)
+            if remaining is not None:
+                size = min(size, remaining) or size
+            if remaining or size <= READ_PREALLOCATE:
+                writer = BufferWriter(bytearray(size))
+                try:
+                    self._readinto(writer, conn)
+                    return writer.view[:writer.pos].tobytes()
+                finally:
+                    writer.close()
         fp = io.BytesIO()
-        conn.retrieveFileFromOffset(
-            self.share, self.relpath, fp, self._index, size
+        self._retrieve(fp, size, conn)
+        return fp.getvalue()
+
+    def _remaining(self, conn=None):
+        """
+        The number of bytes after the current position the remote file held
+        open had when last seen, None when no file is held open.
+        """
+        if conn is None and self._file is None and not set(self.mode) & set('wa+'):
+            # _retrieve reads through the handle too
+            self._open_file('r')
+        if conn is None and self._file is not None:
+            return max(0, self._file.file_size - self._index)
+        return None
+
+    def _readinto(self, writer, conn=None):
+        # Fill what is left of writer from the current position.
+        start = writer.pos
+        if start < len(writer):
+            self._retrieve(writer, len(writer) - start, conn)
+        return writer.pos - start
+
+    def _retrieve(self, fp, size=-1, conn=None):
+        """
+        Write up to size bytes from the current position to fp, advancing the
+        position by the number of bytes written.
+        """
+        smbfile = None
+        if conn is None:
+            if self._file is not None:
+                # Read through whichever handle is open, a write handle
+                # would block another open for reading.
+                smbfile = self._open_file(self._file.mode)
+            elif size >= 0 and not set(self.mode) & set('wa+'):
+                smbfile = self._open_file('r')
+        if smbfile is not None:
+            count = smbfile.read(fp, self._index, size)
+        else:
+            with self.connection(conn) as conn:
+                _, count = retrieveFileFromOffset(
+                    conn, self.share, self.relpath, fp, self._index, size,
+                    timeout=self.timeout,
+                )
+        self._index += count
+        return count
+
+    def _get_pool(self, is_direct_tcp):
+        return get_smb_pool(
+            self.server_name, self.domain, self.user, self.password,
+            timeout=self.timeout, client=self.clientname,
+            is_direct_tcp=is_direct_tcp,
         )
-        self._index = self._index + fp.tell()
-        fp.seek(0)
-        return fp.read()
 
-    def get_connection(self):
-        from socket import error
-        if not self._conn:
-            if self._is_direct_tcp is None:
+    def _checkout(self):
+        """
+        Check a connection out of the shared pool for this path's server,
+        returning the pool and the connection.
+        """
+        if self._is_direct_tcp is not None:
+            order = (self._is_direct_tcp, not self._is_direct_tcp)
+        else:
+            order = transportcache.order(
+                '{}.{}'.format(self.server_name, self.domain)
+            )
+        for is_direct_tcp in order[:-1]:
+            try:
+                pool = self._get_pool(is_direct_tcp)
+                conn = pool.acquire()
+                break
+            except socket.error as e:
+                if e.errno not in TRANSPORT_REFUSED_ERRNOS:
+                    raise
+                log.debug(
+                    "Transport %s refused by %s, trying the next one",
+                    transport_port(is_direct_tcp), self.server_name,
+                )
+        else:
+            is_direct_tcp = order[-1]
+            pool = self._get_pool(is_direct_tcp)
+            conn = pool.acquire()
+        self._is_direct_tcp = is_direct_tcp
+        return pool, conn
+
+    @staticmethod
+    def _checkin(pool, conn):
+        """
+        Return a connection to its pool, or close it when it was left in a
+        state another caller can't use.
+        """
+        if connection_reusable(conn):
+            pool.release(conn)
+        else:
+            pool.discard(conn)
+
+    @contextlib.contextmanager
+    def connection(self, conn=None):
+        """
+        Context manager providing a connection for one operation. The given
+        connection or the one pinned by get_connection() is used when there
+        is one, otherwise a connection is checked out of the shared pool and
+        handed back when the block exits.
+        """
+        if conn is None:
+            conn = self._conn
+        if conn is not None:
+            yield conn
+            return
+        pool, conn = self._checkout()
+        try:
+            yield conn
+        finally:
+            self._checkin(pool, conn)
+
+    def _open_file(self, mode='r'):
+        """
+        Return the remote file kept open between calls, opening it for
+        reading ('r') or writing ('w') on first use. A handle open for
+        reading is replaced on the first write. None when the connection
+        doesn't support open handles.
+        """
+        conn = self.get_connection()
+        if self._file is not None and self._file.conn is not conn:
+            # The connection was replaced, the handle went with it.
+            self._file = None
+        if self._file is not None and mode == 'w' and self._file.mode != 'w':
+            smbfile, self._file = self._file, None
+            smbfile.close()
+        if self._file is None and conn.is_using_smb2:
+            if mode == 'w':
+                self._acquire_lock()
                 try:
-                    self._conn = get_smb_connection(
-                        self.server_name, self.domain, self.user, self.password,
-                        timeout=self.timeout, is_direct_tcp = False
+                    self._file = openFile(
+                        conn, self.share, self.relpath, mode='w',
+                        timeout=self.timeout, share_access=FILE_SHARE_READ,
                     )
-                    self._is_direct_tcp = False
-                except error as e:
-                    if e.errno != 61 and e.errno != 104 and e.errno != 111:
-                        raise
-                    self._conn = get_smb_connection(
-                        self.server_name, self.domain, self.user, self.password,
-                        timeout=self.timeout, is_direct_tcp = True
-                    )
-                    self._is_direct_tcp = True
+                except Exception:
+                    self._release_lock()
+                    raise
             else:
-                self._conn = get_smb_connection(
-                    self.server_name, self.domain, self.user, self.password,
-                    timeout=self.timeout, is_direct_tcp=self._is_direct_tcp
+                self._file = openFile(
+                    conn, self.share, self.relpath, timeout=self.timeout
                 )
+        return self._file
 
-            self._conn.timestamp = time.time()
-        elif time.time() - self.MAX_CONNECTION_TIME > self._conn.timestamp:
-            self._conn = get_smb_connection(
-                self.server_name, self.domain, self.user, self.password,
-                timeout=self.timeout, is_direct_tcp=self._is_direct_tcp
-            )
-            self._conn.timestamp = time.time()
+    def _close_file(self):
+        """
+        Close the remote file held open between calls and release the write
+        lock taken when it was opened for writing. The listings of the
+        directory are invalidated once the writes are done.
+        """
+        if self._file is not None:
+            smbfile, self._file = self._file, None
+            try:
+                smbfile.close()
+            except Exception:
+                log.debug("Exception closing %s", self.path, exc_info=True)
+            if smbfile.mode == 'w':
+                self._invalidate_listings()
+        self._release_lock()
+
+    def _acquire_lock(self):
+        if self.WRITELOCK and not self._locked:
+            self.WRITELOCK.acquire(self.server_name, self.share, self.relpath)
+            self._locked = True
+
+    def _release_lock(self):
+        if self._locked:
+            self._locked = False
+            self.WRITELOCK.release(self.server_name, self.share, self.relpath)
+
+    def get_connection(self):
+        """
+        Return a connection pinned to this object until close() is called.
+        Prefer the connection() context manager, which hands the connection
+        back to the pool as soon as the operation is done.
+        """
+        if self._conn is not None and self._conn.sock is None:
+            # The pinned connection was closed, likely by a failed request.
+            self._pool.discard(self._conn)
+            self._conn = None
+        if self._conn is None:
+            self._pool, self._conn = self._checkout()
+            # In use again after close()
+            self._closed = False
         return self._conn
 
     def exists(self, relpath=None):
-        conn = self.get_connection()
-        try:
-            stat = conn.getAttributes(self.share, self.relpath)
-        except OperationFailure:
-            return False
+        with self.connection() as conn:
+            try:
+                stat = conn.getAttributes(self.share, self.relpath)
+            except OperationFailure:
+                return False
         return stat != None
 
     def makedirs(self, relpath=None, is_dir=False, exist_ok=False):
         if not relpath:
             relpath = self.relpath
-        c = self.get_connection()
         if is_dir:
             dirs = relpath.split('\\')
         else:
@@ -626,134 +1258,499 @@ class SMBPath(BasePath):
         if self.WRITELOCK:
             self.WRITELOCK.acquire(self.server_name, self.share, self.relpath)
         try:
-            for a in dirs:
-                path = '{0}\\{1}'.format(path.strip('\\'), a.strip('\\'))
-                if path != self.relpath or exist_ok:
-                    try:
-                        c.listPath(self.share, path, timeout=self.timeout)
-                    except smb.smb_structs.OperationFailure as e:
-                        pass
-                    else:
-                        continue
-                c.createDirectory(self.share, path)
+            with self.connection() as c:
+                for a in dirs:
+                    path = '{0}\\{1}'.format(path.strip('\\'), a.strip('\\'))
+                    if path != self.relpath or exist_ok:
+                        try:
+                            c.listPath(self.share, path, timeout=self.timeout)
+                        except smb.smb_structs.OperationFailure as e:
+                            pass
+                        else:
+                            continue
+                    c.createDirectory(self.share, path)
+                    listingcache.invalidate(self.server_name, self.share, path)
         finally:
             if self.WRITELOCK:
                 self.WRITELOCK.release(self.server_name, self.share, self.relpath)
 
     def write(self, fp):
+        """
+        Write bytes, any other bytes-like object or the contents of a file
+        like object at the current position. Returns the number of bytes
+        written.
+        """
         if not hasattr(fp, 'read'):
-            fp = io.BytesIO(fp)
+            # Send straight out of the caller's buffer instead of copying it
+            # into a BytesIO first.
+            fp = BufferReader(fp)
         if self.mode == 'r':
             raise Exception("File not open for writing")
+        self._buffer = b''
+        smbfile = self._open_file('w')
+        if smbfile is not None:
+            # The file stays open, and the write lock held, until flush() or
+            # close() is called.
+            count = smbfile.write(fp, self._index)
+            self._index += count
+            return count
         if self.WRITELOCK:
             self.WRITELOCK.acquire(self.server_name, self.share, self.relpath)
         try:
-            conn = self.get_connection()
-            storeFileFromOffset(conn, self.share, self.relpath, fp, offset=self._index, timeout=self.timeout)
-            fp.seek(0)
-            self._index = self._index + len(fp.read())
+            with self.connection() as conn:
+                end = storeFileFromOffset(conn, self.share, self.relpath, fp, offset=self._index, timeout=self.timeout)
+            count = end - self._index
+            self._index = end
+            return count
         finally:
+            self._invalidate_listings()
             if self.WRITELOCK:
                 self.WRITELOCK.release(self.server_name, self.share, self.relpath)
 
-    def files(self, glob='*', limit=0, offset=0, recurse=False):
+    def files(self, glob='*', limit=0, offset=0, recurse=False, exclude=None,
+            where=None):
         return self.ls(
             glob=glob, return_dirs=False, limit=limit, offset=offset,
-            recurse=recurse
+            recurse=recurse, exclude=exclude, where=where,
         )
 
-    def filenames(self, glob='*', limit=0, offset=0, recurse=False):
+    def filenames(self, glob='*', limit=0, offset=0, recurse=False, exclude=None,
+            where=None):
         return self.ls_names(
             glob=glob, return_dirs=False, limit=limit, offset=offset,
-            recurse=recurse,
+            recurse=recurse, exclude=exclude, where=where,
         )
 
-    def dirs(self, glob='*', limit=0, offset=0, recurse=False):
+    def dirs(self, glob='*', limit=0, offset=0, recurse=False, exclude=None,
+            where=None):
         return self.ls(
             glob=glob,
             limit=limit,
             offset=offset,
             recurse=recurse,
-            return_files=False
+            return_files=False,
+            exclude=exclude,
+            where=where,
         )
 
-    def dirnames(self, glob='*', limit=0, offset=0, recurse=False):
+    def dirnames(self, glob='*', limit=0, offset=0, recurse=False, exclude=None,
+            where=None):
         return self.ls_names(
             glob=glob,
             limit=limit,
             offset=offset,
             recurse=recurse,
-            return_files=False
+            return_files=False,
+            exclude=exclude,
+            where=where,
         )
 
-    def _walk(self):
+    def _walk(self, entries=False, where=None):
         dirs = []
         files = []
-        for i in self.ls():
-            if i.isdir():
+        # where only applies to the files, every directory is walked
+        for a in self._iter_list(where=where):
+            if entries:
+                i = DirEntry(self, a)
+            else:
+                i = self.join(a.filename, _attrs=a)
+            if a.isDirectory:
                 dirs.append(i)
             else:
                 files.append(i)
         return dirs, files
 
-    def walk(self, top_down=False):
-        dirs, files = self._walk()
-        if top_down:
-            for x in dirs:
-                for _ in x.walk(top_down=top_down):
-                    yield _
-        yield self, dirs, files
-        if top_down:
-            return
-        for x in dirs:
-            for _ in x.walk(top_down=top_down):
+    def walk(
+            self, top_down=False, workers=1, ordered=True, max_pending=None,
+            max_depth=None, entries=False, where=None,
+        ):
+        """
+        Iterate over (dir, dirs, files) tuples for this directory and every
+        directory below it, down to max_depth levels below this one. With
+        more than one worker directories are listed concurrently by a
+        ParallelWalker, see urlio.walk for the options. The connection pool
+        of this path's server is grown to let every worker have a connection.
+
+        With entries dirs and files are lists of DirEntry objects instead of
+        SMBPath objects, as is dir for every directory but this one.
+        Only the files where, an EntryFilter, matches are listed.
+        """
+        if workers > 1:
+            # Every worker checks out a connection of its own, from the pool
+            # of the transport the first connection settles on
+            if self._is_direct_tcp is None:
+                self._checkin(*self._checkout())
+            self._get_pool(self._is_direct_tcp).reserve(workers)
+            walker = ParallelWalker(
+                self, workers=workers, top_down=top_down, ordered=ordered,
+                max_pending=max_pending, max_depth=max_depth, entries=entries,
+                where=where,
+            )
+            for _ in walker:
                 yield _
+            return
+        # An explicit stack of (directory, depth) still to be listed, and of
+        # (listing, depth) waiting for everything below them when top_down.
+        stack = [(self, 0)]
+        while stack:
+            item, depth = stack.pop()
+            if isinstance(item, tuple):
+                yield item
+                continue
+            dirs, files = item._walk(entries=entries, where=where)
+            if top_down:
+                stack.append(((item, dirs, files), depth))
+            else:
+                yield item, dirs, files
+            if max_depth is None or depth < max_depth:
+                stack.extend((x, depth + 1) for x in reversed(dirs))
 
     def close(self):
-        self.get_connection().close()
+        """
+        Close the remote file held open by read() or write() and hand the
+        connection pinned by get_connection() back to the pool.
+        """
+        self._close_file()
+        if self._conn is not None:
+            self._checkin(self._pool, self._conn)
+            self._conn = None
+        self._closed = True
+
+    def __del__(self):
+        # Best effort, the pool or the remote file may already be gone when
+        # this runs during garbage collection or interpreter shutdown.
+        try:
+            if (getattr(self, '_file', None) is not None or
+                    getattr(self, '_conn', None) is not None or
+                    getattr(self, '_locked', False)):
+                self.close()
+        except Exception:
+            pass
+
+    def cursor(self, glob='*', page_size=1000, position=0):
+        """
+        Return a ListingCursor paging through the entries of this directory
+        page_size at a time, starting after the first position entries.
+        """
+        return ListingCursor(
+            self, glob=glob, page_size=page_size, position=position
+        )
+
+    def watch(
+            self, recursive=False, filter=FILE_NOTIFY_CHANGE_DEFAULT,
+            timeout=None, poll=None, interval=5,
+        ):
+        """
+        Iterate over ChangeEvent tuples for the changes to this directory,
+        or anything below it with recursive, as they happen. filter takes
+        the FILE_NOTIFY_CHANGE_xxx bits of the changes to report. Iteration
+        ends after timeout seconds without a change, None waits forever.
+
+        The server sends the changes over a CHANGE_NOTIFY request on a
+        directory handle held open for as long as the iteration goes on.
+        SMB1 servers have no CHANGE_NOTIFY, there, and when poll is True,
+        the directory is listed every interval seconds instead. Polling
+        can't tell renames apart, they are reported as a removal and an
+        addition.
+        """
+        pool, conn = self._checkout()
+        events = None
+        try:
+            if poll is None:
+                poll = not conn.is_using_smb2
+            if poll:
+                events = self._watch_poll(conn, recursive, filter, timeout, interval)
+            else:
+                events = self._watch_notify(conn, recursive, filter, timeout)
+            for event in events:
+                # Listings cached before the change are out of date
+                listingcache.invalidate(
+                    self.server_name, self.share,
+                    u'{0}\\{1}'.format(self.relpath, event.filename or ''),
+                    tree=event.action == CHANGE_OVERFLOW,
+                )
+                yield event
+        finally:
+            if events is not None:
+                # Close the directory before the connection is handed back
+                events.close()
+            SMBPath._checkin(pool, conn)
+
+    def _watch_notify(self, conn, recursive, filter, timeout):
+        smbdir = openDirectory(
+            conn, self.share, self.relpath, timeout=self.timeout
+        )
+        try:
+            last_change = time.time()
+            while True:
+                wait = self.timeout
+                if timeout is not None:
+                    wait = min(wait, last_change + timeout - time.time())
+                    if wait <= 0:
+                        return
+                events = smbdir.notify(recursive, filter, timeout=wait)
+                if events:
+                    last_change = time.time()
+                for event in events:
+                    yield event
+        finally:
+            smbdir.close()
+
+    def _watch_poll(self, conn, recursive, filter, timeout, interval):
+        last_change = time.time()
+        before = self._snapshot(conn, recursive)
+        while True:
+            wait = interval
+            if timeout is not None:
+                wait = min(wait, last_change + timeout - time.time())
+                if wait <= 0:
+                    return
+            time.sleep(wait)
+            after = self._snapshot(conn, recursive)
+            events = []
+            for name in sorted(set(before) | set(after)):
+                old, new = before.get(name), after.get(name)
+                if old is not None and new is not None:
+                    if ((old[1] != new[1] and filter & FILE_NOTIFY_CHANGE_SIZE) or
+                            (old[2] != new[2] and filter & FILE_NOTIFY_CHANGE_LAST_WRITE)):
+                        events.append(ChangeEvent(CHANGE_MODIFIED, name, None))
+                    continue
+                is_dir = (old or new)[0]
+                if is_dir and not filter & FILE_NOTIFY_CHANGE_DIR_NAME:
+                    continue
+                if not is_dir and not filter & FILE_NOTIFY_CHANGE_FILE_NAME:
+                    continue
+                action = CHANGE_ADDED if old is None else CHANGE_REMOVED
+                events.append(ChangeEvent(action, name, None))
+            before = after
+            if events:
+                last_change = time.time()
+            for event in events:
+                yield event
+
+    def _snapshot(self, conn, recursive):
+        # {name relative to this directory: (is directory, size, mtime)}
+        snapshot = {}
+        stack = ['']
+        while stack:
+            relname = stack.pop()
+            for entry in iter_listPath(
+                    conn, self.share,
+                    u'{0}\\{1}'.format(self.relpath, relname).strip('\\'),
+                    timeout=self.timeout, ignore=self.ignore_filenames,
+                ):
+                name = u'{0}\\{1}'.format(relname, entry.filename).lstrip('\\')
+                snapshot[name] = (
+                    entry.isDirectory, entry.file_size, entry.last_write_time,
+                )
+                if recursive and entry.isDirectory:
+                    stack.append(name)
+        return snapshot
+
+    def _iter_list(self, glob='*', begin_at=0, where=None):
+        """
+        Iterate over the raw directory entries of this path, starting with
+        entry begin_at. A connection is held for as long as the iteration is
+        in progress. Complete listings are kept in the listing cache, when
+        it is enabled. Files where, an EntryFilter, doesn't match are
+        dropped as they are decoded, directories are all listed.
+        """
+        cached = listingcache.get(
+            self.server_name, self.share, self.relpath, glob
+        )
+        if cached is not None:
+            if where is not None:
+                cached = [
+                    a for a in cached if a.isDirectory or where.match(a)
+                ]
+            for entry in cached[begin_at:]:
+                yield entry
+            return
+        listed = []
+        with self.connection() as conn:
+            for entry in iter_listPath(
+                    conn,
+                    self.share,
+                    self.relpath,
+                    pattern=glob,
+                    limit=0,
+                    timeout=self.timeout,
+                    begin_at=begin_at,
+                    ignore=self.ignore_filenames,
+                    where=where,
+                ):
+                listed.append(entry)
+                yield entry
+        # A filtered listing is not the directory's listing
+        if not begin_at and where is None:
+            listingcache.set(
+                self.server_name, self.share, self.relpath, glob, listed
+            )
+
+    def _invalidate_listings(self, tree=False):
+        listingcache.invalidate(
+            self.server_name, self.share, self.relpath, tree=tree
+        )
+
+    def _open_listing(self, conns, pattern):
+        """
+        Open this directory for a listing _iter_tree can pause, on the
+        connection to its server in conns, a dict of (pool, connection)
+        tuples the caller checks back in. Returns the SMBDirectory, or None
+        when the listing is cached or the connection has no directory
+        handles (SMB1).
+        """
+        if listingcache.get(self.server_name, self.share, self.relpath, pattern) is not None:
+            return None
+        key = (self.server_name.lower(), self.domain.lower())
+        if key not in conns:
+            conns[key] = self._checkout()
+        _, conn = conns[key]
+        if not conn.is_using_smb2:
+            return None
+        return openDirectory(conn, self.share, self.relpath, timeout=self.timeout)
+
+    def _iter_tree(self, glob, max_depth=None, max_frontier=None, where=None):
+        """
+        Iterate over (parent, entry, path) tuples for the entries below this
+        directory matching glob, a Glob, and where, an EntryFilter, each
+        directory followed by its contents. path is the SMBPath of a directory entry and None for
+        files. Directories nothing below can match aren't listed and only
+        the directories whose subdirectories aren't listed get a pattern
+        sent to the server.
+
+        The entries not handed out yet are kept on an explicit stack. Each
+        directory is held open and listed a response at a time as its
+        entries are handed out, with max_frontier responses are read ahead
+        until max_frontier entries are held. The directories are held open
+        on one connection per server. SMB1 connections have no directory
+        handles, a listing is read in full there and max_frontier doesn't
+        bound it.
+        """
+        # (directory, glob state, depth, entries left to hand out, the open
+        # SMBDirectory, None once the listing is done, the entries listed so
+        # far for the listing cache or None)
+        stack = [(self, glob.start(), 0, None, None, None)]
+        held = 0
+        conns = {}
+        handles = set()
+        try:
+            while stack:
+                parent, state, depth, entries, more, listed = stack.pop()
+                descend = max_depth is None or depth < max_depth
+                pattern = glob.server_pattern(state, descend)
+                if entries is None:
+                    more = parent._open_listing(conns, pattern)
+                    if more is None:
+                        entries = collections.deque(
+                            parent._iter_list(pattern, where=where)
+                        )
+                        held += len(entries)
+                    else:
+                        handles.add(more)
+                        entries = collections.deque()
+                        if listingcache.ttl and not max_frontier and where is None:
+                            listed = []
+                while True:
+                    while more is not None and (
+                            not entries or max_frontier and held < max_frontier):
+                        page = more.query(
+                            pattern, ignore=parent.ignore_filenames,
+                            where=where,
+                        )
+                        if not page:
+                            handles.discard(more)
+                            more.close()
+                            more = None
+                            if listed is not None:
+                                listingcache.set(
+                                    parent.server_name, parent.share,
+                                    parent.relpath, pattern, listed,
+                                )
+                            break
+                        entries.extend(page)
+                        held += len(page)
+                        if listed is not None:
+                            listed.extend(page)
+                    if not entries:
+                        break
+                    entry = entries.popleft()
+                    held -= 1
+                    child = glob.child(state, entry.filename)
+                    if not entry.isDirectory:
+                        if glob.match(child):
+                            yield parent, entry, None
+                        continue
+                    p = None
+                    if glob.match(child) and (where is None or where.match(entry)):
+                        p = parent.join(entry.filename, _attrs=entry)
+                        yield parent, entry, p
+                    if descend and glob.descend(child):
+                        p = p or parent.join(entry.filename, _attrs=entry)
+                        stack.append((parent, state, depth, entries, more, listed))
+                        stack.append((p, child, depth + 1, None, None, None))
+                        break
+        finally:
+            for smbdir in handles:
+                try:
+                    smbdir.close()
+                except Exception:
+                    log.debug("Exception closing %s", smbdir.path, exc_info=True)
+            for pool, conn in conns.values():
+                self._checkin(pool, conn)
 
     def ls(
             self, glob='*', limit=0, offset=0, recurse=False,
-            return_files=True, return_dirs=True, _done=0, _at=-1
+            return_files=True, return_dirs=True, max_depth=None,
+            max_frontier=None, entries=False, exclude=None, where=None,
         ):
         """
         List a directory and return the names of the files and directories.
+        With recurse the contents of each directory follow it, down to
+        max_depth levels below this one, see _iter_tree for max_frontier.
+        With entries DirEntry objects are returned instead of SMBPath
+        objects.
+
+        glob is a pattern or a list of patterns, which may use '**' and
+        braces, entries matching any of the exclude patterns are left out.
+        See urlio.globbing. With recurse a pattern without a directory
+        part matches entries at any depth.
+
+        where, an EntryFilter, restricts the entries returned by size, time
+        and attributes. It is evaluated as the listing is decoded, files it
+        rejects never become objects. Directories it rejects are still
+        descended into.
         """
-        conn = self.get_connection()
-        paths = []
         if not return_files and not return_dirs:
             raise Exception("At lest one return_files or return_dirs must be true")
-        paths = iter_listPath(
-            conn,
-            self.share,
-            self.relpath,
-            pattern=glob,
-            limit=0,
-            timeout=self.timeout,
-            begin_at=0,
-            ignore=self.ignore_filenames,
-        )
-        for a in paths:
-            _at += 1
-            if _at < offset:
+        if recurse:
+            listing = self._iter_tree(
+                Glob.recursive(glob, exclude), max_depth, max_frontier, where
+            )
+        elif Glob.is_plain(glob) and not exclude:
+            listing = (
+                (self, a, None) for a in self._iter_list(glob, where=where)
+                if where is None or not a.isDirectory or where.match(a)
+            )
+        else:
+            listing = self._iter_tree(
+                Glob(glob, exclude), max_depth=0, where=where
+            )
+        done = 0
+        for at, (parent, a, p) in enumerate(listing):
+            if at < offset:
                 continue
-            if limit > 0 and _done >= limit:
-                raise StopIteration
-            if a.isDirectory:
-                p = self.join(a.filename, _attrs=a)
-                if return_dirs:
-                    yield p
-                    _done += 1
-                if recurse:
-                    for _ in p.ls(glob, limit, offset, recurse, return_files,
-                        return_dirs, _done, _at):
-                        yield _
-                        _done += 1
-            elif return_files:
-                yield SMBPath(self.path).join(
-                    a.filename, _attrs=a
-                )
-                _done += 1
+            if limit > 0 and done >= limit:
+                return
+            if a.isDirectory and not return_dirs:
+                continue
+            if not a.isDirectory and not return_files:
+                continue
+            if entries:
+                yield DirEntry(parent, a)
+            else:
+                yield p or parent.join(a.filename, _attrs=a)
+            done += 1
 
     def recurse_files(self, glob='*', limit=0, offset=0):
         return self.filenames(
@@ -767,7 +1764,7 @@ class SMBPath(BasePath):
 
     def ls_names(
             self, glob='*', limit=0, offset=0, recurse=False, return_files=True,
-            return_dirs=True
+            return_dirs=True, exclude=None, where=None,
         ):
         """
         List a directory and return the names of the files and directories.
@@ -775,23 +1772,27 @@ class SMBPath(BasePath):
         for a in self.ls(
                 glob=glob, limit=limit, offset=offset, recurse=recurse,
                 return_files=return_files, return_dirs=return_dirs,
+                exclude=exclude, where=where,
             ):
             yield a.path
 
     def remove(self):
-        conn = self.get_connection()
         if self.WRITELOCK:
             self.WRITELOCK.acquire(self.server_name, self.share, self.relpath)
         if self.isdir():
             try:
-                conn.deleteDirectory(self.share, self.relpath)
+                with self.connection() as conn:
+                    conn.deleteDirectory(self.share, self.relpath)
             finally:
+                self._invalidate_listings(tree=True)
                 if self.WRITELOCK:
                     self.WRITELOCK.release(self.server_name,  self.share, self.relpath)
             return
         try:
-            conn.deleteFiles(self.share, self.relpath)
+            with self.connection() as conn:
+                conn.deleteFiles(self.share, self.relpath)
         finally:
+            self._invalidate_listings()
             if self.WRITELOCK:
                 self.WRITELOCK.release(self.server_name,  self.share, self.relpath)
 
@@ -802,8 +1803,8 @@ class SMBPath(BasePath):
     @property
     def _attrs(self):
         if not self.__attrs:
-            conn = self.get_connection()
-            self.__attrs = conn.getAttributes(self.share, self.relpath)
+            with self.connection() as conn:
+                self.__attrs = conn.getAttributes(self.share, self.relpath)
         return self.__attrs
 
     @_attrs.setter
@@ -856,11 +1857,37 @@ class SMBPath(BasePath):
         return smb_basename(self.relpath)
 
     def join(self, *joins, **kwargs):
+        """
+        Return an SMBPath for a path below this one. The server, share,
+        domain and credentials are taken from this path rather than
+        resolving the new path again, so DFS links below this path are only
+        followed for directory entries listed as reparse points. Create an
+        SMBPath from the full path to follow any other link.
+        """
         p = self
         for joinname in joins:
-            p = SMBPath(p.static_join(p.path, joinname), **kwargs)
+            p = p._child(joinname, **kwargs)
         return p
 
+    def _child(self, name, **kwargs):
+        attrs = kwargs.get('_attrs')
+        if attrs is not None and attrs.file_attributes & ATTR_REPARSE_POINT:
+            # A DFS link, its target has to be resolved
+            kwargs['_location'] = None
+        else:
+            kwargs['_location'] = (
+                self.server_name, self.share, self.domain,
+                u'{0}\\{1}'.format(
+                    self.relpath.rstrip('\\'), name.strip('\\')
+                ).lstrip('\\'),
+            )
+        kwargs.setdefault('user', self.user)
+        kwargs.setdefault('password', self.password)
+        kwargs.setdefault('clientname', self.clientname)
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('find_dfs_share', self.find_dfs_share)
+        return SMBPath(self.static_join(self.path, name), **kwargs)
+
     @staticmethod
     def static_join(dirname, basename):
         return u"{0}\\{1}".format(
@@ -868,20 +1895,38 @@ class SMBPath(BasePath):
             basename.lstrip('\\')
         )
 
-    def readline(self):
-        size = 1024
-        start_pos = self.tell()
-        while True:
-            chunk = self.read(size)
-            if not chunk:
-                break
-            if chunk.find('\n') != -1:
+    def readline(self, size=-1):
+        """
+        Read and return one line, including the trailing newline, from the
+        current position. The file is read ahead buffer_size bytes at a time
+        so each line costs no more than a scan of the buffer.
+        """
+        if size is None:
+            size = -1
+        chunks = []
+        found = 0
+        while size < 0 or found < size:
+            start = self._index - self._buffer_pos
+            if not self._buffer or start < 0 or start >= len(self._buffer):
+                self._buffer_pos = self._index
+                self._buffer = self._read(self.buffer_size)
+                self._index = self._buffer_pos
+                if not self._buffer:
+                    break
+                start = 0
+            end = self._buffer.find(b'\n', start)
+            if end == -1:
+                end = len(self._buffer)
+            else:
+                end += 1
+            if size >= 0:
+                end = min(end, start + size - found)
+            chunks.append(self._buffer[start:end])
+            found += end - start
+            self._index = self._buffer_pos + end
+            if chunks[-1].endswith(b'\n'):
                 break
-        if chunk.find('\n') == -1:
-            return
-        line = chunk[:chunk.find('\n') + 1]
-        self.seek(start_pos + len(line))
-        return line
+        return b''.join(chunks)
 
     def readlines(self):
         line = self.readline()
@@ -889,6 +1934,28 @@ class SMBPath(BasePath):
             yield line
             line = self.readline()
 
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    next = __next__
+
+    def flush(self):
+        """
+        Close the remote file if it is open for writing, releasing the write
+        lock. The next write opens it again.
+        """
+        if self._file is not None and self._file.mode == 'w':
+            self._close_file()
+
+    def isatty(self):
+        return False
+
     def isdir(self):
         return self._attrs.isDirectory
 
@@ -896,11 +1963,17 @@ class SMBPath(BasePath):
         newp = SMBPath(newname)
         if newp.server_name != self.server_name or newp.share != self.share:
             raise Exception("Can only rename on the same server and share")
-        c = self.get_connection()
-        c.rename(self.share, self.relpath, newp.relpath)
+        try:
+            with self.connection() as c:
+                c.rename(self.share, self.relpath, newp.relpath)
+        finally:
+            self._invalidate_listings(tree=True)
+            newp._invalidate_listings(tree=True)
         self.relpath = newp.relpath
 
     def rmtree(self):
+        # Don't walk listings cached before the tree changed
+        self._invalidate_listings(tree=True)
         for _, dirs, files in self.walk(top_down=True):
             for d in dirs:
                 if d.exists():
@@ -921,6 +1994,112 @@ class SMBPath(BasePath):
 
     @property
     def closed(self):
-        if self.get_connection().sock is None:
-            return True
-        return False
+        return self._closed
+
+
+class ListingCursor(object):
+    """
+    Page through the entries of a large directory. Unlike ls(offset=...),
+    which lists the directory again from the start for every page, the
+    directory is held open on a connection of the cursor's own between
+    pages and every page continues where the last one stopped.
+
+    position is the number of entries handed out so far. A cursor created
+    with that position resumes the listing, skipping those entries once.
+    SMB1 connections have no directory handles, each page is listed from
+    the position reached instead.
+    """
+
+    def __init__(self, path, glob='*', page_size=1000, position=0):
+        self.path = path
+        self.glob = glob
+        self.page_size = page_size
+        self.position = position
+        self.done = False
+        self._skip = position
+        # Entries fetched from the server, including the skipped ones
+        self._listed = 0
+        self._entries = collections.deque()
+        self._pool = None
+        self._conn = None
+        self._dir = None
+
+    def __iter__(self):
+        page = self.next_page()
+        while page:
+            yield page
+            page = self.next_page()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        try:
+            if getattr(self, '_conn', None) is not None:
+                self.close()
+        except Exception:
+            pass
+
+    def next_page(self):
+        """
+        Return a list of up to page_size SMBPath objects, an empty list once
+        every entry has been handed out.
+        """
+        page = []
+        while len(page) < self.page_size:
+            if not self._entries:
+                if self.done:
+                    break
+                self._fetch()
+                continue
+            entry = self._entries.popleft()
+            if self._skip:
+                self._skip -= 1
+                continue
+            page.append(self.path.join(entry.filename, _attrs=entry))
+        self.position += len(page)
+        if self.done and not self._entries:
+            # Hand the connection back as soon as the listing is done
+            self.close()
+        return page
+
+    def _fetch(self):
+        if self._conn is None:
+            self._pool, self._conn = self.path._checkout()
+        conn = self._conn
+        ignore = self.path.ignore_filenames
+        if conn.is_using_smb2:
+            if self._dir is None:
+                self._dir = openDirectory(
+                    conn, self.path.share, self.path.relpath,
+                    timeout=self.path.timeout,
+                )
+            entries = self._dir.query(self.glob, ignore=ignore)
+        else:
+            self._listed, self._skip = self._listed + self._skip, 0
+            entries = list(iter_listPath(
+                conn, self.path.share, self.path.relpath, pattern=self.glob,
+                limit=self.page_size, timeout=self.path.timeout,
+                begin_at=self._listed, ignore=ignore,
+            ))
+        if not entries:
+            self.done = True
+        self._listed += len(entries)
+        self._entries.extend(entries)
+
+    def close(self):
+        """
+        Close the directory handle and hand the connection back to the pool.
+        """
+        if self._dir is not None:
+            smbdir, self._dir = self._dir, None
+            try:
+                smbdir.close()
+            except Exception:
+                log.debug("Exception closing %s", self.path, exc_info=True)
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            SMBPath._checkin(self._pool, conn)
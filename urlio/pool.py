@@ -0,0 +1,334 @@
+"""
+Connection pooling for urlio.
+
+Every SMBPath and SMBUrl used to open (and authenticate) its own connection.
+The pools in this module let all objects pointing at the same server share a
+small set of authenticated sessions. Connections are checked out for the
+duration of an operation and handed back afterwards.
+"""
+from __future__ import absolute_import
+import logging
+import threading
+import time
+
+from .base import UrlIOException
+
+log = logging.getLogger(__name__)
+
+
+class PoolTimeout(UrlIOException):
+    "Raised when no connection could be checked out of a pool in time"
+
+
+class ConnectionPool(object):
+    """
+    A bounded pool of connections created by calling *factory*.
+
+    - min_size: idle connections are never evicted below this many
+    - max_size: maximum number of open connections, checked out or idle
+      (0 means unbounded)
+    - idle_timeout: seconds a connection may sit idle before it is closed
+    - max_lifetime: seconds after which a connection is retired and closed
+      instead of being reused (None keeps connections forever)
+    - ping: callable used to check that an idle connection is still alive;
+      it returns False or raises when the connection is dead
+    - ping_after: seconds a connection must have been idle before ping is
+      called on checkout
+    - wait_timeout: seconds acquire() waits for a connection when the pool is
+      exhausted before raising PoolTimeout (None waits forever)
+    """
+
+    def __init__(
+            self, factory, min_size=0, max_size=10, idle_timeout=300,
+            max_lifetime=None, ping=None, ping_after=30, wait_timeout=30,
+        ):
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.ping = ping
+        self.ping_after = ping_after
+        self.wait_timeout = wait_timeout
+        # Idle connections as (conn, released_at) tuples, oldest first. The
+        # most recently used connection is handed out first so the warmest
+        # sessions get reused and the cold ones age out.
+        self._idle = []
+        self._size = 0
+        # Creation time of every open connection keyed by id()
+        self._created = {}
+        self._cond = threading.Condition(threading.Lock())
+        self._counters = {
+            'created': 0,
+            'reused': 0,
+            'released': 0,
+            'discarded': 0,
+            'evicted': 0,
+            'retired': 0,
+            'pings': 0,
+            'ping_failures': 0,
+            'waits': 0,
+            'timeouts': 0,
+        }
+
+    def acquire(self, timeout=None):
+        """
+        Check a connection out of the pool, creating a new one when no idle
+        connection is available and the pool is not full.
+        """
+        if timeout is None:
+            timeout = self.wait_timeout
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            conn, released_at = self._take(timeout, deadline)
+            if conn is None:
+                return self._create()
+            if self._expired(conn):
+                self._retire(conn)
+                continue
+            if (self.ping is not None and self.ping_after is not None and
+                    time.time() - released_at >= self.ping_after and
+                    not self._ping(conn)):
+                continue
+            with self._cond:
+                self._counters['reused'] += 1
+            return conn
+
+    def _take(self, timeout, deadline):
+        """
+        Pop the most recently released idle connection. When there is none
+        and the pool is not full a slot is reserved for a new connection and
+        (None, None) is returned.
+        """
+        with self._cond:
+            self._evict_idle()
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+                if self.max_size <= 0 or self._size < self.max_size:
+                    # Reserve the slot now, connect outside of the lock.
+                    self._size += 1
+                    return None, None
+                self._counters['waits'] += 1
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    raise PoolTimeout(
+                        "No connection available after {} seconds".format(timeout)
+                    )
+                self._cond.wait(remaining)
+
+    def release(self, conn):
+        """
+        Hand a checked out connection back to the pool.
+        """
+        if getattr(conn, 'sock', True) is None:
+            # Closed while checked out, nothing to keep.
+            self.discard(conn)
+            return
+        if self._expired(conn):
+            self._retire(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._counters['released'] += 1
+            self._evict_idle()
+            self._cond.notify()
+
+    def discard(self, conn):
+        """
+        Close a checked out connection instead of returning it to the pool.
+        """
+        self._forget(conn, 'discarded')
+
+    def reserve(self, count):
+        """
+        Raise max_size so count more connections can be checked out on top
+        of the ones in use now. An unbounded pool is left alone.
+        """
+        with self._cond:
+            if self.max_size <= 0:
+                return
+            in_use = self._size - len(self._idle)
+            if self.max_size < in_use + count:
+                log.debug(
+                    "Growing pool from %s to %s connections",
+                    self.max_size, in_use + count,
+                )
+                self.max_size = in_use + count
+                self._cond.notify_all()
+
+    def fill(self):
+        """
+        Open connections until at least min_size are held by the pool.
+        """
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            conn = self._create()
+            with self._cond:
+                self._idle.insert(0, (conn, time.time()))
+                self._cond.notify()
+
+    def clear(self):
+        """
+        Close every idle connection held by the pool.
+        """
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            for conn, _ in idle:
+                self._created.pop(id(conn), None)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            _close(conn)
+
+    def stats(self):
+        """
+        Return a dictionary of counters describing the pool's activity.
+        """
+        with self._cond:
+            stats = dict(self._counters)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+        return stats
+
+    def _create(self):
+        # The caller must already have reserved a slot in self._size.
+        try:
+            conn = self.factory()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._counters['created'] += 1
+            self._created[id(conn)] = time.time()
+        return conn
+
+    def _expired(self, conn):
+        if not self.max_lifetime:
+            return False
+        created = self._created.get(id(conn))
+        return created is not None and time.time() - created >= self.max_lifetime
+
+    def _retire(self, conn):
+        self._forget(conn, 'retired')
+
+    def _ping(self, conn):
+        """
+        Check an idle connection before handing it out, closing it when the
+        check fails.
+        """
+        with self._cond:
+            self._counters['pings'] += 1
+        try:
+            alive = self.ping(conn) is not False
+        except Exception:
+            log.debug("Pooled connection failed liveness check", exc_info=True)
+            alive = False
+        if not alive:
+            with self._cond:
+                self._counters['ping_failures'] += 1
+            self.discard(conn)
+        return alive
+
+    def _forget(self, conn, reason):
+        # Close a connection that is not in the idle list and free its slot.
+        _close(conn)
+        with self._cond:
+            self._size -= 1
+            self._created.pop(id(conn), None)
+            self._counters[reason] += 1
+            self._cond.notify()
+
+    def _evict_idle(self):
+        # Must be called with self._cond held.
+        if not self.idle_timeout:
+            return
+        expires = time.time() - self.idle_timeout
+        while self._idle and self._size > self.min_size:
+            conn, released_at = self._idle[0]
+            if released_at > expires:
+                break
+            self._idle.pop(0)
+            self._size -= 1
+            self._created.pop(id(conn), None)
+            self._counters['evicted'] += 1
+            _close(conn)
+
+
+class PoolManager(object):
+    """
+    Process wide registry of connection pools. Pools are created on demand
+    for each key using the manager's default pool options.
+    """
+
+    def __init__(self, **defaults):
+        self.defaults = defaults
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, factory, **options):
+        """
+        Return the pool for *key*, creating it with *factory* if needed.
+        Extra options override the manager's defaults for a new pool.
+        """
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                kwargs = dict(self.defaults)
+                kwargs.update(options)
+                pool = ConnectionPool(factory, **kwargs)
+                self._pools[key] = pool
+        return pool
+
+    def configure(self, **options):
+        """
+        Update the default pool options and apply them to existing pools.
+        """
+        with self._lock:
+            self.defaults.update(options)
+            pools = list(self._pools.values())
+        for pool in pools:
+            for name, value in options.items():
+                setattr(pool, name, value)
+
+    def stats(self):
+        """
+        Return the statistics of every pool keyed by the pool's key.
+        """
+        with self._lock:
+            pools = list(self._pools.items())
+        return dict((key, pool.stats()) for key, pool in pools)
+
+    def clear(self):
+        """
+        Close all idle connections and forget every pool.
+        """
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.clear()
+
+
+def _close(conn):
+    try:
+        conn.close()
+    except Exception:
+        log.debug("Exception closing pooled connection", exc_info=True)
+
+
+POOLS = PoolManager(
+    min_size=0, max_size=10, idle_timeout=300, max_lifetime=3600,
+    ping_after=30, wait_timeout=30,
+)
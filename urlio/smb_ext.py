@@ -3,13 +3,16 @@ Override pysmb's listPath method to be able to limit the number of
 results returned.
 """
 from smb.base import (
-    _PendingRequest, SharedFile, NotConnectedError, NotReadyError
+    _PendingRequest, SharedFile, NotConnectedError, NotReadyError, SMBTimeout
 )
 from smb.smb_constants import *
-from collections import deque
+from collections import deque, namedtuple
 from smb.smb_structs import *
 from smb.smb2_structs import *
 import binascii
+import calendar
+import datetime
+from codecs import utf_16_le_decode
 
 DFLTSEARCH = (
     SMB_FILE_ATTRIBUTE_READONLY |
@@ -19,14 +22,170 @@ DFLTSEARCH = (
     SMB_FILE_ATTRIBUTE_ARCHIVE
 )
 
+# Number of SMB2 requests kept in flight by the pipelined engines. The
+# window never grows past the credits granted by the server.
+WINDOW = 16
+
+# Credits asked for with every pipelined request. pysmb asks for none, which
+# leaves a session with a single credit on most servers.
+CREDIT_REQUEST = 64
+
+# QUERY_DIRECTORY flag starting a listing over from the first entry
+SMB2_RESTART_SCANS = 0x01
+
+# CHANGE_NOTIFY flag reporting changes anywhere below the directory
+SMB2_WATCH_TREE = 0x0001
+# The watch was cancelled by closing the directory
+STATUS_NOTIFY_CLEANUP = 0x0000010B
+# More changes happened than fit the response, they have to be listed
+STATUS_NOTIFY_ENUM_DIR = 0x0000010C
+
+# CHANGE_NOTIFY completion filter bits. See [MS-SMB2]: 2.2.35
+FILE_NOTIFY_CHANGE_FILE_NAME = 0x00000001
+FILE_NOTIFY_CHANGE_DIR_NAME = 0x00000002
+FILE_NOTIFY_CHANGE_ATTRIBUTES = 0x00000004
+FILE_NOTIFY_CHANGE_SIZE = 0x00000008
+FILE_NOTIFY_CHANGE_LAST_WRITE = 0x00000010
+FILE_NOTIFY_CHANGE_LAST_ACCESS = 0x00000020
+FILE_NOTIFY_CHANGE_CREATION = 0x00000040
+FILE_NOTIFY_CHANGE_SECURITY = 0x00000100
+FILE_NOTIFY_CHANGE_DEFAULT = (
+    FILE_NOTIFY_CHANGE_FILE_NAME |
+    FILE_NOTIFY_CHANGE_DIR_NAME |
+    FILE_NOTIFY_CHANGE_SIZE |
+    FILE_NOTIFY_CHANGE_LAST_WRITE
+)
+
+# Actions of ChangeEvent
+CHANGE_ADDED = 'added'
+CHANGE_REMOVED = 'removed'
+CHANGE_MODIFIED = 'modified'
+CHANGE_RENAMED = 'renamed'
+# Changes were lost, the directory has to be listed again
+CHANGE_OVERFLOW = 'overflow'
+
+# FILE_NOTIFY_INFORMATION actions. See [MS-FSCC]: 2.4.42
+FILE_ACTIONS = {
+    0x01: CHANGE_ADDED,
+    0x02: CHANGE_REMOVED,
+    0x03: CHANGE_MODIFIED,
+}
+FILE_ACTION_RENAMED_OLD_NAME = 0x04
+FILE_ACTION_RENAMED_NEW_NAME = 0x05
+
+# filename is relative to the directory watched, old_filename is only set
+# for renames.
+ChangeEvent = namedtuple('ChangeEvent', ('action', 'filename', 'old_filename'))
+
+
 class Results(deque):
     def __init__(self, *args, **kwargs):
         super(Results, self).__init__(*args, **kwargs)
         self.at = 0
 
+
+class CreditedSMB2Message(SMB2Message):
+    """
+    SMB2Message which asks the server for CREDIT_REQUEST credits so more
+    than one request can be outstanding.
+    """
+
+    def encode(self):
+        data = SMB2Message.encode(self)
+        # CreditRequest is the 16 bit field at offset 14 of the header
+        return data[:14] + struct.pack('<H', CREDIT_REQUEST) + data[16:]
+
+
+class CreditWindow(object):
+    """
+    Keep track of the requests in flight for one pipelined operation.
+    Credits are a lower bound of what the server has granted: we start with
+    the single credit every session holds, spend one per request and add
+    what each final response grants. pysmb keeps interim STATUS_PENDING
+    responses to itself, the credits they grant aren't counted.
+    """
+
+    def __init__(self, window=None):
+        if window is None:
+            window = WINDOW
+        self.window = max(1, window)
+        self.credits = 1
+        self.in_flight = 0
+
+    def available(self):
+        return max(0, min(self.window - self.in_flight, self.credits))
+
+    def sent(self):
+        self.credits -= 1
+        self.in_flight += 1
+
+    def received(self, message):
+        self.credits += message.credit_re
+        self.in_flight -= 1
+
+
+class BufferReader(object):
+    """
+    File-like reader over a bytes-like object. Blocks are sliced out of a
+    memoryview so only the block being sent is ever copied.
+    """
+
+    def __init__(self, data):
+        view = memoryview(data)
+        if view.itemsize != 1 or view.ndim != 1:
+            view = view.cast('B')
+        self.view = view
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.view)
+
+    def read(self, size=-1):
+        start = self.pos
+        if size is None or size < 0:
+            end = len(self.view)
+        else:
+            end = min(len(self.view), start + size)
+        self.pos = end
+        return self.view[start:end].tobytes()
+
+
+class BufferWriter(object):
+    """
+    File-like writer filling a writable buffer such as a bytearray,
+    memoryview or mmap in place. pos is the number of bytes written.
+    """
+
+    def __init__(self, buf):
+        view = memoryview(buf)
+        if view.itemsize != 1 or view.ndim != 1:
+            view = view.cast('B')
+        if view.readonly:
+            raise TypeError('buffer is read only')
+        self.view = view
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.view)
+
+    def write(self, data):
+        end = self.pos + len(data)
+        if end > len(self.view):
+            raise ValueError('buffer is full')
+        self.view[self.pos:end] = data
+        self.pos = end
+        return len(data)
+
+    def close(self):
+        # The read callbacks form a reference cycle holding on to this
+        # writer. Release the view now so an mmap can be closed right away.
+        if hasattr(self.view, 'release'):
+            self.view.release()
+
 def listPath(conn, service_name, path,
              search = DFLTSEARCH,
-             pattern = '*', timeout = 30, limit=0, begin_at=0, ignore=None):
+             pattern = '*', timeout = 30, limit=0, begin_at=0, ignore=None,
+             where=None):
     """
     Retrieve a directory listing of files/folders at *path*
 
@@ -35,6 +194,7 @@ def listPath(conn, service_name, path,
     :param integer search: integer value made up from a bitwise-OR of *SMB_FILE_ATTRIBUTE_xxx* bits (see smb_constants.py).
                            The default *search* value will query for all read-only, hidden, system, archive files and directories.
     :param string/unicode pattern: the filter to apply to the results before returning to the client.
+    :param where: an EntryFilter the files listed must match.
     :return: A list of :doc:`smb.base.SharedFile<smb_SharedFile>` instances.
     """
     if not conn.sock:
@@ -56,13 +216,13 @@ def listPath(conn, service_name, path,
             _listPath_SMB2(
                 conn, service_name, path, cb, eb, search = search,
                 pattern = pattern, timeout = timeout, limit=limit,
-                begin_at=begin_at, ignore=ignore
+                begin_at=begin_at, ignore=ignore, where=where,
             )
         else:
             _listPath_SMB1(
                 conn, service_name, path, cb, eb, search = search,
                 pattern = pattern, timeout = timeout, limit=limit,
-                begin_at=begin_at, ignore=ignore
+                begin_at=begin_at, ignore=ignore, where=where,
             )
         while conn.is_busy:
             conn._pollForNetBIOSPacket(timeout)
@@ -101,9 +261,220 @@ def getDfsReferral(conn, service_name, path, timeout = 30):
     return results
 
 
+# FileBothDirectoryInformation structure. See [MS-FSCC]: 2.4.8
+BOTH_DIRECTORY_INFO = struct.Struct('<IIQQQQQQIIIBB24s')
+
+
+def _filetime(index):
+    return property(lambda self: convertFILETIMEtoEpoch(self.raw_times[index]))
+
+
+class LazySharedFile(SharedFile, object):
+    """
+    SharedFile decoded from a directory listing. Timestamps are kept as the
+    FILETIME values sent by the server and only converted when read, most
+    listings never look at them.
+    """
+
+    create_time = _filetime(0)
+    last_access_time = _filetime(1)
+    last_write_time = _filetime(2)
+    last_attr_change_time = _filetime(3)
+
+    def __init__(self, create_time, last_access_time, last_write_time, last_attr_change_time, file_size, alloc_size, file_attributes, short_name, filename, file_id = None):
+        # SharedFile.__init__ would assign over the timestamp properties
+        self.raw_times = (create_time, last_access_time, last_write_time, last_attr_change_time)
+        self.file_size = file_size
+        self.alloc_size = alloc_size
+        self.file_attributes = file_attributes
+        self.raw_short_name = short_name
+        self.filename = filename
+        self.file_id = file_id
+
+    @property
+    def short_name(self):
+        return self.raw_short_name.decode('UTF-16LE')
+
+
+# Seconds from 1601-01-01, the start of FILETIME, to the epoch
+FILETIME_EPOCH_OFFSET = 11644473600
+
+
+def _toFiletime(value):
+    "Return the FILETIME for an epoch timestamp or a naive UTC datetime"
+    if isinstance(value, datetime.datetime):
+        value = calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+    return int((value + FILETIME_EPOCH_OFFSET) * 10000000)
+
+
+class EntryFilter(object):
+    """
+    Predicates on the size, timestamps and attributes of directory entries,
+    evaluated on the values decoded from a listing response before an entry
+    object is built. Entries left out cost next to nothing.
+
+    Sizes are inclusive bounds. Times are epoch timestamps or naive UTC
+    datetimes, like SMBPath.mtime, and converted to FILETIME once: the
+    *_before bounds are exclusive and the *_after ones inclusive. Entries
+    must have every bit of attributes and none of exclude_attributes set.
+
+    Listings only apply the predicates to files, directories are always
+    decoded so that they can be walked. Use match() on them.
+    """
+
+    def __init__(
+            self, min_size=None, max_size=None, mtime_before=None,
+            mtime_after=None, ctime_before=None, ctime_after=None,
+            attributes=0, exclude_attributes=0,
+        ):
+        inf = float('inf')
+        self.min_size = min_size or 0
+        self.max_size = inf if max_size is None else max_size
+        self.mtime_before = inf if mtime_before is None else _toFiletime(mtime_before)
+        self.mtime_after = 0 if mtime_after is None else _toFiletime(mtime_after)
+        self.ctime_before = inf if ctime_before is None else _toFiletime(ctime_before)
+        self.ctime_after = 0 if ctime_after is None else _toFiletime(ctime_after)
+        self.attributes = attributes
+        self.exclude_attributes = exclude_attributes
+
+    def check(self, file_size, file_attributes, create_time, last_write_time):
+        "True when an entry with these raw values, FILETIME times, matches"
+        return (
+            self.min_size <= file_size <= self.max_size and
+            self.mtime_after <= last_write_time < self.mtime_before and
+            self.ctime_after <= create_time < self.ctime_before and
+            file_attributes & self.attributes == self.attributes and
+            not file_attributes & self.exclude_attributes
+        )
+
+    def accept(self, file_size, file_attributes, create_time, last_write_time):
+        "check() for files, directories are always accepted"
+        if file_attributes & ATTR_DIRECTORY:
+            return True
+        return self.check(file_size, file_attributes, create_time, last_write_time)
+
+    def match(self, entry):
+        "check() for a SharedFile or DirEntry"
+        raw_times = getattr(entry, 'raw_times', None)
+        if raw_times is None:
+            raw_times = (entry.create_time, None, entry.last_write_time)
+        create_time, last_write_time = raw_times[0], raw_times[2]
+        # SMB1 listings and pysmb's SharedFile hold epoch timestamps
+        if isinstance(create_time, float):
+            create_time = _toFiletime(create_time)
+        if isinstance(last_write_time, float):
+            last_write_time = _toFiletime(last_write_time)
+        return self.check(
+            entry.file_size, entry.file_attributes, create_time, last_write_time
+        )
+
+
+def _decodeQueryDirectory(data_bytes, ignore = (), where = None):
+    """
+    Decode the FileBothDirectoryInformation entries of a QUERY_DIRECTORY
+    response. Returns a list of LazySharedFile instances and the bytes of
+    an incomplete trailing entry. Files where, an EntryFilter, doesn't
+    accept are left out.
+    """
+    # Entries are unpacked in place, only the file names are copied out.
+    view = memoryview(data_bytes)
+    unpack_from = BOTH_DIRECTORY_INFO.unpack_from
+    info_size = BOTH_DIRECTORY_INFO.size
+
+    entries = [ ]
+    data_length = len(view)
+    offset = 0
+    while offset < data_length:
+        if offset + info_size > data_length:
+            return entries, view[offset:].tobytes()
+
+        next_offset, _, \
+        create_time, last_access_time, last_write_time, last_attr_change_time, \
+        file_size, alloc_size, file_attributes, filename_length, ea_size, \
+        short_name_length, _, short_name = unpack_from(view, offset)
+
+        offset2 = offset + info_size
+        if offset2 + filename_length > data_length:
+            return entries, view[offset:].tobytes()
+
+        # Rejected entries don't even get their name decoded
+        if where is None or where.accept(file_size, file_attributes, create_time, last_write_time):
+            filename = utf_16_le_decode(view[offset2:offset2+filename_length])[0]
+            if filename not in ignore:
+                entries.append(LazySharedFile(create_time, last_access_time, last_write_time, last_attr_change_time,
+                                              file_size, alloc_size, file_attributes, short_name, filename))
+        if next_offset:
+            offset += next_offset
+        else:
+            break
+    return entries, b''
+
+
+# FILE_NOTIFY_INFORMATION structure. See [MS-FSCC]: 2.4.42
+NOTIFY_INFORMATION = struct.Struct('<III')
+
+
+def _decodeNotifyInformation(data_bytes):
+    """
+    Decode the FILE_NOTIFY_INFORMATION entries of a CHANGE_NOTIFY response
+    into a list of ChangeEvent tuples. The old and new name entries of a
+    rename are merged into one event.
+    """
+    view = memoryview(data_bytes)
+    events = [ ]
+    old_filename = None
+    offset = 0
+    while offset + NOTIFY_INFORMATION.size <= len(view):
+        next_offset, action, filename_length = NOTIFY_INFORMATION.unpack_from(view, offset)
+        offset2 = offset + NOTIFY_INFORMATION.size
+        filename = utf_16_le_decode(view[offset2:offset2+filename_length])[0]
+        if action == FILE_ACTION_RENAMED_OLD_NAME:
+            old_filename = filename
+        elif action == FILE_ACTION_RENAMED_NEW_NAME:
+            events.append(ChangeEvent(CHANGE_RENAMED, filename, old_filename))
+            old_filename = None
+        elif action in FILE_ACTIONS:
+            events.append(ChangeEvent(FILE_ACTIONS[action], filename, None))
+        if not next_offset:
+            break
+        offset += next_offset
+    return events
+
+
+class SMB2ChangeNotifyRequest(Structure):
+    """
+    References:
+    ===========
+    - [MS-SMB2]: 2.2.35
+    """
+
+    STRUCTURE_FORMAT = "<HHI16sII"
+    STRUCTURE_SIZE = struct.calcsize(STRUCTURE_FORMAT)
+
+    def __init__(self, fid, completion_filter, flags, output_buf_len):
+        self.fid = fid
+        self.completion_filter = completion_filter
+        self.flags = flags
+        self.output_buf_len = output_buf_len
+
+    def initMessage(self, message):
+        Structure.initMessage(self, message)
+        message.command = SMB2_COM_CHANGE_NOTIFY
+
+    def prepare(self, message):
+        message.data = struct.pack(self.STRUCTURE_FORMAT,
+                                   32,  # Structure size. Must be 32 as mandated by [MS-SMB2] 2.2.35
+                                   self.flags,
+                                   self.output_buf_len,
+                                   self.fid,
+                                   self.completion_filter,
+                                   0)   # Reserved
+
+
 def _listPath_SMB2(
         conn, service_name, path, callback, errback, search, pattern,
-        timeout=30, limit=0, begin_at=0, ignore=None
+        timeout=30, limit=0, begin_at=0, ignore=None, where=None,
+        results=None,
     ):
     if not conn.has_authenticated:
         raise NotReadyError('SMB connection not authenticated')
@@ -115,7 +486,10 @@ def _listPath_SMB2(
     if path.endswith('\\'):
         path = path[:-1]
     messages_history = [ ]
-    results = Results()
+    if results is None:
+        # Entries are appended to the caller's results as they are decoded
+        # when one is given, which lets iter_listPath stream them.
+        results = Results()
     if not ignore:
         ignore = []
     def sendCreate(tid):
@@ -143,7 +517,7 @@ def _listPath_SMB2(
     def createCB(create_message, **kwargs):
         messages_history.append(create_message)
         if create_message.status == 0:
-            sendQuery(create_message.tid, create_message.payload.fid, '')
+            sendQuery(create_message.tid, create_message.payload.fid, b'')
         else:
             errback(OperationFailure('Failed to list %s on %s: Unable to open directory' % ( path, service_name ), messages_history))
 
@@ -160,10 +534,10 @@ def _listPath_SMB2(
     def queryCB(query_message, **kwargs):
          messages_history.append(query_message)
          if query_message.status == 0:
-             data_buf = decodeQueryStruct(
-                 kwargs['data_buf'].encode('utf-8') + query_message.payload.data,
-                 query_message.tid, kwargs['fid']
-             )
+             data = query_message.payload.data
+             if kwargs['data_buf']:
+                 data = kwargs['data_buf'] + data
+             data_buf = decodeQueryStruct(data, query_message.tid, kwargs['fid'])
              if data_buf is False:
                  closeFid(query_message.tid, kwargs['fid'], results = results)
              else:
@@ -174,45 +548,14 @@ def _listPath_SMB2(
              closeFid(query_message.tid, kwargs['fid'], error = query_message.status)
 
     def decodeQueryStruct(data_bytes, tid, fid):
-        # SMB_FIND_FILE_BOTH_DIRECTORY_INFO structure. See [MS-CIFS]: 2.2.8.1.7 and [MS-SMB]: 2.2.8.1.1
-        info_format = '<IIQQQQQQIIIBB24s'
-        info_size = struct.calcsize(info_format)
-
-        data_length = len(data_bytes)
-        offset = 0
-        while offset < data_length:
-            if offset + info_size > data_length:
-                return data_bytes[offset:]
-
-            next_offset, _, \
-            create_time, last_access_time, last_write_time, last_attr_change_time, \
-            file_size, alloc_size, file_attributes, filename_length, ea_size, \
-            short_name_length, _, short_name = struct.unpack(info_format, data_bytes[offset:offset+info_size])
-
-            offset2 = offset + info_size
-            if offset2 + filename_length > data_length:
-                return data_bytes[offset:]
-
-            filename = data_bytes[offset2:offset2+filename_length].decode('UTF-16LE')
-            if filename in ignore:
-                if next_offset:
-                    offset += next_offset
-                    continue
-                else:
-                    break
-            short_name = short_name.decode('UTF-16LE')
+        entries, leftover = _decodeQueryDirectory(data_bytes, ignore, where)
+        for entry in entries:
             if results.at >= begin_at:
-                results.append(SharedFile(convertFILETIMEtoEpoch(create_time), convertFILETIMEtoEpoch(last_access_time),
-                                          convertFILETIMEtoEpoch(last_write_time), convertFILETIMEtoEpoch(last_attr_change_time),
-                                          file_size, alloc_size, file_attributes, short_name, filename))
-                if limit != 0 and len(results) >= limit:
+                results.append(entry)
+                if limit != 0 and results.at + 1 - begin_at >= limit:
                     return False
             results.at += 1
-            if next_offset:
-                offset += next_offset
-            else:
-                break
-        return ''
+        return leftover
 
     def closeFid(tid, fid, results = None, error = None):
         m = SMB2Message(SMB2CloseRequest(fid))
@@ -246,7 +589,8 @@ def _listPath_SMB2(
 
 def _listPath_SMB1(
         self, service_name, path, callback, errback, search,
-        pattern, timeout = 30, limit=0, begin_at=0, ignore=None
+        pattern, timeout = 30, limit=0, begin_at=0, ignore=None,
+        where=None,
     ):
     if not self.has_authenticated:
         raise NotReadyError('SMB connection not authenticated')
@@ -301,8 +645,11 @@ def _listPath_SMB1(
             if offset2 + filename_length > data_length:
                 return data_bytes[offset:]
 
-            filename = data_bytes[offset2:offset2+filename_length].decode('UTF-16LE')
-            if filename in ignore:
+            if where is not None and not where.accept(file_size, file_attributes, create_time, last_write_time):
+                filename = None
+            else:
+                filename = data_bytes[offset2:offset2+filename_length].decode('UTF-16LE')
+            if filename is None or filename in ignore:
                 if next_offset:
                     offset += next_offset
                     continue
@@ -439,23 +786,30 @@ def _listPath_SMB1(
         sendFindFirst(self.connected_trees[service_name])
 
 
-def storeFileFromOffset(conn, service_name, path, file_obj, offset = 0, timeout = 30, overwrite=False):
+def retrieveFileFromOffset(conn, service_name, path, file_obj, offset = 0, max_length = -1, timeout = 30, window = None):
     """
-    Store the contents of the *file_obj* at *path* on the *service_name*.
+    Retrieve the contents of the file at *path* on the *service_name* and write these contents to the provided *file_obj*.
+    Over SMB2 several reads are kept in flight and reassembled in order, SMB1 connections use pysmb's sequential implementation.
+
     :param string/unicode service_name: the name of the shared folder for the *path*
-    :param string/unicode path: Path of the file on the remote server. If the file at *path* does not exist, it will be created. Otherwise, it will be overwritten.
-                                If the *path* refers to a folder or the file cannot be opened for writing, an :doc:`OperationFailure<smb_exceptions>` will be raised.
-    :param file_obj: A file-like object that has a *read* method. Data will read continuously from *file_obj* until EOF.
-    :return: Number of bytes uploaded
+    :param string/unicode path: Path of the file on the remote server. If the file cannot be opened for reading, an :doc:`OperationFailure<smb_exceptions>` will be raised.
+    :param file_obj: A file-like object that has a *write* method. Data will be written continuously to *file_obj* until EOF is received from the remote service.
+    :param integer offset: the offset in the remote *path* where the first byte will be read and written to *file_obj*.
+    :param integer max_length: maximum number of bytes to read from the remote *path*. If negative, the file is read until EOF.
+    :param integer window: maximum number of SMB2 reads kept in flight, defaults to WINDOW. Use 1 for strictly sequential reads.
+    :return: A 2-element tuple of ( file attributes of the file on server, number of bytes written to *file_obj* ).
     """
     if not conn.sock:
         raise NotConnectedError('Not connected to server')
 
+    if not conn.is_using_smb2:
+        return conn.retrieveFileFromOffset(service_name, path, file_obj, offset, max_length, timeout = timeout)
+
     results = [ ]
 
     def cb(r):
         conn.is_busy = False
-        results.append(r[1])
+        results.append(r[1:])
 
     def eb(failure):
         conn.is_busy = False
@@ -463,18 +817,56 @@ def storeFileFromOffset(conn, service_name, path, file_obj, offset = 0, timeout
 
     conn.is_busy = True
     try:
-        if conn.is_using_smb2:
-            _storeFileFromOffset_SMB2(conn, service_name, path, file_obj, cb, eb, offset, timeout = timeout, overwrite = overwrite)
-        else:
-            _storeFileFromOffset_SMB1(conn, service_name, path, file_obj, cb, eb, offset, timeout = timeout, overwrite = overwrite)
+        _retrieveFileFromOffset_SMB2(conn, service_name, path, file_obj, cb, eb, offset, max_length, timeout = timeout, window = window)
         while conn.is_busy:
-            conn._pollForNetBIOSPacket(timeout * 1000)
+            conn._pollForNetBIOSPacket(timeout)
     finally:
         conn.is_busy = False
 
     return results[0]
 
-def _storeFileFromOffset_SMB2(conn, service_name, path, file_obj, callback, errback, starting_offset, timeout = 30, overwrite = False):
+def _retrieveFileFromOffset_SMB2(conn, service_name, path, file_obj, callback, errback, starting_offset, max_length, timeout = 30, window = None):
+    messages_history = [ ]
+    credits = CreditWindow(window)
+
+    def openCB(create_message):
+        tid, fid = create_message.tid, create_message.payload.fid
+        file_attributes = create_message.payload.file_attributes
+        end = create_message.payload.file_size
+        if max_length >= 0:
+            end = min(end, starting_offset + max_length)
+
+        def readCB(count, error):
+            closeFid(tid, fid, file_attributes, count, error)
+
+        _readFid_SMB2(conn, tid, fid, file_obj, readCB, errback, starting_offset, end, credits, messages_history, timeout = timeout)
+
+    def closeFid(tid, fid, file_attributes, count, error):
+        m = SMB2Message(SMB2CloseRequest(fid))
+        m.tid = tid
+        conn._sendSMBMessage(m)
+        conn.pending_requests[m.mid] = _PendingRequest(m.mid, int(time.time()) + timeout, closeCB, errback, file_attributes = file_attributes, count = count, error = error)
+        messages_history.append(m)
+
+    def closeCB(close_message, **kwargs):
+        if kwargs['error'] is not None:
+            errback(OperationFailure('Failed to retrieve %s on %s: Read failed' % ( path, service_name ), messages_history))
+        else:
+            callback(( file_obj, kwargs['file_attributes'], kwargs['count'] ))
+
+    _openFile_SMB2(conn, service_name, path, openCB, errback, 'r', credits, messages_history, timeout = timeout)
+
+def _openFile_SMB2(conn, service_name, path, callback, errback, mode, credits, messages_history, timeout = 30, overwrite = False, share_access = None):
+    """
+    Connect to the share when needed and open *path* for reading (mode 'r'),
+    writing (mode 'w') or, when it is a directory, listing (mode 'd').
+    *callback* is passed the CREATE response.
+    """
+    if share_access is None:
+        if mode == 'd':
+            share_access = FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE
+        else:
+            share_access = FILE_SHARE_READ if mode == 'r' else 0
     if not conn.has_authenticated:
         raise NotReadyError('SMB connection not authenticated')
 
@@ -483,93 +875,593 @@ def _storeFileFromOffset_SMB2(conn, service_name, path, file_obj, callback, errb
         path = path[1:]
     if path.endswith('\\'):
         path = path[:-1]
-    messages_history = [ ]
+    action = {'r': 'retrieve', 'w': 'store', 'd': 'list'}[mode]
 
     def sendCreate(tid):
-        if overwrite:
-            OVERWRITE = FILE_OVERWRITE_IF
+        if mode == 'd':
+            request = SMB2CreateRequest(path,
+                                        file_attributes = 0,
+                                        access_mask = FILE_READ_DATA | FILE_READ_EA | FILE_READ_ATTRIBUTES | SYNCHRONIZE,
+                                        share_access = share_access,
+                                        oplock = SMB2_OPLOCK_LEVEL_NONE,
+                                        impersonation = SEC_IMPERSONATE,
+                                        create_options = FILE_DIRECTORY_FILE,
+                                        create_disp = FILE_OPEN)
+        elif mode == 'r':
+            request = SMB2CreateRequest(path,
+                                        file_attributes = 0,
+                                        access_mask = FILE_READ_DATA | FILE_READ_EA | FILE_READ_ATTRIBUTES | READ_CONTROL | SYNCHRONIZE,
+                                        share_access = share_access,
+                                        oplock = SMB2_OPLOCK_LEVEL_NONE,
+                                        impersonation = SEC_IMPERSONATE,
+                                        create_options = FILE_SEQUENTIAL_ONLY | FILE_NON_DIRECTORY_FILE,
+                                        create_disp = FILE_OPEN)
         else:
-            OVERWRITE = FILE_OPEN_IF
-        create_context_data = binascii.unhexlify(
-            b"28 00 00 00 10 00 04 00 00 00 18 00 10 00 00 00"
-            b"44 48 6e 51 00 00 00 00 00 00 00 00 00 00 00 00"
-            b"00 00 00 00 00 00 00 00 20 00 00 00 10 00 04 00"
-            b"00 00 18 00 08 00 00 00 41 6c 53 69 00 00 00 00"
-            b"85 62 00 00 00 00 00 00 18 00 00 00 10 00 04 00"
-            b"00 00 18 00 00 00 00 00 4d 78 41 63 00 00 00 00"
-            b"00 00 00 00 10 00 04 00 00 00 18 00 00 00 00 00"
-            b"51 46 69 64 00 00 00 00".replace(b' ', b'').replace(b'\n', b'')
-        )
-        m = SMB2Message(SMB2CreateRequest(path,
-                                          file_attributes = ATTR_ARCHIVE,
-                                          access_mask = FILE_READ_DATA | FILE_WRITE_DATA | FILE_APPEND_DATA | FILE_READ_ATTRIBUTES | FILE_WRITE_ATTRIBUTES | FILE_READ_EA | FILE_WRITE_EA | WRITE_DAC | READ_CONTROL | SYNCHRONIZE,
-                                          share_access = 0,
-                                          oplock = SMB2_OPLOCK_LEVEL_NONE,
-                                          impersonation = SEC_IMPERSONATE,
-                                          create_options = FILE_SEQUENTIAL_ONLY | FILE_NON_DIRECTORY_FILE,
-                                          create_disp = OVERWRITE,
-                                          create_context_data = create_context_data))
+            if overwrite:
+                OVERWRITE = FILE_OVERWRITE_IF
+            else:
+                OVERWRITE = FILE_OPEN_IF
+            create_context_data = binascii.unhexlify(
+                b"28 00 00 00 10 00 04 00 00 00 18 00 10 00 00 00"
+                b"44 48 6e 51 00 00 00 00 00 00 00 00 00 00 00 00"
+                b"00 00 00 00 00 00 00 00 20 00 00 00 10 00 04 00"
+                b"00 00 18 00 08 00 00 00 41 6c 53 69 00 00 00 00"
+                b"85 62 00 00 00 00 00 00 18 00 00 00 10 00 04 00"
+                b"00 00 18 00 00 00 00 00 4d 78 41 63 00 00 00 00"
+                b"00 00 00 00 10 00 04 00 00 00 18 00 00 00 00 00"
+                b"51 46 69 64 00 00 00 00".replace(b' ', b'').replace(b'\n', b'')
+            )
+            request = SMB2CreateRequest(path,
+                                        file_attributes = ATTR_ARCHIVE,
+                                        access_mask = FILE_READ_DATA | FILE_WRITE_DATA | FILE_APPEND_DATA | FILE_READ_ATTRIBUTES | FILE_WRITE_ATTRIBUTES | FILE_READ_EA | FILE_WRITE_EA | WRITE_DAC | READ_CONTROL | SYNCHRONIZE,
+                                        share_access = share_access,
+                                        oplock = SMB2_OPLOCK_LEVEL_NONE,
+                                        impersonation = SEC_IMPERSONATE,
+                                        create_options = FILE_SEQUENTIAL_ONLY | FILE_NON_DIRECTORY_FILE,
+                                        create_disp = OVERWRITE,
+                                        create_context_data = create_context_data)
+        m = CreditedSMB2Message(request)
         m.tid = tid
         conn._sendSMBMessage(m)
+        credits.sent()
         conn.pending_requests[m.mid] = _PendingRequest(m.mid, int(time.time()) + timeout, createCB, errback, tid = tid)
         messages_history.append(m)
 
     def createCB(create_message, **kwargs):
+        credits.received(create_message)
         messages_history.append(create_message)
         if create_message.status == 0:
-            sendWrite(create_message.tid, create_message.payload.fid, starting_offset)
+            callback(create_message)
         else:
-            errback(OperationFailure('Failed to store %s on %s: Unable to open file' % ( path, service_name ), messages_history))
+            errback(OperationFailure('Failed to %s %s on %s: Unable to open file' % ( action, path, service_name ), messages_history))
 
-    def sendWrite(tid, fid, offset):
-        write_count = conn.max_write_size
-        data = file_obj.read(write_count)
-        data_len = len(data)
-        if data_len > 0:
-            m = SMB2Message(SMB2WriteRequest(fid, data, offset))
+    if service_name not in conn.connected_trees:
+        def connectCB(connect_message, **kwargs):
+            messages_history.append(connect_message)
+            if connect_message.status == 0:
+                conn.connected_trees[service_name] = connect_message.tid
+                sendCreate(connect_message.tid)
+            else:
+                errback(OperationFailure('Failed to %s %s on %s: Unable to connect to shared device' % ( action, path, service_name ), messages_history))
+
+        m = SMB2Message(SMB2TreeConnectRequest(r'\\%s\%s' % ( conn.remote_name.upper(), service_name )))
+        conn._sendSMBMessage(m)
+        conn.pending_requests[m.mid] = _PendingRequest(m.mid, int(time.time()) + timeout, connectCB, errback, path = service_name)
+        messages_history.append(m)
+    else:
+        sendCreate(conn.connected_trees[service_name])
+
+def _readFid_SMB2(conn, tid, fid, file_obj, callback, errback, starting_offset, end, credits, messages_history, timeout = 30):
+    """
+    Read the bytes from *starting_offset* up to *end* of an open file into
+    *file_obj*, keeping as many READs in flight as *credits* allows. Calls
+    callback(bytes_written, error) once every read has come back, error is
+    the status of the first failed read or None.
+    """
+    # Blocks still to be requested as (offset, length), blocks that arrived
+    # ahead of the write position keyed by offset, the offset up to which
+    # file_obj has been written and where the file turned out to end.
+    todo = deque()
+    arrived = { }
+    state = {'written': starting_offset, 'end': None, 'error': None}
+    block = conn.max_read_size
+    for offset in range(starting_offset, end, block):
+        todo.append(( offset, min(block, end - offset) ))
+
+    def sendReads():
+        while todo and state['error'] is None and credits.available():
+            offset, length = todo.popleft()
+            if state['end'] is not None and offset >= state['end']:
+                continue
+            m = CreditedSMB2Message(SMB2ReadRequest(fid, read_offset = offset, read_len = length, min_read_len = 0))
             m.tid = tid
             conn._sendSMBMessage(m)
-            conn.pending_requests[m.mid] = _PendingRequest(m.mid, int(time.time()) + timeout, writeCB, errback, fid = fid, offset = offset+data_len)
-        else:
-            closeFid(tid, fid, offset = offset)
+            credits.sent()
+            conn.pending_requests[m.mid] = _PendingRequest(m.mid, int(time.time()) + timeout, readCB, errback, offset = offset, length = length)
+        if credits.in_flight == 0:
+            callback(state['written'] - starting_offset, state['error'])
+
+    def readCB(read_message, **kwargs):
+        credits.received(read_message)
+        offset, length = kwargs['offset'], kwargs['length']
+        if read_message.status == 0 and read_message.payload.data_length > 0:
+            data = read_message.payload.data
+            arrived[offset] = data
+            if len(data) < length:
+                # Short read, ask for the rest of the block next.
+                todo.appendleft(( offset + len(data), length - len(data) ))
+            while state['written'] in arrived:
+                data = arrived.pop(state['written'])
+                file_obj.write(data)
+                state['written'] += len(data)
+        elif read_message.status in (0, 0xC0000011):  # STATUS_END_OF_FILE
+            # The file was truncated since it was opened.
+            if state['end'] is None or offset < state['end']:
+                state['end'] = offset
+        elif state['error'] is None:
+            messages_history.append(read_message)
+            state['error'] = read_message.status
+        sendReads()
+
+    sendReads()
+
+def _writeFid_SMB2(conn, tid, fid, file_obj, callback, errback, starting_offset, credits, messages_history, timeout = 30):
+    """
+    Write the contents of *file_obj* to an open file starting at
+    *starting_offset*, keeping as many WRITEs in flight as *credits* allows.
+    Calls callback(end_offset, error) once every write has come back, error
+    is the status of the first failed write or None.
+    """
+    # Offset of the next block read from file_obj and the first write error
+    state = {'offset': starting_offset, 'eof': False, 'error': None}
+    write_count = conn.max_write_size
+
+    def sendWrites():
+        # Each block is sent to its own offset so the order the server
+        # completes them in doesn't matter.
+        while not state['eof'] and state['error'] is None and credits.available():
+            data = file_obj.read(write_count)
+            data_len = len(data)
+            if data_len == 0:
+                state['eof'] = True
+                break
+            m = CreditedSMB2Message(SMB2WriteRequest(fid, data, state['offset']))
+            m.tid = tid
+            conn._sendSMBMessage(m)
+            credits.sent()
+            conn.pending_requests[m.mid] = _PendingRequest(m.mid, int(time.time()) + timeout, writeCB, errback, length = data_len)
+            state['offset'] += data_len
+        if credits.in_flight == 0:
+            callback(state['offset'], state['error'])
 
     def writeCB(write_message, **kwargs):
+        credits.received(write_message)
         # To avoid crazy memory usage when saving large files, we do not save every write_message in messages_history.
-        if write_message.status == 0:
-            sendWrite(write_message.tid, kwargs['fid'], kwargs['offset'])
+        if write_message.status != 0:
+            if state['error'] is None:
+                messages_history.append(write_message)
+                state['error'] = write_message.status
+        elif write_message.payload.count != kwargs['length']:
+            if state['error'] is None:
+                messages_history.append(write_message)
+                state['error'] = 'short write'
+        # Once a write has failed no more are sent, the file is closed when
+        # the ones still in flight have come back.
+        sendWrites()
+
+    sendWrites()
+
+def _closeFid_SMB2(conn, tid, fid, callback, errback, messages_history, timeout = 30):
+    m = SMB2Message(SMB2CloseRequest(fid))
+    m.tid = tid
+    conn._sendSMBMessage(m)
+    conn.pending_requests[m.mid] = _PendingRequest(m.mid, int(time.time()) + timeout, callback, errback)
+    messages_history.append(m)
+
+def _run(conn, start, timeout = 30):
+    """
+    Call start(callback, errback) and poll the connection until one of them
+    is called. Returns the value passed to callback.
+    """
+    if not conn.sock:
+        raise NotConnectedError('Not connected to server')
+
+    results = [ ]
+
+    def cb(r):
+        conn.is_busy = False
+        results.append(r)
+
+    def eb(failure):
+        conn.is_busy = False
+        raise failure
+
+    conn.is_busy = True
+    try:
+        start(cb, eb)
+        while conn.is_busy:
+            conn._pollForNetBIOSPacket(timeout)
+    finally:
+        conn.is_busy = False
+
+    return results[0]
+
+def openFile(conn, service_name, path, mode = 'r', timeout = 30, overwrite = False, share_access = None):
+    """
+    Open the file at *path* on the *service_name* and return an SMBFile. The
+    file stays open until SMBFile.close() is called, so sequential reads or
+    writes don't have to open and close it every time. Only SMB2 is supported.
+
+    :param string/unicode mode: 'r' to open an existing file for reading, 'w' to open or create it for reading and writing.
+    :param boolean overwrite: truncate an existing file when opening it for writing.
+    :param integer share_access: FILE_SHARE_xxx bits granted to other opens, defaults to FILE_SHARE_READ for reading and none for writing.
+    """
+    if not conn.is_using_smb2:
+        raise NotImplementedError('Open file handles require SMB2')
+    messages_history = [ ]
+    credits = CreditWindow()
+
+    def start(callback, errback):
+        _openFile_SMB2(conn, service_name, path, callback, errback, mode, credits, messages_history, timeout = timeout, overwrite = overwrite, share_access = share_access)
+
+    create_message = _run(conn, start, timeout)
+    return SMBFile(
+        conn, service_name, path, mode, create_message.tid,
+        create_message.payload.fid, create_message.payload.file_size,
+        create_message.payload.file_attributes, credits, timeout = timeout,
+    )
+
+
+class SMBFile(object):
+    """
+    A file held open on an SMB2 share. Reads and writes reuse the handle and
+    keep several requests in flight like retrieveFileFromOffset and
+    storeFileFromOffset do.
+    """
+
+    def __init__(self, conn, service_name, path, mode, tid, fid, file_size, file_attributes, credits, timeout = 30):
+        self.conn = conn
+        self.service_name = service_name
+        self.path = path
+        self.mode = mode
+        self.tid = tid
+        self.fid = fid
+        self.file_size = file_size
+        self.file_attributes = file_attributes
+        self.credits = credits
+        self.timeout = timeout
+
+    @property
+    def closed(self):
+        return self.fid is None
+
+    def read(self, file_obj, offset = 0, max_length = -1, window = None):
+        """
+        Read up to *max_length* bytes from *offset* into *file_obj*, up to
+        the end of the file when *max_length* is negative. Like
+        retrieveFileFromOffset reads go on until the server reports the end
+        of the file, so data appended since the file was opened is read.
+        Returns the number of bytes written to *file_obj*.
+        """
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        limit = None
+        if max_length >= 0:
+            limit = offset + max_length
+        window = max(1, window or WINDOW)
+        total = 0
+        # Blocks to read at a time past the size the file is known to have
+        probe = 1
+        while limit is None or offset < limit:
+            # Up to the known size in one go, then a block to find out if the
+            # file grew, and a window of blocks at a time while it did, until
+            # the server reports EOF.
+            end = self.file_size
+            if end <= offset:
+                end = offset + self.conn.max_read_size * probe
+                probe = window
+            if limit is not None:
+                end = min(end, limit)
+            count = self._read(file_obj, offset, end, window)
+            total += count
+            offset += count
+            self.file_size = max(self.file_size, offset)
+            if offset < end:
+                break
+        return total
+
+    def _read(self, file_obj, offset, end, window):
+        messages_history = [ ]
+        self.credits.window = window
+
+        def start(callback, errback):
+            def readCB(count, error):
+                if error is not None:
+                    errback(OperationFailure('Failed to retrieve %s on %s: Read failed' % ( self.path, self.service_name ), messages_history))
+                else:
+                    callback(count)
+            _readFid_SMB2(self.conn, self.tid, self.fid, file_obj, readCB, errback, offset, end, self.credits, messages_history, timeout = self.timeout)
+
+        return _run(self.conn, start, self.timeout)
+
+    def write(self, file_obj, offset = 0, window = None):
+        """
+        Write the contents of *file_obj* at *offset*. Returns the number of
+        bytes written.
+        """
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        messages_history = [ ]
+        self.credits.window = max(1, window or WINDOW)
+
+        def start(callback, errback):
+            def writeCB(end, error):
+                if error is not None:
+                    errback(OperationFailure('Failed to store %s on %s: Write failed' % ( self.path, self.service_name ), messages_history))
+                else:
+                    callback(end - offset)
+            _writeFid_SMB2(self.conn, self.tid, self.fid, file_obj, writeCB, errback, offset, self.credits, messages_history, timeout = self.timeout)
+
+        count = _run(self.conn, start, self.timeout)
+        self.file_size = max(self.file_size, offset + count)
+        return count
+
+    def close(self):
+        """
+        Close the remote file handle.
+        """
+        if self.closed:
+            return
+        fid, self.fid = self.fid, None
+        if not self.conn.sock:
+            return
+
+        def start(callback, errback):
+            _closeFid_SMB2(self.conn, self.tid, fid, lambda message, **kwargs: callback(message), errback, [ ], timeout = self.timeout)
+
+        _run(self.conn, start, self.timeout)
+
+
+def openDirectory(conn, service_name, path, timeout = 30):
+    """
+    Open the directory at *path* on the *service_name* and return an
+    SMBDirectory. The server keeps track of how far the listing got, so
+    pages of a huge directory can be fetched without listing it again from
+    the start. Only SMB2 is supported.
+    """
+    if not conn.is_using_smb2:
+        raise NotImplementedError('Open directory handles require SMB2')
+    messages_history = [ ]
+
+    def start(callback, errback):
+        _openFile_SMB2(conn, service_name, path, callback, errback, 'd', CreditWindow(1), messages_history, timeout = timeout)
+
+    create_message = _run(conn, start, timeout)
+    return SMBDirectory(
+        conn, service_name, path, create_message.tid,
+        create_message.payload.fid, timeout = timeout,
+    )
+
+
+class SMBDirectory(object):
+    """
+    A directory held open on an SMB2 share for listing.
+    """
+
+    def __init__(self, conn, service_name, path, tid, fid, timeout = 30):
+        self.conn = conn
+        self.service_name = service_name
+        self.path = path
+        self.tid = tid
+        self.fid = fid
+        self.timeout = timeout
+        self.done = False
+        # The responses to the CHANGE_NOTIFY request in flight, None when
+        # there is none
+        self._notify = None
+        self._notify_request = None
+
+    @property
+    def closed(self):
+        return self.fid is None
+
+    def query(self, pattern = '*', restart = False, ignore = (), where = None):
+        """
+        Return the entries of the next QUERY_DIRECTORY response as a list of
+        SharedFile instances, an empty list once the listing is done. The
+        *pattern* is only used by the first query and when *restart* is
+        True, which starts the listing over. Files *where*, an EntryFilter,
+        doesn't accept are left out.
+        """
+        if self.closed:
+            raise ValueError('I/O operation on closed directory')
+        if restart:
+            self.done = False
+        elif self.done:
+            return [ ]
+        messages_history = [ ]
+
+        def start(callback, errback):
+            def queryCB(query_message, **kwargs):
+                messages_history.append(query_message)
+                if query_message.status == 0:
+                    callback(query_message.payload.data)
+                elif query_message.status == 0x80000006:  # STATUS_NO_MORE_FILES
+                    callback(None)
+                else:
+                    errback(OperationFailure('Failed to list %s on %s: Query failed with errorcode 0x%08x' % ( self.path, self.service_name, query_message.status ), messages_history))
+
+            m = SMB2Message(SMB2QueryDirectoryRequest(self.fid, pattern,
+                                                      info_class = 0x03,   # FileBothDirectoryInformation
+                                                      flags = SMB2_RESTART_SCANS if restart else 0,
+                                                      output_buf_len = self.conn.max_transact_size))
+            m.tid = self.tid
+            self.conn._sendSMBMessage(m)
+            self.conn.pending_requests[m.mid] = _PendingRequest(m.mid, int(time.time()) + self.timeout, queryCB, errback)
+            messages_history.append(m)
+
+        while True:
+            data = _run(self.conn, start, self.timeout)
+            if data is None:
+                self.done = True
+                return [ ]
+            entries, _ = _decodeQueryDirectory(data, ignore, where)
+            if entries:
+                return entries
+            # Every entry of the response was ignored or filtered out
+            restart = False
+
+    def notify(self, recursive = False, completion_filter = FILE_NOTIFY_CHANGE_DEFAULT, timeout = None):
+        """
+        Wait up to *timeout* seconds for changes to the directory and return
+        them as a list of ChangeEvent tuples, an empty list if nothing
+        changed in time. A CHANGE_NOTIFY request is sent when none is in
+        flight and left outstanding when the wait times out, so changes are
+        never missed between calls. With *recursive* changes anywhere below
+        the directory are reported, *recursive* and *completion_filter* only
+        take effect when a new request is sent.
+        """
+        if self.closed:
+            raise ValueError('I/O operation on closed directory')
+        if timeout is None:
+            timeout = self.timeout
+        if self._notify is None:
+            responses = self._notify = [ ]
+
+            def notifyCB(notify_message, **kwargs):
+                responses.append(notify_message)
+
+            def errback(failure):
+                responses.append(failure)
+
+            m = SMB2Message(SMB2ChangeNotifyRequest(self.fid, completion_filter,
+                                                    flags = SMB2_WATCH_TREE if recursive else 0,
+                                                    output_buf_len = self.conn.max_transact_size))
+            m.tid = self.tid
+            self.conn._sendSMBMessage(m)
+            # The server answers with STATUS_PENDING right away, pysmb then
+            # moves the request to async_requests until the final response.
+            self._notify_request = _PendingRequest(m.mid, int(time.time()) + self.timeout, notifyCB, errback)
+            self.conn.pending_requests[m.mid] = self._notify_request
+        responses = self._notify
+        expiry_time = time.time() + timeout
+        while not responses:
+            remaining = expiry_time - time.time()
+            if remaining <= 0:
+                return [ ]
+            try:
+                self.conn._pollForNetBIOSPacket(remaining)
+            except SMBTimeout:
+                return [ ]
+        self._notify = self._notify_request = None
+        notify_message = responses[0]
+        if isinstance(notify_message, Exception):
+            raise notify_message
+        if notify_message.status == 0:
+            _, offset, length = struct.unpack('<HHI', notify_message.raw_data[SMB2Message.HEADER_SIZE:SMB2Message.HEADER_SIZE+8])
+            return _decodeNotifyInformation(notify_message.raw_data[offset:offset+length])
+        elif notify_message.status == STATUS_NOTIFY_ENUM_DIR:
+            return [ ChangeEvent(CHANGE_OVERFLOW, None, None) ]
+        elif notify_message.status == STATUS_NOTIFY_CLEANUP:
+            return [ ]
+        raise OperationFailure('Failed to watch %s on %s: Change notify failed with errorcode 0x%08x' % ( self.path, self.service_name, notify_message.status ), [ notify_message ])
+
+    def close(self):
+        """
+        Close the remote directory handle.
+        """
+        if self.closed:
+            return
+        fid, self.fid = self.fid, None
+        try:
+            if not self.conn.sock:
+                return
+
+            def start(callback, errback):
+                _closeFid_SMB2(self.conn, self.tid, fid, lambda message, **kwargs: callback(message), errback, [ ], timeout = self.timeout)
+
+            _run(self.conn, start, self.timeout)
+        finally:
+            self._forget_notify()
+
+    def _forget_notify(self):
+        # The server should complete a CHANGE_NOTIFY with STATUS_NOTIFY_CLEANUP
+        # when the handle is closed. Drop the request in any case, a
+        # connection with outstanding requests can't go back to the pool.
+        request, self._notify_request = self._notify_request, None
+        self._notify = None
+        if request is None:
+            return
+        if self.conn.pending_requests.get(request.mid) is request:
+            del self.conn.pending_requests[request.mid]
+        async_requests = getattr(self.conn, 'async_requests', {})
+        for async_id, req in list(async_requests.items()):
+            if req is request:
+                del async_requests[async_id]
+
+
+def storeFileFromOffset(conn, service_name, path, file_obj, offset = 0, timeout = 30, overwrite=False, window=None):
+    """
+    Store the contents of the *file_obj* at *path* on the *service_name*.
+    :param string/unicode service_name: the name of the shared folder for the *path*
+    :param string/unicode path: Path of the file on the remote server. If the file at *path* does not exist, it will be created. Otherwise, it will be overwritten.
+                                If the *path* refers to a folder or the file cannot be opened for writing, an :doc:`OperationFailure<smb_exceptions>` will be raised.
+    :param file_obj: A file-like object that has a *read* method. Data will read continuously from *file_obj* until EOF.
+    :param integer window: maximum number of SMB2 writes kept in flight, defaults to WINDOW. Use 1 for strictly sequential writes.
+    :return: Number of bytes uploaded
+    """
+    if not conn.sock:
+        raise NotConnectedError('Not connected to server')
+
+    results = [ ]
+
+    def cb(r):
+        conn.is_busy = False
+        results.append(r[1])
+
+    def eb(failure):
+        conn.is_busy = False
+        raise failure
+
+    conn.is_busy = True
+    try:
+        if conn.is_using_smb2:
+            _storeFileFromOffset_SMB2(conn, service_name, path, file_obj, cb, eb, offset, timeout = timeout, overwrite = overwrite, window = window)
         else:
-            messages_history.append(write_message)
-            closeFid(write_message.tid, kwargs['fid'])
-            errback(OperationFailure('Failed to store %s on %s: Write failed' % ( path, service_name ), messages_history))
+            _storeFileFromOffset_SMB1(conn, service_name, path, file_obj, cb, eb, offset, timeout = timeout, overwrite = overwrite)
+        while conn.is_busy:
+            conn._pollForNetBIOSPacket(timeout * 1000)
+    finally:
+        conn.is_busy = False
+
+    return results[0]
+
+def _storeFileFromOffset_SMB2(conn, service_name, path, file_obj, callback, errback, starting_offset, timeout = 30, overwrite = False, window = None):
+    messages_history = [ ]
+    credits = CreditWindow(window)
+
+    def openCB(create_message):
+        tid, fid = create_message.tid, create_message.payload.fid
+
+        def writeCB(offset, error):
+            closeFid(tid, fid, offset, error)
 
-    def closeFid(tid, fid, error = None, offset = None):
+        _writeFid_SMB2(conn, tid, fid, file_obj, writeCB, errback, starting_offset, credits, messages_history, timeout = timeout)
+
+    def closeFid(tid, fid, offset, error):
         m = SMB2Message(SMB2CloseRequest(fid))
         m.tid = tid
         conn._sendSMBMessage(m)
-        conn.pending_requests[m.mid] = _PendingRequest(m.mid, int(time.time()) + timeout, closeCB, errback, fid = fid, offset = offset, error = error)
+        conn.pending_requests[m.mid] = _PendingRequest(m.mid, int(time.time()) + timeout, closeCB, errback, offset = offset, error = error)
         messages_history.append(m)
 
     def closeCB(close_message, **kwargs):
-        if kwargs['offset'] is not None:
-            callback(( file_obj, kwargs['offset'] ))  # Note that this is a tuple of 2-elements
-        elif kwargs['error'] is not None:
+        if kwargs['error'] is not None:
             errback(OperationFailure('Failed to store %s on %s: Write failed' % ( path, service_name ), messages_history))
+        else:
+            callback(( file_obj, kwargs['offset'] ))  # Note that this is a tuple of 2-elements
 
-    if service_name not in conn.connected_trees:
-        def connectCB(connect_message, **kwargs):
-            messages_history.append(connect_message)
-            if connect_message.status == 0:
-                conn.connected_trees[service_name] = connect_message.tid
-                sendCreate(connect_message.tid)
-            else:
-                errback(OperationFailure('Failed to store %s on %s: Unable to connect to shared device' % ( path, service_name ), messages_history))
-
-        m = SMB2Message(SMB2TreeConnectRequest(r'\\%s\%s' % ( conn.remote_name.upper(), service_name )))
-        conn._sendSMBMessage(m)
-        conn.pending_requests[m.mid] = _PendingRequest(m.mid, int(time.time()) + timeout, connectCB, errback, path = service_name)
-        messages_history.append(m)
-    else:
-        sendCreate(conn.connected_trees[service_name])
+    _openFile_SMB2(conn, service_name, path, openCB, errback, 'w', credits, messages_history, timeout = timeout, overwrite = overwrite)
 
 
 def _storeFileFromOffset_SMB1(conn, service_name, path, file_obj, callback,
@@ -647,7 +1539,8 @@ errback, starting_offset, timeout = 30, **kwargs):
 
 def iter_listPath(conn, service_name, path,
              search = DFLTSEARCH,
-             pattern = '*', timeout = 30, limit=0, begin_at=0, ignore=None):
+             pattern = '*', timeout = 30, limit=0, begin_at=0, ignore=None,
+             where=None):
     """
     Retrieve an iterator of directory listing of files/folders at *path*
 
@@ -656,17 +1549,18 @@ def iter_listPath(conn, service_name, path,
     :param integer search: integer value made up from a bitwise-OR of *SMB_FILE_ATTRIBUTE_xxx* bits (see smb_constants.py).
                            The default *search* value will query for all read-only, hidden, system, archive files and directories.
     :param string/unicode pattern: the filter to apply to the results before returning to the client.
+    :param where: an EntryFilter the files listed must match.
     :return: A list of :doc:`smb.base.SharedFile<smb_SharedFile>` instances.
     """
     if not conn.sock:
         raise NotConnectedError('Not connected to server')
 
-    results = [ ]
     results = Results()
 
     def cb(entries):
         conn.is_busy = False
-        results.extend(entries)
+        if entries is not results:
+            results.extend(entries)
 
     def eb(failure):
         conn.is_busy = False
@@ -675,16 +1569,18 @@ def iter_listPath(conn, service_name, path,
     conn.is_busy = True
     try:
         if conn.is_using_smb2:
+            # Entries are yielded as each QUERY_DIRECTORY response is decoded
             _listPath_SMB2(
                 conn, service_name, path, cb, eb, search = search,
                 pattern = pattern, timeout = timeout, limit=limit,
-                begin_at=begin_at, ignore=ignore,
+                begin_at=begin_at, ignore=ignore, where=where,
+                results=results,
             )
         else:
             _listPath_SMB1(
                 conn, service_name, path, cb, eb, search = search,
                 pattern = pattern, timeout = timeout, limit=limit,
-                begin_at=begin_at, ignore=ignore,
+                begin_at=begin_at, ignore=ignore, where=where,
             )
         while conn.is_busy:
             conn._pollForNetBIOSPacket(timeout)
@@ -244,30 +244,19 @@ class SMBUrl(SMBPath, BasicIO):
     def __init__(
             self, uri, mode='r', user=None, password=None, api=None,
             clientname=CLIENTNAME, find_dfs_share=None, write_lock=None,
-            timeout=120, _attrs=None,
+            timeout=120, _attrs=None, buffer_size=None,
             ):
 
         self._orig_uri = uri
         self.uri = Uri(uri)
         path = u'\\\\{}{}'.format(self.uri.host, self.uri.path.replace('/', '\\'))
-        self._set_path(path)
-        self.find_dfs_share = find_dfs_share or default_find_dfs_share
-        server_name, share, domain, relpath = self.find_dfs_share(self.path)
-        self.server_name = server_name
-        self.share = share
-        self.relpath = relpath
-        self.domain = domain
-        self.user = user or SMB_USER
-        self.password = password or SMB_PASS
-        self.clientname = clientname
-        self.timeout = timeout
-        self._index = 0
-        self.mode = mode
-        self._conn = None
-        self.WRITELOCK = write_lock
-        self._attrs = _attrs
-        self._is_direct_tcp = None
-        self.ignore_filenames = SMB_IGNORE_FILENAMES
+        super(SMBUrl, self).__init__(
+            path, mode=mode, user=user, password=password, api=api,
+            clientname=clientname,
+            find_dfs_share=find_dfs_share or default_find_dfs_share,
+            write_lock=write_lock, timeout=timeout, _attrs=_attrs,
+            buffer_size=buffer_size,
+        )
 
     def __repr__(self):
         return '<SMBUrl({}, mode={}) at {}>'.format(
@@ -288,377 +277,6 @@ class SMBUrl(SMBPath, BasicIO):
     def uri(self, uri):
         self._uri = uri
 
-    def tell(self):
-        return self._index
-
-    def seek(self, index, *args):
-        self._index = index
-
-    def read(self, size=-1, conn=None):
-        if size is None:
-            size = -1
-        if conn is None:
-            conn = self.get_connection()
-        fp = io.BytesIO()
-        conn.retrieveFileFromOffset(
-            self.share, self.relpath, fp, self._index, size
-        )
-        self._index = self._index + fp.tell()
-        fp.seek(0)
-        return fp.read()
-
-    def get_connection(self):
-        from socket import error
-        if not self._conn:
-            if self._is_direct_tcp is None:
-                try:
-                    self._conn = get_smb_connection(
-                        self.server_name, self.domain, self.user, self.password,
-                        timeout=self.timeout, is_direct_tcp = True
-                    )
-                    self._is_direct_tcp = True
-                except error as e:
-                    if e.errno != 61 and e.errno != 104:
-                        raise
-                    self._conn = get_smb_connection(
-                        self.server_name, self.domain, self.user, self.password,
-                        timeout=self.timeout, is_direct_tcp = False
-                    )
-                    self._is_direct_tcp = False
-            else:
-                self._conn = get_smb_connection(
-                    self.server_name, self.domain, self.user, self.password,
-                    timeout=self.timeout, is_direct_tcp=self._is_direct_tcp
-                )
-
-            self._conn.timestamp = time.time()
-        elif time.time() - self.MAX_CONNECTION_TIME > self._conn.timestamp:
-            self._conn = get_smb_connection(
-                self.server_name, self.domain, self.user, self.password,
-                timeout=self.timeout, is_direct_tcp=self._is_direct_tcp
-            )
-            self._conn.timestamp = time.time()
-        return self._conn
-
-    def exists(self, relpath=None):
-        conn = self.get_connection()
-        try:
-            stat = conn.getAttributes(self.share, self.relpath)
-        except OperationFailure:
-            return False
-        return stat != None
-
-    def makedirs(self, relpath=None, is_dir=False, exist_ok=False):
-        if not relpath:
-            relpath = self.relpath
-        c = self.get_connection()
-        if is_dir:
-            dirs = relpath.split('\\')
-        else:
-            dirs = relpath.split('\\')[:-1]
-        path = ''
-        if self.WRITELOCK:
-            self.WRITELOCK.acquire(self.server_name, self.share, self.relpath)
-        try:
-            for a in dirs:
-                path = '{0}\\{1}'.format(path.strip('\\'), a.strip('\\'))
-                if path != self.relpath or exist_ok:
-                    try:
-                        c.listPath(self.share, path, timeout=self.timeout)
-                    except smb.smb_structs.OperationFailure as e:
-                        pass
-                    else:
-                        continue
-                c.createDirectory(self.share, path)
-        finally:
-            if self.WRITELOCK:
-                self.WRITELOCK.release(self.server_name, self.share, self.relpath)
-
-    def write(self, fp):
-        if not hasattr(fp, 'read'):
-            fp = io.BytesIO(fp)
-        if self.mode == 'r':
-            raise Exception("File not open for writing")
-        if self.WRITELOCK:
-            self.WRITELOCK.acquire(self.server_name, self.share, self.relpath)
-        try:
-            conn = self.get_connection()
-            storeFileFromOffset(conn, self.share, self.relpath, fp, offset=self._index, timeout=self.timeout)
-            fp.seek(0)
-            self._index = self._index + len(fp.read())
-        finally:
-            if self.WRITELOCK:
-                self.WRITELOCK.release(self.server_name, self.share, self.relpath)
-
-    def files(self, glob='*', limit=0, offset=0, recurse=False):
-        return self.ls(
-            glob=glob, return_dirs=False, limit=limit, offset=offset,
-            recurse=recurse
-        )
-
-    def filenames(self, glob='*', limit=0, offset=0, recurse=False):
-        return self.ls_names(
-            glob=glob, return_dirs=False, limit=limit, offset=offset,
-            recurse=recurse,
-        )
-
-    def dirs(self, glob='*', limit=0, offset=0, recurse=False):
-        return self.ls(
-            glob=glob,
-            limit=limit,
-            offset=offset,
-            recurse=recurse,
-            return_files=False
-        )
-
-    def dirnames(self, glob='*', limit=0, offset=0, recurse=False):
-        return self.ls_names(
-            glob=glob,
-            limit=limit,
-            offset=offset,
-            recurse=recurse,
-            return_files=False
-        )
-
-    def _walk(self):
-        dirs = []
-        files = []
-        for i in self.ls():
-            if i.isdir():
-                dirs.append(i)
-            else:
-                files.append(i)
-        return dirs, files
-
-    def walk(self, top_down=False):
-        dirs, files = self._walk()
-        if top_down:
-            for x in dirs:
-                for _ in x.walk(top_down=top_down):
-                    yield _
-        yield self, dirs, files
-        if top_down:
-            return
-        for x in dirs:
-            for _ in x.walk(top_down=top_down):
-                yield _
-
-    def close(self):
-        self.get_connection().close()
-
-    def ls(
-            self, glob='*', limit=0, offset=0, recurse=False,
-            return_files=True, return_dirs=True, _done=0, _at=-1
-        ):
-        """
-        List a directory and return the names of the files and directories.
-        """
-        conn = self.get_connection()
-        paths = []
-        if not return_files and not return_dirs:
-            raise Exception("At lest one return_files or return_dirs must be true")
-        paths = iter_listPath(
-            conn,
-            self.share,
-            self.relpath,
-            pattern=glob,
-            limit=0,
-            timeout=self.timeout,
-            begin_at=0,
-            ignore=self.ignore_filenames,
-        )
-        for a in paths:
-            _at += 1
-            if _at < offset:
-                continue
-            if limit > 0 and _done >= limit:
-                raise StopIteration
-            if a.isDirectory:
-                p = self.join(a.filename, _attrs=a)
-                if return_dirs:
-                    yield p
-                    _done += 1
-                if recurse:
-                    for _ in p.ls(glob, limit, offset, recurse, return_files,
-                        return_dirs, _done, _at):
-                        yield _
-                        _done += 1
-            elif return_files:
-                yield SMBPath(self.path).join(
-                    a.filename, _attrs=a
-                )
-                _done += 1
-
-    def recurse_files(self, glob='*', limit=0, offset=0):
-        return self.filenames(
-            glob=glob, recurse=True, limit=limit, offset=offset,
-        )
-
-    def recurse(self, glob='*', limit=0, offset=0):
-        return self.ls_names(
-            glob=glob, limit=limit, offset=offset, recurse=True
-        )
-
-    def ls_names(
-            self, glob='*', limit=0, offset=0, recurse=False, return_files=True,
-            return_dirs=True
-        ):
-        """
-        List a directory and return the names of the files and directories.
-        """
-        for a in self.ls(
-                glob=glob, limit=limit, offset=offset, recurse=recurse,
-                return_files=return_files, return_dirs=return_dirs,
-            ):
-            yield a.path
-
-    def remove(self):
-        conn = self.get_connection()
-        if self.WRITELOCK:
-            self.WRITELOCK.acquire(self.server_name, self.share, self.relpath)
-        if self.isdir():
-            try:
-                conn.deleteDirectory(self.share, self.relpath)
-            finally:
-                if self.WRITELOCK:
-                    self.WRITELOCK.release(self.server_name,  self.share, self.relpath)
-            return
-        try:
-            conn.deleteFiles(self.share, self.relpath)
-        finally:
-            if self.WRITELOCK:
-                self.WRITELOCK.release(self.server_name,  self.share, self.relpath)
-
-    @staticmethod
-    def _dirname(inpath):
-        return smb_dirname(inpath)
-
-    @property
-    def _attrs(self):
-        if not self.__attrs:
-            conn = self.get_connection()
-            self.__attrs = conn.getAttributes(self.share, self.relpath)
-        return self.__attrs
-
-    @_attrs.setter
-    def _attrs(self, attrs):
-        self.__attrs = attrs
-
-    @property
-    def atime(self):
-        return getFiletime(self._attrs.last_access_time)
-
-    @property
-    def mtime(self):
-        return getFiletime(self._attrs.last_write_time)
-
-    @property
-    def ctime(self):
-        return getFiletime(self._attrs.create_time)
-
-    @property
-    def size(self):
-        return self._attrs.file_size
-
-    def stat(self):
-        # dir(self._attrs) == ['__doc__', '__init__', '__module__',
-        # '__unicode__', 'alloc_size', 'create_time', 'file_attributes',
-        # 'file_size', 'filename', 'isDirectory', 'isReadOnly',
-        # 'last_access_time', 'last_attr_change_time',
-        # 'last_write_time', 'short_name']
-        return {
-           'size': self._attrs.file_size,
-           'atime': getFiletime(self._attrs.last_access_time),
-           'mtime': getFiletime(self._attrs.last_write_time),
-           'ctime': getFiletime(self._attrs.create_time),
-        }
-
-    @property
-    def dirname(self):
-        return smb_dirname(self.path)
-
-    @property
-    def rel_dirname(self):
-        return smb_dirname(self.relpath)
-
-    @property
-    def basename(self):
-        return smb_basename(self.path)
-
-    @property
-    def rel_basename(self):
-        return smb_basename(self.relpath)
-
-    def join(self, *joins, **kwargs):
-        p = self
-        for joinname in joins:
-            p = SMBPath(p.static_join(p.path, joinname), **kwargs)
-        return p
-
-    @staticmethod
-    def static_join(dirname, basename):
-        return u"{0}\\{1}".format(
-            dirname.rstrip('\\'),
-            basename.lstrip('\\')
-        )
-
-    def readline(self):
-        size = 1024
-        start_pos = self.tell()
-        while True:
-            chunk = self.read(size)
-            if not chunk:
-                break
-            if chunk.find('\n') != -1:
-                break
-        if chunk.find('\n') == -1:
-            return
-        line = chunk[:chunk.find('\n') + 1]
-        self.seek(start_pos + len(line))
-        return line
-
-    def readlines(self):
-        line = self.readline()
-        while line:
-            yield line
-            line = self.readline()
-
-    def isdir(self):
-        return self._attrs.isDirectory
-
-    def rename(self, newname):
-        newp = SMBPath(newname)
-        if newp.server_name != self.server_name or newp.share != self.share:
-            raise Exception("Can only rename on the same server and share")
-        c = self.get_connection()
-        c.rename(self.share, self.relpath, newp.relpath)
-        self.relpath = newp.relpath
-
-    def rmtree(self):
-        for _, dirs, files in self.walk(top_down=True):
-            for d in dirs:
-                if d.exists():
-                    d.remove()
-            for f in files:
-                f.remove()
-            _.remove()
-
-    def readable(self):
-        return 'r' in self.mode
-
-    def writable(self):
-        return 'w' in self.mode or 'b' in self.mode
-
-    def seekable(self):
-        "No known casees where this shouldn't be True"
-        return True
-
-    @property
-    def closed(self):
-        if self.get_connection().sock is None:
-            return True
-        return False
-
 
 class _S3Upload(object):
 
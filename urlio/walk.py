@@ -0,0 +1,232 @@
+"""
+Parallel directory walking.
+
+A sequential walk lists one directory at a time, so crawling a large share
+is bound by the round trip of every QUERY_DIRECTORY exchange. The walker in
+this module lists several directories at once from a pool of worker
+threads. Each worker checks its own connection out of the shared pool for
+every listing.
+"""
+from __future__ import absolute_import
+import collections
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class _Listing(object):
+    "A directory waiting to be, or already, listed by a worker"
+
+    def __init__(self, path, depth=0):
+        self.path = path
+        self.depth = depth
+        self.submitted = False
+        self.done = False
+        self.dirs = None
+        self.files = None
+        self.error = None
+
+
+class _Frame(object):
+    """
+    The subdirectories of a directory still to be walked, the first few
+    already taken off as _Listing objects. With top_down result is the
+    directory's own listing, yielded once the frame is done.
+    """
+
+    def __init__(self, children, depth, result=None, ahead=()):
+        self.children = children
+        self.depth = depth
+        self.result = result
+        self.ahead = collections.deque(ahead)
+
+    def pull(self):
+        "Take the next subdirectory into ahead, False when there is none"
+        for path in self.children:
+            self.ahead.append(_Listing(path, self.depth))
+            return True
+        return False
+
+    def next(self):
+        if not self.ahead and not self.pull():
+            return None
+        return self.ahead.popleft()
+
+
+class ParallelWalker(object):
+    """
+    Iterate over (dir, dirs, files) tuples for the tree below *top* like
+    walk(), listing up to *workers* directories concurrently.
+
+    - top_down: same meaning as for SMBPath.walk(), when True a directory
+      is yielded after everything below it
+    - ordered: yield directories in the order a sequential walk would.
+      When False directories are yielded as soon as their listing comes
+      back, which keeps every worker busy.
+    - max_depth: how many levels below top to descend, None for no limit
+    - max_pending: maximum number of directories being listed, or listed
+      and not yet yielded (defaults to twice the number of workers).
+      Directories that haven't been listed yet aren't kept, the walker
+      holds an iterator over the subdirectories of each directory it is
+      in the middle of, as a sequential walk does. The tree is explored
+      depth first, so those are the directories between top and the ones
+      being listed.
+
+    Directories are listed by calling their _walk() method, which must
+    return a (dirs, files) tuple. With entries it is called as
+    _walk(entries=True) and with where, an EntryFilter for the files, as
+    _walk(where=where).
+    """
+
+    def __init__(
+            self, top, workers=4, top_down=False, ordered=True,
+            max_pending=None, max_depth=None, entries=False, where=None,
+        ):
+        self.top = top
+        self.workers = max(1, workers)
+        self.top_down = top_down
+        self.ordered = ordered
+        self.max_depth = max_depth
+        self.entries = entries
+        self.where = where
+        if max_pending is None:
+            max_pending = 2 * self.workers
+        self.max_pending = max(1, max_pending)
+        self._jobs = collections.deque()
+        self._pending = 0
+        self._stopped = False
+        self._cond = threading.Condition(threading.Lock())
+
+    def __iter__(self):
+        threads = []
+        for n in range(self.workers):
+            t = threading.Thread(target=self._work, name='urlio-walk-{}'.format(n))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        try:
+            if self.ordered:
+                walk = self._walk_ordered()
+            else:
+                walk = self._walk_unordered()
+            for result in walk:
+                yield result
+        finally:
+            with self._cond:
+                self._stopped = True
+                self._jobs.clear()
+                self._cond.notify_all()
+
+    def _walk_ordered(self):
+        # A stack of frames, one per directory on the way down to the one
+        # being walked, each iterating over the subdirectories still to be
+        # listed. The directories next in line are taken off the frames
+        # into their lookahead and handed to the workers.
+        top = _Listing(self.top)
+        self._submit(top)
+        stack = [_Frame(iter(()), 1, ahead=[top])]
+        while stack:
+            self._prefetch(stack)
+            frame = stack[-1]
+            entry = frame.next()
+            if entry is None:
+                stack.pop()
+                if frame.result is not None:
+                    yield frame.result
+                continue
+            if not entry.submitted:
+                self._submit(entry)
+            result = self._result(entry)
+            children = self._children(entry, result)
+            if self.top_down:
+                stack.append(_Frame(iter(children), entry.depth + 1, result))
+            else:
+                stack.append(_Frame(iter(children), entry.depth + 1))
+                yield result
+
+    def _walk_unordered(self):
+        # Iterators over the subdirectories still to be listed, the most
+        # recently listed directory's last so the tree is explored depth
+        # first.
+        frontier = [(iter([self.top]), 0)]
+        running = []
+        while frontier or running:
+            while frontier and len(running) < self.max_pending:
+                children, depth = frontier[-1]
+                for path in children:
+                    entry = _Listing(path, depth)
+                    self._submit(entry)
+                    running.append(entry)
+                    break
+                else:
+                    frontier.pop()
+            if not running:
+                continue
+            with self._cond:
+                while not any(entry.done for entry in running):
+                    self._cond.wait()
+            for entry in [entry for entry in running if entry.done]:
+                running.remove(entry)
+                result = self._result(entry)
+                children = self._children(entry, result)
+                if children:
+                    frontier.append((iter(children), entry.depth + 1))
+                yield result
+
+    def _children(self, entry, result):
+        if self.max_depth is not None and entry.depth >= self.max_depth:
+            return []
+        return result[1]
+
+    def _prefetch(self, stack):
+        # Submit the directories a sequential walk would list next until
+        # max_pending are in flight, going down the stack once the frames
+        # above have nothing left to list.
+        for frame in reversed(stack):
+            while self._pending < self.max_pending:
+                if not frame.pull():
+                    break
+                self._submit(frame.ahead[-1])
+            if self._pending >= self.max_pending:
+                return
+
+    def _submit(self, entry):
+        entry.submitted = True
+        with self._cond:
+            self._pending += 1
+            self._jobs.append(entry)
+            self._cond.notify_all()
+
+    def _result(self, entry):
+        with self._cond:
+            while not entry.done:
+                self._cond.wait()
+            self._pending -= 1
+        if entry.error is not None:
+            raise entry.error
+        return entry.path, entry.dirs, entry.files
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._jobs and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                entry = self._jobs.popleft()
+            try:
+                kwargs = {}
+                if self.entries:
+                    kwargs['entries'] = True
+                if self.where is not None:
+                    kwargs['where'] = self.where
+                dirs, files = entry.path._walk(**kwargs)
+            except Exception as e:
+                log.debug("Failed to list %s", entry.path, exc_info=True)
+                entry.error = e
+            else:
+                entry.dirs, entry.files = dirs, files
+            with self._cond:
+                entry.done = True
+                self._cond.notify_all()